@@ -159,4 +159,10 @@ admin.site.register(models.Sector)
 admin.site.register(models.Region)
 admin.site.register(models.SAField)
 admin.site.register(models.SAFieldOption)
-admin.site.register(models.SAFieldValue)
\ No newline at end of file
+admin.site.register(models.SAFieldValue)
+admin.site.register(models.SimulationJob)
+admin.site.register(models.StaleResult)
+admin.site.register(models.EnsembleDataPoint)
+admin.site.register(models.SensitivityIndex)
+admin.site.register(models.SimulatedSeries)
+admin.site.register(models.SimulationRun)
\ No newline at end of file
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class SahelConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sahel'
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,51 @@
+from dataclasses import fields, replace
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from sahel.sd_model import benchmark
+from sahel.sd_model.model_operations import ENGINES
+
+
+class Command(BaseCommand):
+    help = 'Times the simulation pipeline on a synthetic model, and compares it to a saved baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--size', nargs='?', type=str, choices=list(benchmark.SIZES), default="small",
+                            help="size of the synthetic model, the options below change parts of it")
+        for size_field in fields(benchmark.BenchmarkSize):
+            parser.add_argument(f'--{size_field.name}', nargs='?', type=int,
+                                help=f"number of {size_field.name} of the synthetic model")
+        parser.add_argument('-e', '--engine', nargs='?', type=str, choices=ENGINES, default="numpy",
+                            help="simulation engine, bptk or numpy")
+        parser.add_argument('-n', '--repeat', nargs='?', type=int, default=3,
+                            help="number of runs, times are the medians")
+        parser.add_argument('-d', '--database', nargs='?', type=str, default="local",
+                            help="database the synthetic model is saved to and run from")
+        parser.add_argument('-o', '--output', nargs='?', type=str, help="file to save the JSON report to")
+        parser.add_argument('-b', '--baseline', nargs='?', type=str, help="JSON report to compare to")
+        parser.add_argument('-t', '--tolerance', nargs='?', type=float, default=benchmark.TOLERANCE,
+                            help="how much slower than the baseline a phase can be, 0.25 is 25%%")
+        parser.add_argument('--keep', action='store_true', help="don't delete the synthetic model afterwards")
+
+    def handle(self, *args, **options):
+        size = replace(benchmark.SIZES[options['size']], **{
+            size_field.name: options[size_field.name] for size_field in fields(benchmark.BenchmarkSize)
+            if options[size_field.name] is not None
+        })
+        call_command("migrate", database=options['database'], verbosity=0)
+        with benchmark.use_database(options['database']):
+            report = benchmark.run_benchmark(size, engine=options['engine'], repeat=options['repeat'],
+                                             keep=options['keep'])
+        if options['output'] is not None:
+            benchmark.save_report(report, options['output'])
+            print(f"saved report to {options['output']}")
+        if options['baseline'] is None:
+            for path, seconds in report["seconds"].items():
+                print(f"{path:<45} {seconds:>10.3f}")
+            print(f"writer {report['writer']['rows_per_second']:.0f} rows/s")
+            return
+        regressions = benchmark.compare(report, benchmark.load_report(options['baseline']), options['tolerance'])
+        if regressions:
+            raise CommandError(f"{len(regressions)} phases are slower than the baseline: "
+                               f"{', '.join(path for path, _, _ in regressions)}")
+        return
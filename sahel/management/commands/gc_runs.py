@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from sahel.sd_model.run_registry import collect_garbage, KEEP_DAYS
+
+
+class Command(BaseCommand):
+    help = 'Deletes simulation runs, and their results, that are no longer current'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-d', '--days', nargs='?', type=int, default=KEEP_DAYS,
+                            help="only delete runs started more than this many days ago")
+
+    def handle(self, *args, **options):
+        collect_garbage(keep_days=options['days'])
+        return
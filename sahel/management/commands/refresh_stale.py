@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from sahel.sd_model.model_operations import ENGINES
+from sahel.sd_model.stale_results import refresh_stale
+
+
+class Command(BaseCommand):
+    help = 'Re-runs the model only for results made stale by changes to constants, pulses, data or equations'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-e', '--engine', nargs='?', type=str, choices=ENGINES, default="numpy",
+                            help="simulation engine, bptk or numpy, for results without a run, "
+                                 "the others use the engine of their last run")
+        parser.add_argument('-w', '--workers', nargs='?', type=int, default=1,
+                            help="number of processes to spread the runs over")
+
+    def handle(self, *args, **options):
+        refresh_stale(engine=options['engine'], workers=options['workers'])
+        return
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from sahel.sd_model.ensemble import run_ensemble
+
+
+class Command(BaseCommand):
+    help = 'Runs a Monte Carlo ensemble from forecast intervals and saves p5/p50/p95 bands'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--scenariopks', nargs='+', type=int, help="scenario pks to be run")
+        parser.add_argument('-r', '--responsepks', nargs='+', type=int, help="response pks to be run")
+        parser.add_argument('-m', '--modelpk', nargs='?', type=int, help="model pk to be run")
+        parser.add_argument('-a', '--admin0', nargs='?', type=str, help="admin0 to be run")
+        parser.add_argument('-n', '--samples', nargs='?', type=int, default=100, help="number of samples")
+        parser.add_argument('--householdspread', nargs='?', type=float, default=0.0,
+                            help="relative standard deviation of household constants")
+        parser.add_argument('--seed', nargs='?', type=int, help="random seed")
+        parser.add_argument('-o', '--outputpks', nargs='+', type=int,
+                            help="only run what is needed for these elements, instead of all model outputs")
+
+    def handle(self, *args, **options):
+        scenario_pks = options['scenariopks'] if options['scenariopks'] is not None else [1]
+        response_pks = options['responsepks'] if options['responsepks'] is not None else [1]
+        model_pk = options['modelpk'] if options['modelpk'] is not None else 1
+        admin0 = options['admin0'] if options['admin0'] is not None else 'Mauritanie'
+        run_ensemble(scenario_pks, response_pks, model_pk, admin0, n_samples=options['samples'],
+                     household_spread=options['householdspread'], seed=options['seed'],
+                     output_pks=options['outputpks'])
+        return
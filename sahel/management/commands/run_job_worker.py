@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from sahel.sd_model.job_queue import work
+
+
+class Command(BaseCommand):
+    help = 'Runs queued simulation jobs submitted from the Dash pages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--pollinterval', nargs='?', type=float, default=2.0,
+                            help="seconds to wait between checks when the queue is empty")
+        parser.add_argument('--once', action='store_true', help="stop once the queue is empty")
+
+    def handle(self, *args, **options):
+        work(poll_interval=options['pollinterval'], once=options['once'])
+        return
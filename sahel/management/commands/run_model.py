@@ -1,6 +1,7 @@
 from django.core.management.base import BaseCommand
 from ... import models
-from sahel.sd_model.model_operations import run_model
+from sahel.sd_model.model_operations import run_model, ENGINES
+from sahel.sd_model import parallel, numpy_engine, subnational
 import time
 
 
@@ -11,7 +12,24 @@ class Command(BaseCommand):
         parser.add_argument('-s', '--scenariopks', nargs='+', type=int, help="scenario pks to be run")
         parser.add_argument('-r', '--responsepks', nargs='+', type=int, help="response pks to be run")
         parser.add_argument('-m', '--modelpk', nargs='?', type=int, help="model pk to be run")
-        parser.add_argument('-a', '--admin0', nargs='?', type=str, help="admin0 to be run")
+        parser.add_argument('-a', '--admin0', nargs='+', type=str, help="admin0s to be run")
+        parser.add_argument('-e', '--engine', nargs='?', type=str, choices=ENGINES, default="bptk",
+                            help="simulation engine, bptk or numpy")
+        parser.add_argument('-o', '--outputpks', nargs='+', type=int,
+                            help="only run what is needed for these elements, instead of all model outputs")
+        parser.add_argument('-w', '--workers', nargs='?', type=int, default=1,
+                            help="number of processes to spread the runs over")
+        parser.add_argument('-i', '--integrator', nargs='?', type=str, choices=numpy_engine.INTEGRATORS,
+                            default="euler", help="how the numpy engine steps, euler, rk4 or adaptive")
+        parser.add_argument('--stepsize', nargs='?', type=float,
+                            help="step of rk4 in days (default timestep), or largest step of adaptive (default none, "
+                                 "its error control chooses the steps)")
+        parser.add_argument('-l', '--adminlevel', nargs='?', type=int, choices=subnational.ADMIN_LEVELS,
+                            help="run every admin1 or admin2 unit of each admin0 in one batch, with the numpy engine")
+        parser.add_argument('--noreuse', action='store_true',
+                            help="run every combination, even if its saved results come from the same inputs")
+        parser.add_argument('--profile', action='store_true',
+                            help="also capture cProfile and tracemalloc statistics of the run")
 
     def handle(self, *args, **options):
         # scenarios = models.Scenario.objects.all()
@@ -32,8 +50,24 @@ class Command(BaseCommand):
         scenario_pks = options['scenariopks'] if options['scenariopks'] is not None else [1]
         response_pks = options['responsepks'] if options['responsepks'] is not None else [1]
         model_pk = options['modelpk'] if options['modelpk'] is not None else 1
-        admin0 = options['admin0'] if options['admin0'] is not None else 'Mauritanie'
-        run_model(scenario_pks, response_pks, model_pk, admin0)
+        admin0s = options['admin0'] if options['admin0'] is not None else ['Mauritanie']
+        if options['adminlevel'] is not None:
+            for admin0 in admin0s:
+                subnational.run_subnational(scenario_pks, response_pks, model_pk, admin0, level=options['adminlevel'],
+                                            output_pks=options['outputpks'], integrator=options['integrator'],
+                                            step_size=options['stepsize'], reuse=not options['noreuse'],
+                                            profile=options['profile'])
+            return
+        if len(admin0s) == 1 and options['workers'] == 1:
+            run_model(scenario_pks, response_pks, model_pk, admin0s[0], engine=options['engine'],
+                      output_pks=options['outputpks'], integrator=options['integrator'],
+                      step_size=options['stepsize'], reuse=not options['noreuse'], profile=options['profile'])
+            return
+        output_pks = [str(pk) for pk in options['outputpks']] if options['outputpks'] is not None else None
+        jobs = parallel.make_jobs(scenario_pks, response_pks, [model_pk], admin0s, engine=options['engine'],
+                                  output_pks=output_pks, integrator=options['integrator'],
+                                  step_size=options['stepsize'], reuse=not options['noreuse'])
+        parallel.run_jobs(jobs, workers=options['workers'])
         return
 
 
@@ -0,0 +1,52 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from sahel.sd_model import optimization
+
+
+class Command(BaseCommand):
+    help = 'Searches for the responses with the best outcome within a cost budget, and saves them as response options'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-e', '--elementpk', nargs='?', type=int, help="outcome element to be optimized")
+        parser.add_argument('-b', '--budget', nargs='?', type=float,
+                            help="cost above the baseline response, summed over the run")
+        parser.add_argument('-c', '--constant', nargs=3, action='append', metavar=('PK', 'LOW', 'HIGH'),
+                            help="response constant pk and its range, can be repeated")
+        parser.add_argument('-p', '--pulse', nargs=3, action='append', metavar=('PK', 'LOW', 'HIGH'),
+                            help="pulse input pk and the range of its height, can be repeated")
+        parser.add_argument('--pulsedays', nargs='?', type=int,
+                            help="length of the pulses in days, by default a month around their start")
+        parser.add_argument('--earliest', nargs='?', type=date.fromisoformat,
+                            help="earliest start of the pulses, YYYY-MM-DD")
+        parser.add_argument('--latest', nargs='?', type=date.fromisoformat,
+                            help="latest start of the pulses, YYYY-MM-DD")
+        parser.add_argument('--minimize', action='store_true', help="look for the lowest outcome")
+        parser.add_argument('-n', '--population', nargs='?', type=int, default=optimization.POPULATION,
+                            help="designs simulated in each generation")
+        parser.add_argument('-g', '--generations', nargs='?', type=int, default=optimization.GENERATIONS)
+        parser.add_argument('-k', '--best', nargs='?', type=int, default=3, help="number of designs to save")
+        parser.add_argument('-s', '--scenariopk', nargs='?', type=int, default=1, help="scenario to be run")
+        parser.add_argument('-r', '--responsepk', nargs='?', type=int,
+                            help="response the designs start from, by default the baseline response")
+        parser.add_argument('--costpk', nargs='?', type=int, default=102, help="cost element")
+        parser.add_argument('--baselinepk', nargs='?', type=int, default=1, help="baseline response")
+        parser.add_argument('-m', '--modelpk', nargs='?', type=int, default=1, help="model pk to be run")
+        parser.add_argument('-a', '--admin0', nargs='?', type=str, default='Mauritanie', help="admin0 to be run")
+        parser.add_argument('--seed', nargs='?', type=int, help="random seed")
+
+    def handle(self, *args, **options):
+        constant_ranges = {str(int(pk)): (float(low), float(high)) for pk, low, high in options['constant'] or []}
+        pulse_ranges = {str(int(pk)): (float(low), float(high)) for pk, low, high in options['pulse'] or []}
+        if options['elementpk'] is None or options['budget'] is None or not (constant_ranges or pulse_ranges):
+            print("give an element with -e, a budget with -b, and constants with -c or pulses with -p")
+            return
+        optimization.run_optimization(
+            options['modelpk'], options['admin0'], options['elementpk'], options['budget'],
+            constant_ranges=constant_ranges, pulse_ranges=pulse_ranges, pulse_days=options['pulsedays'],
+            earliest=options['earliest'], latest=options['latest'], maximize=not options['minimize'],
+            population=options['population'], generations=options['generations'], n_best=options['best'],
+            scenario_pk=options['scenariopk'], response_pk=options['responsepk'], cost_element_pk=options['costpk'],
+            baseline_response_pk=options['baselinepk'], seed=options['seed'],
+        )
+        return
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from sahel.sd_model.sensitivity import run_sensitivity, default_ranges
+
+
+class Command(BaseCommand):
+    help = 'Ranks how much constants drive an output with a Morris or Sobol sensitivity analysis, and saves the indices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-e', '--elementpk', nargs='?', type=int, help="output element to be analysed")
+        parser.add_argument('-c', '--constant', nargs=3, action='append', metavar=('PK', 'LOW', 'HIGH'),
+                            help="constant pk and its range, can be repeated")
+        parser.add_argument('-p', '--constantpks', nargs='+', type=int,
+                            help="constant pks, with ranges of +/- spread around their current value")
+        parser.add_argument('--spread', nargs='?', type=float, default=0.5, help="relative spread for -p")
+        parser.add_argument('--method', nargs='?', type=str, default='Morris', choices=['Morris', 'Sobol'])
+        parser.add_argument('-n', '--samples', nargs='?', type=int, default=20,
+                            help="Morris trajectories or Sobol base samples")
+        parser.add_argument('-s', '--scenariopk', nargs='?', type=int, default=1, help="scenario to be run")
+        parser.add_argument('-r', '--responsepk', nargs='?', type=int, default=1, help="response to be run")
+        parser.add_argument('-m', '--modelpk', nargs='?', type=int, default=1, help="model pk to be run")
+        parser.add_argument('-a', '--admin0', nargs='?', type=str, default='Mauritanie', help="admin0 to be run")
+        parser.add_argument('--seed', nargs='?', type=int, help="random seed")
+
+    def handle(self, *args, **options):
+        constant_ranges = {}
+        if options['constantpks'] is not None:
+            constant_ranges.update(default_ranges(
+                options['modelpk'], options['admin0'], options['constantpks'], options['spread']
+            ))
+        for pk, low, high in options['constant'] or []:
+            constant_ranges[str(int(pk))] = (float(low), float(high))
+        if options['elementpk'] is None or not constant_ranges:
+            print("give an element with -e and constants with -c or -p")
+            return
+        run_sensitivity(options['modelpk'], options['admin0'], options['elementpk'], constant_ranges,
+                        method=options['method'], n=options['samples'], scenario_pk=options['scenariopk'],
+                        response_pk=options['responsepk'], seed=options['seed'])
+        return
@@ -14,6 +14,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 from unidecode import unidecode
 from itertools import chain
+from sahel.sd_model.stale_results import mark_stale
 
 MALI_ADMIN1S = ["Gao", "Kidal", "Mopti", "Tombouctou", "Ménaka"]
 MRT_ADMIN1 = 'Hodh Ech Chargi'
@@ -551,4 +552,6 @@ class Command(BaseCommand):
         # update_mrt_wfp()
         # update_mrt_prixmarche()
         update_dm_phm_bkn_maraichange()
+        # bulk creates don't send signals, so mark every result that could use the new data
+        mark_stale("measured data updated")
         pass
\ No newline at end of file
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.15 on 2026-10-18 14:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sahel', '0145_alter_variable_unit'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimulationJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('admin0', models.CharField(max_length=200)),
+                ('scenario_pks', models.CharField(max_length=500)),
+                ('response_pks', models.CharField(max_length=500)),
+                ('startdate', models.DateField()),
+                ('enddate', models.DateField()),
+                ('engine', models.CharField(default='numpy', max_length=20)),
+                ('status', models.CharField(choices=[('Pending', 'En attente'), ('Running', 'En cours'), ('Done', 'Terminé'), ('Failed', 'Échoué'), ('Cancelled', 'Annulé')], default='Pending', max_length=20)),
+                ('cancel_requested', models.BooleanField(default=False)),
+                ('runs_done', models.IntegerField(default=0)),
+                ('runs_total', models.IntegerField(default=0)),
+                ('current_run', models.CharField(blank=True, max_length=200, null=True)),
+                ('message', models.TextField(blank=True, null=True)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('date_started', models.DateTimeField(blank=True, null=True)),
+                ('date_finished', models.DateTimeField(blank=True, null=True)),
+                ('samramodel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='simulationjobs', to='sahel.samramodel')),
+            ],
+        ),
+    ]
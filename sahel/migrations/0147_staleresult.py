@@ -0,0 +1,29 @@
+# Generated by Django 3.2.15 on 2026-10-18 14:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sahel', '0146_simulationjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StaleResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('admin0', models.CharField(blank=True, max_length=200, null=True)),
+                ('reason', models.CharField(blank=True, max_length=500, null=True)),
+                ('date_marked', models.DateTimeField()),
+                ('responseoption', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='staleresults', to='sahel.responseoption')),
+                ('samramodel', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='staleresults', to='sahel.samramodel')),
+                ('scenario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='staleresults', to='sahel.scenario')),
+            ],
+            options={
+                'unique_together': {('scenario', 'responseoption', 'admin0')},
+            },
+        ),
+    ]
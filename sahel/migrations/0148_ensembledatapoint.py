@@ -0,0 +1,31 @@
+# Generated by Django 3.2.15 on 2026-10-18 14:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sahel', '0147_staleresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EnsembleDataPoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('admin0', models.CharField(blank=True, max_length=200, null=True)),
+                ('admin1', models.CharField(blank=True, max_length=200, null=True)),
+                ('admin2', models.CharField(blank=True, max_length=200, null=True)),
+                ('p5', models.FloatField(null=True)),
+                ('p50', models.FloatField(null=True)),
+                ('p95', models.FloatField(null=True)),
+                ('n_samples', models.IntegerField()),
+                ('element', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ensembledatapoints', to='sahel.variable')),
+                ('responseoption', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ensembledatapoints', to='sahel.responseoption')),
+                ('scenario', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ensembledatapoints', to='sahel.scenario')),
+            ],
+        ),
+    ]
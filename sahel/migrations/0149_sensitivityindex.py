@@ -0,0 +1,37 @@
+# Generated by Django 3.2.15 on 2026-10-18 14:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sahel', '0148_ensembledatapoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SensitivityIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('admin0', models.CharField(blank=True, max_length=200, null=True)),
+                ('method', models.CharField(choices=[('Morris', 'Morris'), ('Sobol', 'Sobol')], max_length=20)),
+                ('agg_value', models.CharField(choices=[('MEAN', 'moyen'), ('SUM', 'total'), ('CHANGE', 'change'), ('%CHANGE', '% change')], max_length=200)),
+                ('low', models.FloatField()),
+                ('high', models.FloatField()),
+                ('mu_star', models.FloatField(blank=True, null=True)),
+                ('sigma', models.FloatField(blank=True, null=True)),
+                ('s1', models.FloatField(blank=True, null=True)),
+                ('st', models.FloatField(blank=True, null=True)),
+                ('rank', models.IntegerField()),
+                ('n_runs', models.IntegerField()),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('constant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sensitivityindices_as_constant', to='sahel.variable')),
+                ('element', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sensitivityindices', to='sahel.variable')),
+                ('responseoption', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='sensitivityindices', to='sahel.responseoption')),
+                ('samramodel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sensitivityindices', to='sahel.samramodel')),
+                ('scenario', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='sensitivityindices', to='sahel.scenario')),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.15 on 2026-10-18 15:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sahel', '0149_sensitivityindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimulatedSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('admin0', models.CharField(blank=True, max_length=200, null=True)),
+                ('admin1', models.CharField(blank=True, max_length=200, null=True)),
+                ('admin2', models.CharField(blank=True, max_length=200, null=True)),
+                ('startdate', models.DateField()),
+                ('timestep', models.IntegerField()),
+                ('n_points', models.IntegerField()),
+                ('values', models.BinaryField()),
+                ('element', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='simulatedseries', to='sahel.variable')),
+                ('responseoption', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='simulatedseries', to='sahel.responseoption')),
+                ('scenario', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='simulatedseries', to='sahel.scenario')),
+            ],
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.15 on 2026-10-18 15:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sahel', '0150_simulatedseries'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimulationRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('admin0', models.CharField(max_length=200)),
+                ('admin1', models.CharField(blank=True, max_length=200, null=True)),
+                ('admin2', models.CharField(blank=True, max_length=200, null=True)),
+                ('input_hash', models.CharField(db_index=True, max_length=64)),
+                ('engine', models.CharField(max_length=20)),
+                ('startdate', models.DateField()),
+                ('enddate', models.DateField()),
+                ('timestep', models.IntegerField()),
+                ('status', models.CharField(choices=[('Running', 'En cours'), ('Done', 'Terminé'), ('Failed', 'Échoué')], default='Running', max_length=20)),
+                ('current', models.BooleanField(default=False)),
+                ('n_values', models.IntegerField(default=0)),
+                ('simulate_seconds', models.FloatField(blank=True, null=True)),
+                ('save_seconds', models.FloatField(blank=True, null=True)),
+                ('date_started', models.DateTimeField()),
+                ('date_finished', models.DateTimeField(blank=True, null=True)),
+                ('responseoption', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='simulationruns', to='sahel.responseoption')),
+                ('samramodel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='simulationruns', to='sahel.samramodel')),
+                ('scenario', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='simulationruns', to='sahel.scenario')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='simulateddatapoint',
+            name='run',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='simulateddatapoints', to='sahel.simulationrun'),
+        ),
+        migrations.AddField(
+            model_name='simulatedseries',
+            name='run',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='simulatedseries', to='sahel.simulationrun'),
+        ),
+    ]
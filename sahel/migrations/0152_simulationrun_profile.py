@@ -0,0 +1,18 @@
+# Generated by Django 3.2.15 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sahel', '0151_simulationrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='simulationrun',
+            name='profile',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
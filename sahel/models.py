@@ -430,11 +430,51 @@ class SimulatedDataPoint(models.Model):
     admin0 = models.CharField(max_length=200, null=True, blank=True)
     admin1 = models.CharField(max_length=200, null=True, blank=True)
     admin2 = models.CharField(max_length=200, null=True, blank=True)
+    run = models.ForeignKey("simulationrun", related_name="simulateddatapoints", null=True, blank=True, on_delete=models.CASCADE)
 
     def __str__(self):
         return str(f"Element: {self.element}; Date: {self.date}; Simulated Value: {self.value}")
 
 
+class SimulatedSeries(models.Model):
+    """ Simulated values of an element for a run, as one compressed array on a regular time grid
+    Alternative to one SimulatedDataPoint per date, see sd_model/result_storage.py
+    """
+    element = models.ForeignKey("variable", related_name="simulatedseries", on_delete=models.CASCADE)
+    scenario = models.ForeignKey("scenario", related_name="simulatedseries", null=True, on_delete=models.CASCADE)
+    responseoption = models.ForeignKey("responseoption", related_name="simulatedseries", null=True, on_delete=models.CASCADE)
+    admin0 = models.CharField(max_length=200, null=True, blank=True)
+    admin1 = models.CharField(max_length=200, null=True, blank=True)
+    admin2 = models.CharField(max_length=200, null=True, blank=True)
+    # the values are at startdate, startdate + timestep days, ...
+    startdate = models.DateField()
+    timestep = models.IntegerField()
+    n_points = models.IntegerField()
+    values = models.BinaryField()
+    run = models.ForeignKey("simulationrun", related_name="simulatedseries", null=True, blank=True, on_delete=models.CASCADE)
+
+    def __str__(self):
+        return str(f"Element: {self.element}; Start Date: {self.startdate}; Points: {self.n_points}")
+
+
+class EnsembleDataPoint(models.Model):
+    """ Percentiles of an output over a Monte Carlo ensemble of runs, sampled from forecast intervals """
+    date = models.DateField()
+    element = models.ForeignKey("variable", related_name="ensembledatapoints", on_delete=models.CASCADE)
+    scenario = models.ForeignKey("scenario", related_name="ensembledatapoints", null=True, on_delete=models.CASCADE)
+    responseoption = models.ForeignKey("responseoption", related_name="ensembledatapoints", null=True, on_delete=models.CASCADE)
+    admin0 = models.CharField(max_length=200, null=True, blank=True)
+    admin1 = models.CharField(max_length=200, null=True, blank=True)
+    admin2 = models.CharField(max_length=200, null=True, blank=True)
+    p5 = models.FloatField(null=True)
+    p50 = models.FloatField(null=True)
+    p95 = models.FloatField(null=True)
+    n_samples = models.IntegerField()
+
+    def __str__(self):
+        return f"Element: {self.element}; Date: {self.date}; Median: {self.p50} ({self.p5} - {self.p95})"
+
+
 class ForecastedDataPoint(models.Model):
     date = models.DateField()
     value = models.FloatField()
@@ -537,6 +577,129 @@ class PulseValue(models.Model):
         return f"Element: {self.element}; ResponseOption: {self.responseoption}; Pulse Height: {self.value}"
 
 
+class SimulationJob(models.Model):
+    PENDING = 'Pending'
+    RUNNING = 'Running'
+    DONE = 'Done'
+    FAILED = 'Failed'
+    CANCELLED = 'Cancelled'
+    STATUSES = (
+        (PENDING, "En attente"),
+        (RUNNING, "En cours"),
+        (DONE, "Terminé"),
+        (FAILED, "Échoué"),
+        (CANCELLED, "Annulé"),
+    )
+    ACTIVE_STATUSES = [PENDING, RUNNING]
+    samramodel = models.ForeignKey("samramodel", related_name="simulationjobs", on_delete=models.CASCADE)
+    admin0 = models.CharField(max_length=200)
+    # comma-separated pks, sorted so identical requests compare equal
+    scenario_pks = models.CharField(max_length=500)
+    response_pks = models.CharField(max_length=500)
+    startdate = models.DateField()
+    enddate = models.DateField()
+    engine = models.CharField(max_length=20, default="numpy")
+    status = models.CharField(max_length=20, choices=STATUSES, default=PENDING)
+    cancel_requested = models.BooleanField(default=False)
+    runs_done = models.IntegerField(default=0)
+    runs_total = models.IntegerField(default=0)
+    current_run = models.CharField(max_length=200, null=True, blank=True)
+    message = models.TextField(null=True, blank=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_started = models.DateTimeField(null=True, blank=True)
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"SimulationJob {self.pk}; {self.admin0}; {self.status}; {self.runs_done}/{self.runs_total}"
+
+
+class SimulationRun(models.Model):
+    """ A saved simulation of a scenario, response and admin unit, identified by a hash of all its inputs
+    Results point to the run that saved them, only results of the current run of each combination are read,
+    see sd_model/run_registry.py
+    """
+    RUNNING = 'Running'
+    DONE = 'Done'
+    FAILED = 'Failed'
+    STATUSES = (
+        (RUNNING, "En cours"),
+        (DONE, "Terminé"),
+        (FAILED, "Échoué"),
+    )
+    samramodel = models.ForeignKey("samramodel", related_name="simulationruns", on_delete=models.CASCADE)
+    scenario = models.ForeignKey("scenario", related_name="simulationruns", on_delete=models.CASCADE)
+    responseoption = models.ForeignKey("responseoption", related_name="simulationruns", on_delete=models.CASCADE)
+    admin0 = models.CharField(max_length=200)
+    admin1 = models.CharField(max_length=200, null=True, blank=True)
+    admin2 = models.CharField(max_length=200, null=True, blank=True)
+    # sha256 of the model, inputs, constants, pulses, dates and engine settings
+    input_hash = models.CharField(max_length=64, db_index=True)
+    engine = models.CharField(max_length=20)
+    startdate = models.DateField()
+    enddate = models.DateField()
+    timestep = models.IntegerField()
+    status = models.CharField(max_length=20, choices=STATUSES, default=RUNNING)
+    current = models.BooleanField(default=False)
+    n_values = models.IntegerField(default=0)
+    simulate_seconds = models.FloatField(null=True, blank=True)
+    save_seconds = models.FloatField(null=True, blank=True)
+    # phase timings of the run_model call that saved the run, as JSON, see sd_model/profiling.py
+    profile = models.TextField(null=True, blank=True)
+    date_started = models.DateTimeField()
+    date_finished = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"SimulationRun {self.pk}; {self.admin0}; {self.scenario_id}/{self.responseoption_id}; {self.status}"
+
+
+class StaleResult(models.Model):
+    """ Simulated results that are out of date since a change to their constants, pulses, data or equations """
+    samramodel = models.ForeignKey("samramodel", related_name="staleresults", null=True, on_delete=models.CASCADE)
+    scenario = models.ForeignKey("scenario", related_name="staleresults", on_delete=models.CASCADE)
+    responseoption = models.ForeignKey("responseoption", related_name="staleresults", on_delete=models.CASCADE)
+    admin0 = models.CharField(max_length=200, null=True, blank=True)
+    reason = models.CharField(max_length=500, null=True, blank=True)
+    date_marked = models.DateTimeField()
+
+    def __str__(self):
+        return f"Scenario: {self.scenario_id}; ResponseOption: {self.responseoption_id}; {self.admin0}; {self.reason}"
+
+    class Meta:
+        unique_together = ("scenario", "responseoption", "admin0")
+
+
+class SensitivityIndex(models.Model):
+    """ How much an output depends on a constant, from a Morris or Sobol sensitivity analysis """
+    MORRIS = 'Morris'
+    SOBOL = 'Sobol'
+    METHODS = (
+        (MORRIS, "Morris"),
+        (SOBOL, "Sobol"),
+    )
+    samramodel = models.ForeignKey("samramodel", related_name="sensitivityindices", on_delete=models.CASCADE)
+    element = models.ForeignKey("variable", related_name="sensitivityindices", on_delete=models.CASCADE)
+    constant = models.ForeignKey("variable", related_name="sensitivityindices_as_constant", on_delete=models.CASCADE)
+    scenario = models.ForeignKey("scenario", related_name="sensitivityindices", null=True, on_delete=models.CASCADE)
+    responseoption = models.ForeignKey("responseoption", related_name="sensitivityindices", null=True, on_delete=models.CASCADE)
+    admin0 = models.CharField(max_length=200, null=True, blank=True)
+    method = models.CharField(max_length=20, choices=METHODS)
+    agg_value = models.CharField(max_length=200, choices=Variable.AGG_OPTIONS)
+    low = models.FloatField()
+    high = models.FloatField()
+    # Morris: mean of absolute elementary effects and their standard deviation
+    mu_star = models.FloatField(null=True, blank=True)
+    sigma = models.FloatField(null=True, blank=True)
+    # Sobol: first order and total indices
+    s1 = models.FloatField(null=True, blank=True)
+    st = models.FloatField(null=True, blank=True)
+    rank = models.IntegerField()
+    n_runs = models.IntegerField()
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.method} rank {self.rank}: {self.constant_id} on {self.element_id}"
+
+
 # NOTE: still not used, just using HH values for now
 class GeographicConstantValue(models.Model):
     element = models.ForeignKey(
@@ -0,0 +1,294 @@
+import json
+import math
+import platform
+import random
+import statistics
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from datetime import date, timedelta
+
+import numpy as np
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.utils import timezone
+
+from ..models import SamraModel, Scenario, ResponseOption, Variable, MeasuredDataPoint, HouseholdConstantValue, \
+    ScenarioConstantValue, ResponseConstantValue, PulseValue, SimulatedDataPoint
+from . import model_operations, profiling, result_storage, result_writer
+
+# Synthetic SAMRA models of a given size, and the time each phase of the simulation pipeline takes on them.
+# run_benchmark creates a model (stocks with inflows and outflows, converters reading earlier elements, smoothed
+# converters, inputs with monthly data, pulses, scenarios and responses), runs it from the database up with
+# run_model, reads results back with read_results, times the result writer, and deletes the model again.
+# The report is JSON, compare checks it against a saved baseline.
+
+# a phase is slower than the baseline if it takes this much longer
+TOLERANCE = 0.25
+# phases shorter than this in the baseline are too noisy to compare
+MIN_SECONDS = 0.01
+
+
+@dataclass
+class BenchmarkSize:
+    stocks: int = 5
+    flows: int = 10
+    converters: int = 40
+    inputs: int = 5
+    smooths: int = 5
+    pulses: int = 2
+    scenarios: int = 2
+    responses: int = 3
+
+
+SIZES = {
+    "small": BenchmarkSize(),
+    "medium": BenchmarkSize(stocks=20, flows=40, converters=200, inputs=20, smooths=20, pulses=5, scenarios=3,
+                            responses=5),
+    "large": BenchmarkSize(stocks=50, flows=100, converters=1000, inputs=50, smooths=50, pulses=10, scenarios=5,
+                           responses=10),
+}
+
+
+@dataclass
+class SyntheticModel:
+    samramodel_pk: int
+    scenario_pks: list
+    response_pks: list
+    # read with read_results
+    output_pk: int
+    cost_pk: int
+
+
+@contextmanager
+def use_database(alias: str):
+    """ Run the block on another database, e.g. the local SQLite one, the pipeline only uses the default one
+    connections are per thread, so this only applies to the current thread.
+    """
+    if alias == DEFAULT_DB_ALIAS:
+        yield
+        return
+    default = connections[DEFAULT_DB_ALIAS]
+    connections[DEFAULT_DB_ALIAS] = connections[alias]
+    try:
+        yield
+    finally:
+        connections[DEFAULT_DB_ALIAS] = default
+
+
+def create_model(
+        size: BenchmarkSize,
+        adm0: str = "Mali",
+        startdate: date = date(2022, 7, 1),
+        enddate: date = date(2024, 7, 1),
+        seed: int = 0,
+) -> SyntheticModel:
+    """ Save a random model of the given size, with its data and constants for adm0, the same one for each seed """
+    start = time.time()
+    rng = random.Random(seed)
+    samramodel = SamraModel.objects.create(name=f"benchmark {seed}")
+    scenarios = [
+        Scenario.objects.create(name=f"benchmark scenario {i}", samramodel=samramodel) for i in range(size.scenarios)
+    ]
+    responses = [
+        ResponseOption.objects.create(name=f"benchmark response {i}", samramodel=samramodel)
+        for i in range(size.responses)
+    ]
+
+    def variable(label, sd_type, unit="1", **fields):
+        return Variable.objects.create(samramodel=samramodel, label=label, sd_type=sd_type, unit=unit, **fields)
+
+    household_constant = variable("household constant", Variable.HOUSEHOLD_CONSTANT, constant_default_value=1.0)
+    scenario_constant = variable("scenario constant", Variable.SCENARIO_CONSTANT, constant_default_value=1.0)
+    response_constant = variable("response constant", Variable.RESPONSE_CONSTANT, "LCY / mois")
+    inputs = [variable(f"input {i}", Variable.INPUT, "LCY / kg") for i in range(size.inputs)]
+    pulses = [variable(f"pulse {i}", Variable.RESPONSE_PULSE, "LCY / mois") for i in range(size.pulses)]
+    initial_values = [
+        variable(f"stock {i} initial value", Variable.HOUSEHOLD_CONSTANT, "kg") for i in range(size.stocks)
+    ]
+    stocks = [
+        variable(f"stock {i}", Variable.STOCK, "kg", stock_initial_value=1.0, stock_initial_value_variable=initial_value)
+        for i, initial_value in enumerate(initial_values)
+    ]
+
+    # converters only read elements created before them, so the equations have no cycles except through stocks
+    sources = inputs + stocks + [household_constant, scenario_constant]
+    converters = []
+    for i in range(size.converters):
+        if i < size.smooths:
+            equation = f"smooth(model, _E{rng.choice(sources + converters).pk}_, 30)"
+        else:
+            first, second = rng.sample(sources + converters, 2)
+            equation = f"{rng.uniform(0.1, 0.5):.3f} * _E{first.pk}_ + {rng.uniform(0.1, 0.5):.3f} * _E{second.pk}_"
+        converters.append(variable(f"converter {i}", Variable.VARIABLE, equation=equation))
+
+    for i in range(size.flows):
+        stock = stocks[i % len(stocks)]
+        if i % 2 == 0:
+            driver = rng.choice(converters or sources)
+            variable(f"flow {i}", Variable.FLOW, "kg / jour", equation=f"0.01 * _E{driver.pk}_", sd_sink=stock)
+        else:
+            variable(f"flow {i}", Variable.FLOW, "kg / mois", equation=f"0.02 * _E{stock.pk}_", sd_source=stock)
+
+    cost = variable(
+        "cost", Variable.VARIABLE, "LCY / mois",
+        equation=" + ".join(f"_E{element.pk}_" for element in pulses + [response_constant]),
+    )
+
+    # monthly data around the period, so inputs cover it after resampling
+    dates = []
+    day = startdate - timedelta(days=60)
+    while day <= enddate + timedelta(days=60):
+        dates.append(day)
+        day += timedelta(days=30)
+    MeasuredDataPoint.objects.bulk_create([
+        MeasuredDataPoint(
+            element=element, admin0=adm0, date=day,
+            value=100 + 50 * math.sin(2 * math.pi * day.month / 12 + i),
+        )
+        for i, element in enumerate(inputs) for day in dates
+    ])
+    HouseholdConstantValue.objects.bulk_create(
+        [HouseholdConstantValue(element=household_constant, admin0=adm0, value=2.0)] +
+        [HouseholdConstantValue(element=initial_value, admin0=adm0, value=100.0) for initial_value in initial_values]
+    )
+    ScenarioConstantValue.objects.bulk_create([
+        ScenarioConstantValue(element=scenario_constant, scenario=scenario, value=1.0 + 0.1 * i)
+        for i, scenario in enumerate(scenarios)
+    ])
+    ResponseConstantValue.objects.bulk_create([
+        ResponseConstantValue(element=response_constant, responseoption=response, admin0=adm0, value=100.0 * i)
+        for i, response in enumerate(responses)
+    ])
+    # the first response is the baseline, without pulses
+    PulseValue.objects.bulk_create([
+        PulseValue(
+            element=pulse, responseoption=response, admin0=adm0, value=1000.0 * (j + 1),
+            startdate=startdate + timedelta(days=90 * (i + j + 1)),
+        )
+        for i, response in enumerate(responses[1:]) for j, pulse in enumerate(pulses)
+    ])
+    print(f"creating benchmark model {samramodel.pk} took {time.time() - start} s")
+    return SyntheticModel(
+        samramodel_pk=samramodel.pk, scenario_pks=[scenario.pk for scenario in scenarios],
+        response_pks=[response.pk for response in responses],
+        output_pk=(converters[-1] if converters else stocks[-1]).pk, cost_pk=cost.pk,
+    )
+
+
+def delete_model(model: SyntheticModel):
+    """ Delete a model from create_model, with its data, constants and results """
+    Variable.objects.filter(samramodel_id=model.samramodel_pk).delete()
+    Scenario.objects.filter(pk__in=model.scenario_pks).delete()
+    ResponseOption.objects.filter(pk__in=model.response_pks).delete()
+    SamraModel.objects.filter(pk=model.samramodel_pk).delete()
+
+
+def time_writer(model: SyntheticModel, adm0: str, n_rows: int) -> dict:
+    """ Rows per second of result_writer, writing n_rows results of the output for an admin1 of its own """
+    adm1 = "benchmark writer"
+    startdate = date(2022, 7, 1)
+    rows = (
+        (model.output_pk, float(i), startdate + timedelta(days=i % 1000))
+        for i in range(n_rows)
+    )
+    start = time.time()
+    result_writer.replace_results(rows, model.scenario_pks[0], model.response_pks[0], adm0, adm1)
+    seconds = time.time() - start
+    SimulatedDataPoint.objects.filter(admin0=adm0, admin1=adm1).delete()
+    return {"rows": n_rows, "seconds": seconds, "rows_per_second": n_rows / max(seconds, 1e-9)}
+
+
+def run_benchmark(
+        size: BenchmarkSize,
+        engine: str = "numpy",
+        repeat: int = 3,
+        adm0: str = "Mali",
+        startdate: date = date(2022, 7, 1),
+        enddate: date = date(2024, 7, 1),
+        timestep: int = 2,
+        writer_rows: int = 100000,
+        seed: int = 0,
+        keep: bool = False,
+) -> dict:
+    """ Create a synthetic model, time repeat runs of run_model and read_results on it, and return the report
+    every run starts from the database, without any cache or reused results. Times are medians over the runs,
+    by phase path, e.g. "run_model/init/inputs". keep leaves the model in the database.
+    """
+    model = create_model(size, adm0, startdate, enddate, seed)
+    try:
+        runs = []
+        for _ in range(repeat):
+            with profiling.span("benchmark") as benchmark_span:
+                model_operations.run_model(
+                    model.scenario_pks, model.response_pks, model.samramodel_pk, adm0, startdate=startdate,
+                    enddate=enddate, timestep=timestep, use_cache=False, engine=engine, reuse=False,
+                )
+                with profiling.span("read_results"):
+                    model_operations.read_results(
+                        adm0, model.output_pk, model.scenario_pks, model.response_pks,
+                        cost_element_pk=model.cost_pk, baseline_response_pk=model.response_pks[0],
+                    )
+            runs.append({
+                path: seconds for child in benchmark_span.children
+                for path, seconds in profiling.phase_seconds(child.to_dict()).items()
+            })
+        writer = time_writer(model, adm0, writer_rows)
+    finally:
+        if not keep:
+            delete_model(model)
+
+    paths = sorted({path for run in runs for path in run})
+    return {
+        "size": asdict(size),
+        "engine": engine,
+        "repeat": repeat,
+        "seed": seed,
+        "adm0": adm0,
+        "startdate": startdate.isoformat(),
+        "enddate": enddate.isoformat(),
+        "timestep": timestep,
+        "database": connection.vendor,
+        "storage": result_storage.storage(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "date": timezone.now().isoformat(),
+        "seconds": {path: statistics.median(run.get(path, 0.0) for run in runs) for path in paths},
+        "writer": writer,
+    }
+
+
+def save_report(report: dict, path: str):
+    with open(path, "w") as file:
+        json.dump(report, file, indent=2)
+
+
+def load_report(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare(report: dict, baseline: dict, tolerance: float = TOLERANCE, min_seconds: float = MIN_SECONDS) -> list:
+    """ Print the phases of report against baseline, return those more than tolerance slower
+    as (phase path, baseline seconds, seconds), the writer is compared by rows per second
+    """
+    if report["size"] != baseline["size"] or report["engine"] != baseline["engine"]:
+        print("the baseline is for another size or engine, times can't be compared")
+    regressions = []
+    print(f"{'phase':<45} {'baseline':>10} {'new':>10} {'ratio':>7}")
+    for path, seconds in report["seconds"].items():
+        baseline_seconds = baseline["seconds"].get(path)
+        if baseline_seconds is None:
+            print(f"{path:<45} {'':>10} {seconds:>10.3f}")
+            continue
+        ratio = seconds / baseline_seconds if baseline_seconds > 0 else math.inf
+        slower = baseline_seconds >= min_seconds and ratio > 1 + tolerance
+        print(f"{path:<45} {baseline_seconds:>10.3f} {seconds:>10.3f} {ratio:>7.2f}{' slower' if slower else ''}")
+        if slower:
+            regressions.append((path, baseline_seconds, seconds))
+    rows_per_second = report["writer"]["rows_per_second"]
+    baseline_rows_per_second = baseline["writer"]["rows_per_second"]
+    print(f"{'writer rows/s':<45} {baseline_rows_per_second:>10.0f} {rows_per_second:>10.0f}")
+    if rows_per_second * (1 + tolerance) < baseline_rows_per_second:
+        regressions.append(("writer", report["writer"]["rows"] / baseline_rows_per_second,
+                            report["writer"]["rows"] / rows_per_second))
+    return regressions
@@ -7,6 +7,7 @@ from dash.exceptions import PreventUpdate
 from sahel.models import ResponseOption, SimulatedDataPoint, Variable, ResponseConstantValue, PulseValue
 
 from sahel.sd_model.model_operations import run_model, timer
+from sahel.sd_model.result_storage import read_points, simulated_elements
 
 import plotly.graph_objects as go
 import plotly
@@ -101,7 +102,7 @@ def populate_initial(_):
     response_options = [{"label": response.name, "value": response.pk} for response in ResponseOption.objects.all()]
     response_value = [1, 2]
     element_options = [{"label": element.label, "value": element.pk}
-                       for element in Variable.objects.exclude(simulateddatapoints=None)]
+                       for element in simulated_elements()]
     element1_value = 15
     element2_value = 39
     print(response_value[1])
@@ -292,8 +293,8 @@ def filter_data(response_pks, element1_pk, element2_pk, *_):
     if None in [response_pks, element1_pk, element2_pk]:
         raise PreventUpdate
     element_pks = [element1_pk, element2_pk]
-    df = pd.DataFrame(SimulatedDataPoint.objects.filter(
-        responseoption_id__in=response_pks, element_id__in=element_pks).values())
+    df = read_points(["element_id", "scenario_id", "responseoption_id", "admin0", "date", "value"],
+                     responseoption_id__in=response_pks, element_id__in=element_pks, admin1__isnull=True)
     response_pk2color = {response_pk: color for response_pk, color in zip(response_pks, default_colors)}
     df["color"] = df["responseoption_id"].apply(response_pk2color.get)
     df["secondary_y"] = df["element_id"].apply(lambda pk: True if str(pk) == str(element2_pk) else False)
@@ -1,13 +1,17 @@
 import datetime
 
 from django_plotly_dash import DjangoDash
-from dash import html, dcc, ctx
+from dash import html, dcc, ctx, no_update
 from dash.dependencies import Input, Output, State, MATCH, ALL
 from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 import dash_cytoscape as cyto
 from sahel.models import *
-from sahel.sd_model.model_operations import timer, run_model
+from sahel.sd_model.model_operations import timer
+from sahel.sd_model.job_queue import submit_job, cancel_job, job_progress, progress_text
+from sahel.sd_model.timeseries import load_measured
+from sahel.sd_model.topology import load_topology
+from sahel.sd_model.result_storage import read_points
 import time
 import pandas as pd
 import plotly.graph_objects as go
@@ -73,6 +77,11 @@ app.layout = html.Div(children=[
                 dbc.Button(
                     id=(RUN_SUBMIT := 'run-submit'), children="Exécuter modèle", className="mb-2", size='sm', color='primary',
                 ),
+                dbc.Button(
+                    id=(RUN_CANCEL := 'run-cancel'), children="Annuler", className="mb-2 ms-2", size='sm',
+                    color='secondary', disabled=True,
+                ),
+                html.Small(id=(RUN_PROGRESS := 'run-progress')),
             ]),
             dbc.Tab(label='Mapping', children=[
                 # colors
@@ -210,6 +219,8 @@ app.layout = html.Div(children=[
     # READOUTS
     html.P(id="current-story", hidden=True, children="init"),
     html.P(id=(RUN_READOUT := 'run-readout'), hidden=True),
+    dcc.Store(id=(RUN_JOB := 'run-job')),
+    dcc.Interval(id=(RUN_INTERVAL := 'run-interval'), interval=1000, disabled=True),
     # store contains positions of elements BEFORE being moved around, and is None if not moving elements around
     dcc.Store(id="store"),
 ])
@@ -522,21 +533,37 @@ def add_eb_elements(samramodel_pk):
 
 
 @app.callback(
+    Output(RUN_JOB, 'data'),
+    Output(RUN_INTERVAL, 'disabled'),
+    Output(RUN_CANCEL, 'disabled'),
+    Output(RUN_PROGRESS, 'children'),
     Output(RUN_READOUT, 'children'),
     Input(RUN_SUBMIT, 'n_clicks'),
+    Input(RUN_CANCEL, 'n_clicks'),
+    Input(RUN_INTERVAL, 'n_intervals'),
+    State(RUN_JOB, 'data'),
     State(SAMRAMODEL_INPUT, 'value'),
     State(ADM0_INPUT, 'value'),
     State(SCENARIO_INPUT, 'value'),
     State(RESPONSE_INPUT, 'value'),
+    prevent_initial_call=True,
 )
-def run_model_from_dash(n_clicks, samramodel_pk, adm0, scenario_pk, response_pk):
-    if n_clicks is None:
+def run_model_from_dash(submit_clicks, cancel_clicks, n_intervals, job_pk, samramodel_pk, adm0, scenario_pk,
+                        response_pk):
+    # the simulation is run by the run_job_worker command, this only queues it and polls its progress
+    if ctx.triggered_id == RUN_SUBMIT:
+        startdate = datetime.date(2023, 1, 1)
+        enddate = datetime.date(2025, 1, 1)
+        job_pk = submit_job([scenario_pk], [response_pk], samramodel_pk, adm0, startdate=startdate, enddate=enddate,
+                            engine="bptk")
+        return job_pk, False, False, progress_text(job_pk), no_update
+    if job_pk is None:
         raise PreventUpdate
-    startdate = datetime.date(2023, 1, 1)
-    enddate = datetime.date(2025, 1, 1)
-    run_model([scenario_pk], [response_pk], samramodel_pk, adm0, startdate=startdate, enddate=enddate)
-    return f"ran model for scenario {scenario_pk}, response {response_pk}, model {samramodel_pk}, admin0 {adm0}, " \
-           f"startdate {startdate}, enddate {enddate}"
+    if ctx.triggered_id == RUN_CANCEL:
+        cancel_job(job_pk)
+    if not job_progress(job_pk).get("finished"):
+        return job_pk, False, False, progress_text(job_pk), no_update
+    return None, True, True, progress_text(job_pk), progress_text(job_pk)
 
 
 @app.callback(
@@ -1092,22 +1119,23 @@ def draw_model(
         })
 
     # variable flows
-    stocks = Variable.objects.filter(sd_type="Stock", pk__in=variable_pks).prefetch_related("inflows", "outflows")
-    for stock in stocks:
-        for inflow in stock.inflows.all():
+    stock_flows = load_topology(stock_pks=variable_pks)
+    for stock_pk, inflows in stock_flows.inflows.items():
+        for inflow in inflows:
             has_equation = "no" if inflow.equation is None else "yes"
             cyto_elements.append(
-                {"data": {"source": str(inflow.pk),
-                          "target": str(stock.pk),
+                {"data": {"source": str(inflow.flow_pk),
+                          "target": str(stock_pk),
                           "has_equation": has_equation,
                           "edge_type": "Flow"},
                  "classes": "variable"}
             )
-        for outflow in stock.outflows.all():
+    for stock_pk, outflows in stock_flows.outflows.items():
+        for outflow in outflows:
             has_equation = "no" if outflow.equation is None else "yes"
             cyto_elements.append(
-                {"data": {"source": str(stock.pk),
-                          "target": str(outflow.pk),
+                {"data": {"source": str(stock_pk),
+                          "target": str(outflow.flow_pk),
                           "has_equation": has_equation,
                           "edge_type": "Flow"},
                  "classes": "variable"}
@@ -1514,9 +1542,8 @@ def right_sidebar(selectednodedata, cyto_elements, adm0, scenario_pk, responseop
 
             # simulated DPs
             # TODO: disagg by admin1-2
-            df = pd.DataFrame(SimulatedDataPoint.objects
-                              .filter(element=variable, scenario_id=scenario_pk, responseoption_id=responseoption_pk, admin0=adm0)
-                              .values("date", "value"))
+            df = read_points(["date", "value"], element=variable, scenario_id=scenario_pk,
+                             responseoption_id=responseoption_pk, admin0=adm0, admin1__isnull=True)
             if not df.empty:
                 fig.add_trace(go.Scatter(
                     x=df["date"],
@@ -1526,25 +1553,17 @@ def right_sidebar(selectednodedata, cyto_elements, adm0, scenario_pk, responseop
 
             # measured DPs
             # TODO: disagg by admin2
-            mdps = MeasuredDataPoint.objects.filter(element=variable, admin0=adm0)
-            if admin1 is not None:
-                mdps = mdps.filter(admin1=admin1)
-            df = pd.DataFrame(mdps.values())
-
-            if not df.empty:
-                source_ids = df["source_id"].drop_duplicates()
-                for source_id in source_ids:
-                    try:
-                        source = Source.objects.get(pk=source_id)
-                    except Source.DoesNotExist:
-                        print(f"no source for datapoint in {variable}")
-                        continue
-                    dff = df[df["source_id"] == source_id].groupby("date").mean().reset_index()
-                    fig.add_trace(go.Scatter(
-                        x=dff["date"],
-                        y=dff["value"],
-                        name=source.title,
-                    ))
+            measured = load_measured([variable.pk], adm0, admin1, by=("source_id",))
+            sources = Source.objects.in_bulk([source_id for _, source_id in measured])
+            for (_, source_id), series in measured.items():
+                if source_id not in sources:
+                    print(f"no source for datapoint in {variable}")
+                    continue
+                fig.add_trace(go.Scatter(
+                    x=series.dates,
+                    y=series.values,
+                    name=sources[source_id].title,
+                ))
             unit_append = " / mois" if variable.sd_type == "Pulse Input" else ""
             fig.update_layout(
                 legend=dict(yanchor="bottom", x=0, y=1),
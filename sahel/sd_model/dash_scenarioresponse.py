@@ -2,13 +2,15 @@ import time
 import datetime
 
 from django_plotly_dash import DjangoDash
-from dash import html, dcc
+from dash import html, dcc, ctx, no_update
 from dash.dependencies import Input, Output, State
 import dash_bootstrap_components as dbc
 from dash.exceptions import PreventUpdate
 
 from sahel.models import ResponseOption, SimulatedDataPoint, Variable, Scenario, ADMIN0S, CURRENCY
-from sahel.sd_model.model_operations import run_model, timer, read_results
+from sahel.sd_model.model_operations import timer, read_results
+from sahel.sd_model.result_storage import simulated_elements
+from sahel.sd_model.job_queue import submit_job, cancel_job, job_progress, progress_text
 
 import plotly.graph_objects as go
 from plotly.colors import DEFAULT_PLOTLY_COLORS
@@ -38,6 +40,9 @@ app.layout = dbc.Container(fluid=True, style={"background-color": "#f8f9fc"}, ch
                     dbc.Checklist(id=(RESPONSE_INPUT := "response-input"), className="mb-2",
                                   style={"height": "195px", "overflow-y": "scroll", "font-size": "small"}),
                     dbc.Button("Réexécuter", id="rerun-submit", color="danger", size="sm", disabled=False),
+                    dbc.Button("Annuler", id=(RERUN_CANCEL := "rerun-cancel"), color="secondary", size="sm",
+                               className="ms-2", disabled=True),
+                    html.Small(id=(RERUN_PROGRESS := "rerun-progress")),
                 ])
             ])
         ]),
@@ -67,6 +72,8 @@ app.layout = dbc.Container(fluid=True, style={"background-color": "#f8f9fc"}, ch
         ])
     ]),
     html.Div(id=(RERUN_READOUT := "rerun-readout")),
+    dcc.Store(id=(RERUN_JOB := "rerun-job")),
+    dcc.Interval(id=(RERUN_INTERVAL := "rerun-interval"), interval=1000, disabled=True),
 ])
 
 
@@ -89,7 +96,7 @@ def populate_initial(_):
     included_types = ["Stock", "Flow", "Variable"]
     variable_options = [
         {"label": element.get("label"), "value": element.get("id")}
-        for element in Variable.objects.exclude(simulateddatapoints=None).filter(sd_type__in=included_types).values("id", "label")
+        for element in simulated_elements().filter(sd_type__in=included_types).values("id", "label")
     ]
     variable_value = 77
     agg_options = [{"label": agg[1], "value": agg[0]} for agg in Variable.AGG_OPTIONS]
@@ -121,25 +128,37 @@ def update_default_agg(element_pk):
 
 
 @app.callback(
-    Output("rerun-readout", "children"),
+    Output(RERUN_JOB, "data"),
+    Output(RERUN_INTERVAL, "disabled"),
+    Output(RERUN_CANCEL, "disabled"),
+    Output(RERUN_PROGRESS, "children"),
+    Output(RERUN_READOUT, "children"),
     Input("rerun-submit", "n_clicks"),
+    Input(RERUN_CANCEL, "n_clicks"),
+    Input(RERUN_INTERVAL, "n_intervals"),
+    State(RERUN_JOB, "data"),
     State(ADMIN0_INPUT, "value"),
     State(SCENARIO_INPUT, "value"),
     State(RESPONSE_INPUT, "value"),
+    prevent_initial_call=True,
 )
 @timer
-def rerun_model(n_clicks, adm0, scenario_pks, response_pks):
-    if n_clicks is None:
+def rerun_model(submit_clicks, cancel_clicks, n_intervals, job_pk, adm0, scenario_pks, response_pks):
+    # the simulation is run by the run_job_worker command, this only queues it and polls its progress
+    if ctx.triggered_id == "rerun-submit":
+        startdate = datetime.date(2023, 1, 1)
+        enddate = datetime.date(2025, 1, 1)
+        job_pk = submit_job(scenario_pks, response_pks, DEFAULT_SAMRAMODEL_PK, adm0, startdate=startdate,
+                            enddate=enddate, engine="numpy")
+        return job_pk, False, False, progress_text(job_pk), no_update
+    if job_pk is None:
         raise PreventUpdate
-    start = time.time()
-    n = len(scenario_pks) * len(response_pks)
-    startdate = datetime.date(2023, 1, 1)
-    enddate = datetime.date(2025, 1, 1)
-    run_model(scenario_pks, response_pks, DEFAULT_SAMRAMODEL_PK, adm0, startdate=startdate, enddate=enddate)
-    stop = time.time()
-    duration = stop - start
-    duration_per = duration / n
-    return f"ran scenarios{scenario_pks}; responses {response_pks}; {duration:.2f} total, {duration_per:.2f} per run"
+    if ctx.triggered_id == RERUN_CANCEL:
+        cancel_job(job_pk)
+    if not job_progress(job_pk).get("finished"):
+        return job_pk, False, False, progress_text(job_pk), no_update
+    # changing the readout redraws the graphs with the new results
+    return None, True, True, progress_text(job_pk), progress_text(job_pk)
 
 
 @app.callback(
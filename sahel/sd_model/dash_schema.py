@@ -2,7 +2,7 @@ import re
 
 import pandas as pd
 from django_plotly_dash import DjangoDash
-from dash import html, dcc, ctx
+from dash import html, dcc, ctx, no_update
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State, MATCH, ALL
 from dash.exceptions import PreventUpdate
@@ -10,7 +10,10 @@ import dash_cytoscape as cyto
 from sahel.models import Variable, SimulatedDataPoint, VariableConnection, ElementGroup, \
     MeasuredDataPoint, Source, ResponseOption, ResponseConstantValue, HouseholdConstantValue, Scenario, Element
 import plotly.graph_objects as go
-from sahel.sd_model.model_operations import run_model, timer
+from sahel.sd_model.model_operations import timer
+from sahel.sd_model.job_queue import submit_job, job_progress, progress_text
+from sahel.sd_model.topology import load_topology
+from sahel.sd_model.result_storage import read_points
 import inspect
 from pprint import pprint
 from datetime import date, datetime
@@ -18,6 +21,8 @@ from django.db.models import Max, Min
 import time
 
 admin1s = ["Gao", "Kidal", "Mopti", "Tombouctou", "Ménaka"]
+DEFAULT_SAMRAMODEL_PK = 1
+DEFAULT_ADM0 = "Mali"
 initial_fig = go.Figure(layout=go.Layout(template="simple_white"))
 initial_fig.update_xaxes(title_text="Date")
 initial_startdate = date(2022, 1, 1)
@@ -219,6 +224,8 @@ app.layout = dbc.Container(style={"background-color": "#f8f9fc"}, fluid=True, ch
     html.H6("Debugging:", hidden=True),
     html.P(id="readout", hidden=True),
     html.P(id="model-ran-readout", hidden=True),
+    dcc.Store(id="model-run-job"),
+    dcc.Interval(id="model-run-interval", interval=1000, disabled=True),
     html.P(id="readout3", hidden=True),
     html.P(id="connection-deleted-readout", hidden=True),
     html.P(id="element-created-readout", hidden=True),
@@ -483,20 +490,29 @@ def submit_outflow(_, nodedata, value):
 
 
 @app.callback(
+    Output("model-run-job", "data"),
+    Output("model-run-interval", "disabled"),
     Output("model-ran-readout", "children"),
     Input("run-model", "n_clicks"),
     Input("equation-changed", "children"),
     Input("householdconstantvalue-changed", "children"),
+    Input("model-run-interval", "n_intervals"),
+    State("model-run-job", "data"),
     State("scenario-input", "value"),
     State("responseoption-input", "value"),
     prevent_initial_call=True,
 )
 @timer
-def run_model_from_cyto(n_clicks, eq_readout, cv_readout, scenario_pk, response_pk):
+def run_model_from_cyto(n_clicks, eq_readout, cv_readout, n_intervals, job_pk, scenario_pk, response_pk):
+    # the simulation is run by the run_job_worker command, this only queues it and polls its progress
+    if ctx.triggered_id == "model-run-interval":
+        if job_pk is None or not job_progress(job_pk).get("finished"):
+            raise PreventUpdate
+        return None, True, progress_text(job_pk)
     if "RERUN MODEL" in eq_readout or "RERUN MODEL" in cv_readout:
-        run_model(scenario_pk=scenario_pk, responseoption_pk=response_pk)
-        return f"ran model with scenario_pk {scenario_pk} and response_pk {response_pk}"
-    return "didn't run model"
+        job_pk = submit_job([scenario_pk], [response_pk], DEFAULT_SAMRAMODEL_PK, DEFAULT_ADM0, engine="bptk")
+        return job_pk, False, no_update
+    return no_update, no_update, "didn't run model"
 
 
 @app.callback(
@@ -578,9 +594,8 @@ def element_detail_graph(nodedata, admin1, scenario_pk, responseoption_pk, *_):
 
     element = Variable.objects.get(pk=nodedata.get("id"))
 
-    df = pd.DataFrame(SimulatedDataPoint.objects
-                      .filter(element=element, scenario_id=scenario_pk, responseoption_id=responseoption_pk)
-                      .values("date", "value"))
+    df = read_points(["date", "value"], element=element, scenario_id=scenario_pk, responseoption_id=responseoption_pk,
+                     admin1__isnull=True)
 
     if not df.empty:
         fig.add_trace(go.Scatter(
@@ -871,21 +886,22 @@ def redraw_model(date_ord, *_):
     start = time.time()
 
     flow_edges = []
-    stocks = Variable.objects.filter(sd_type="Stock").prefetch_related("inflows", "outflows")
-    for stock in stocks:
-        for inflow in stock.inflows.all():
+    stock_flows = load_topology()
+    for stock_pk, inflows in stock_flows.inflows.items():
+        for inflow in inflows:
             has_equation = "no" if inflow.equation is None else "yes"
             flow_edges.append(
-                {"data": {"source": inflow.pk,
-                          "target": stock.pk,
+                {"data": {"source": inflow.flow_pk,
+                          "target": stock_pk,
                           "has_equation": has_equation,
                           "edge_type": "Flow"}}
             )
-        for outflow in stock.outflows.all():
+    for stock_pk, outflows in stock_flows.outflows.items():
+        for outflow in outflows:
             has_equation = "no" if outflow.equation is None else "yes"
             flow_edges.append(
-                {"data": {"source": stock.pk,
-                          "target": outflow.pk,
+                {"data": {"source": stock_pk,
+                          "target": outflow.flow_pk,
                           "has_equation": has_equation,
                           "edge_type": "Flow"}}
             )
@@ -0,0 +1,106 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from ..models import EnsembleDataPoint
+from . import model_operations, numpy_engine, profiling
+
+PERCENTILES = [5, 50, 95]
+
+
+def run_ensemble(
+        scenario_pks: list[int],
+        response_pks: list[int],
+        samramodel_pk: int,
+        adm0: str,
+        n_samples: int = 100,
+        household_spread=0.0,
+        seed: int = None,
+        startdate: date = date(2023, 1, 1),
+        enddate: date = date(2025, 1, 1),
+        timestep: int = 2,
+        use_cache: bool = True,
+        output_pks: list[int] = None,
+):
+    """ Run a Monte Carlo ensemble for every combination of scenario and response, and save percentile bands
+    Inputs with forecasts are sampled from their prediction intervals. household_spread is the relative standard
+    deviation of Household Constants, either one value for all or a dict of pk: spread.
+    Every combination uses the same samples, so differences between responses aren't sampling noise.
+    Uses the numpy engine, all samples of a combination are run as one batch.
+    """
+    if adm0 not in model_operations.ADMIN0S:
+        print("invalid admin0")
+        return
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % 2 ** 32)
+    if output_pks is not None:
+        output_pks = sorted({str(pk) for pk in output_pks}, key=int)
+
+    with profiling.span("ensembles", samples=n_samples) as ensembles_span:
+        compiled = model_operations.get_compiled_model(
+            int(samramodel_pk), adm0, None, None, startdate, enddate, timestep, engine="numpy", use_cache=use_cache,
+            output_pks=output_pks,
+        )
+        numpy_model = compiled.model
+        household_pks = [
+            str(element.pk) for element in compiled.definition.elements if element.sd_type == "Household Constant"
+        ]
+        print(f"sampling {len(numpy_model.input_sds)} inputs with forecast intervals and "
+              f"{len(household_pks) if household_spread else 0} household constants, seed {seed}")
+
+        with compiled.lock:
+            model_output_pks = compiled.definition.model_output_pks.copy()
+            runs = model_operations.collect_runs(
+                compiled.definition.elements, [int(pk) for pk in scenario_pks], [int(pk) for pk in response_pks], adm0,
+                numpy_model.t,
+            )
+            ensembles_span.counts["combinations"] = len(runs)
+            for scenario_pk, responseoption_pk, constants, pulses in runs:
+                rng = np.random.default_rng(seed)
+                inputs = numpy_engine.sample_inputs(numpy_model, n_samples, rng)
+                constants = sample_constants(constants, household_pks, household_spread, numpy_model, n_samples, rng)
+                with profiling.span("ensemble", samples=n_samples, outputs=len(model_output_pks)):
+                    results = numpy_engine.integrate(
+                        numpy_model, constants, pulses, model_output_pks, batch_size=n_samples, inputs=inputs
+                    )
+                save_bands(results, numpy_model.t, scenario_pk, responseoption_pk, adm0, n_samples)
+
+
+def sample_constants(constants: dict, household_pks: list, household_spread, numpy_model, n_samples: int, rng):
+    """ Constants of one run, with household constants replaced by arrays of n_samples non-negative samples """
+    constants = constants.copy()
+    for pk in household_pks:
+        spread = household_spread.get(pk, 0.0) if isinstance(household_spread, dict) else household_spread
+        if not spread:
+            continue
+        value = constants.get(pk, numpy_model.constant_defaults.get(pk, 0.0))
+        constants[pk] = np.maximum(value * (1 + spread * rng.standard_normal(n_samples)), 0.0)
+    return constants
+
+
+def save_bands(results: dict, t: np.ndarray, scenario_pk, responseoption_pk, adm0, n_samples: int):
+    """ Replace the EnsembleDataPoints of the outputs in results with their percentiles over the ensemble """
+    dates = [date.fromordinal(int(ordinal)) for ordinal in t]
+    objs = []
+    for pk, values in results.items():
+        p5, p50, p95 = np.percentile(values, PERCENTILES, axis=1)
+        objs += [
+            EnsembleDataPoint(
+                element_id=int(pk), scenario_id=scenario_pk, responseoption_id=responseoption_pk, admin0=adm0,
+                date=dates[k], p5=p5[k], p50=p50[k], p95=p95[k], n_samples=n_samples,
+            )
+            for k in range(len(dates))
+        ]
+    with profiling.span("save bands", rows=len(objs)):
+        EnsembleDataPoint.objects.filter(
+            scenario_id=scenario_pk, responseoption_id=responseoption_pk, admin0=adm0,
+            element_id__in=[int(pk) for pk in results],
+        ).delete()
+        EnsembleDataPoint.objects.bulk_create(objs)
+
+
+def read_bands(adm0, element_pk, scenario_pks, response_pks) -> pd.DataFrame:
+    return pd.DataFrame(EnsembleDataPoint.objects.filter(
+        admin0=adm0, element_id=element_pk, scenario_id__in=scenario_pks, responseoption_id__in=response_pks
+    ).values("date", "scenario_id", "responseoption_id", "p5", "p50", "p95", "n_samples"))
@@ -0,0 +1,320 @@
+import ast
+import re
+from dataclasses import dataclass, field
+
+# Compiles the _E<pk>_ equations of a SAMRA model once, for both simulation engines.
+# Every equation is parsed with ast and checked against a whitelist, so equations can only combine the values of
+# other elements with numbers, operators, sd.* functions, smooth(model, ...) and delay(model, ...).
+# Equations are then ordered so each comes after the elements it references, and turned into a single evaluate
+# function that computes every Variable and Flow in that order.
+# smooth and delay are stocks, so an element that only reaches another through the input of a smooth or delay doesn't
+# need it in the same step: their inputs are passed as functions, which engines call once every equation is computed.
+# Loops through a smooth or delay are allowed, only loops of equations that need each other in the same step are not.
+
+EQUATION_NAME = re.compile(r"_E(\d+)_")
+
+# sd functions that both the BPTK and the numpy engine support
+SD_FUNCTIONS = {
+    "If", "And", "Or", "Not", "max", "min", "abs", "exp", "sqrt", "sin", "cos", "tan", "round", "pi", "nan",
+    "time", "dt", "starttime", "stoptime", "step", "lookup",
+}
+# functions with state that each engine implements itself, called as function(model, ...)
+ENGINE_FUNCTIONS = {"smooth", "delay"}
+ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Attribute, ast.Name, ast.Constant,
+    ast.keyword, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod, ast.FloorDiv, ast.USub, ast.UAdd,
+    ast.Gt, ast.GtE, ast.Lt, ast.LtE, ast.Eq, ast.NotEq,
+)
+
+
+@dataclass
+class CompiledEquations:
+    """ Equations of all Variables and Flows of a model, checked and ordered, with one function to evaluate them
+    function(values, sd, smooth, delay, model, variable, flow) reads the values of the other elements by name from
+    values, and returns the value of every Variable and Flow by name. variable(pk, value) and flow(pk, value) are called
+    on each result, so each engine can turn it into what later equations should see.
+    smooth(model, input, ...) and delay(model, input, ...) get their input as a function of no arguments, which can
+    only be called for a value once the function has returned, see the module comment.
+    Only the source is pickled, the function is rebuilt from it.
+    """
+    # pks of Variables and Flows, in order of evaluation
+    order: list
+    flows: set
+    # pk: equation as it is evaluated, "0.0" if it couldn't be used
+    expressions: dict
+    # pk: pks of all elements the equation references
+    dependencies: dict
+    problems: list
+    source: str
+    function: object = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.function = _make_function(self.source)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["function"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.function = _make_function(self.source)
+
+
+class _EquationChecker(ast.NodeVisitor):
+    def __init__(self):
+        self.refs = set()
+        self.problems = []
+
+    def generic_visit(self, node):
+        if not isinstance(node, ALLOWED_NODES):
+            self.problems.append(f"{type(node).__name__} is not allowed")
+            return
+        super().generic_visit(node)
+
+    def visit_Name(self, node):
+        match = EQUATION_NAME.fullmatch(node.id)
+        if match is None:
+            self.problems.append(f"unknown name {node.id}")
+            return
+        self.refs.add(match.group(1))
+
+    def visit_Attribute(self, node):
+        if not (isinstance(node.value, ast.Name) and node.value.id == "sd"):
+            self.problems.append(f"attribute {ast.unparse(node)} is not allowed")
+        elif node.attr not in SD_FUNCTIONS:
+            self.problems.append(f"sd.{node.attr} is not supported")
+
+    def visit_Constant(self, node):
+        if not isinstance(node.value, (int, float, str)) or isinstance(node.value, bool):
+            self.problems.append(f"constant {node.value!r} is not allowed")
+
+    def visit_Call(self, node):
+        args = node.args
+        if isinstance(node.func, ast.Name) and node.func.id in ENGINE_FUNCTIONS:
+            if not args or not (isinstance(args[0], ast.Name) and args[0].id == "model"):
+                self.problems.append(f"{node.func.id} must be called as {node.func.id}(model, ...)")
+                return
+            args = args[1:]
+        elif isinstance(node.func, ast.Attribute):
+            self.visit_Attribute(node.func)
+        else:
+            self.problems.append(f"call to {ast.unparse(node.func)} is not allowed")
+            return
+        for arg in args:
+            self.visit(arg)
+        for keyword in node.keywords:
+            self.visit(keyword.value)
+
+
+def check_equation(equation: str) -> tuple[ast.Expression, set, list]:
+    """ Parse an equation, return the tree, the pks it references and any problems with it """
+    try:
+        tree = ast.parse(equation.strip(), mode="eval")
+    except SyntaxError as error:
+        return None, set(), [f"invalid syntax ({error.msg})"]
+    checker = _EquationChecker()
+    checker.visit(tree)
+    return tree, checker.refs, checker.problems
+
+
+def _smooth_input(node: ast.Call):
+    """ The input argument of a smooth(model, input, ...) or delay(model, input, ...) call, None if it isn't one """
+    if not (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ENGINE_FUNCTIONS):
+        return None
+    if len(node.args) > 1:
+        return node.args[1]
+    return next((keyword.value for keyword in node.keywords if keyword.arg == "input_var"), None)
+
+
+def _has_initial_value(node: ast.Call) -> bool:
+    return len(node.args) > 3 or any(keyword.arg == "initial_value" for keyword in node.keywords)
+
+
+def _references(node) -> set:
+    return {
+        match.group(1) for child in ast.walk(node) if isinstance(child, ast.Name)
+        for match in [EQUATION_NAME.fullmatch(child.id)] if match is not None
+    }
+
+
+def split_references(tree: ast.Expression) -> tuple[set, set]:
+    """ pks an equation needs in the same step, and pks it only reads through the input of a smooth or delay """
+    same_step = set()
+    lagged = set()
+
+    def visit(node, in_input: bool):
+        if isinstance(node, ast.Name):
+            match = EQUATION_NAME.fullmatch(node.id)
+            if match is not None:
+                (lagged if in_input else same_step).add(match.group(1))
+            return
+        input_node = _smooth_input(node)
+        for child in ast.iter_child_nodes(node):
+            visit(child, in_input or child is input_node)
+
+    visit(tree, False)
+    return same_step, lagged - same_step
+
+
+def _strongly_connected(graph: dict) -> dict:
+    """ Component id of every node of a graph {node: successors}, with Tarjan's algorithm """
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    component = {}
+
+    def connect(node):
+        index[node] = low[node] = len(index)
+        stack.append(node)
+        on_stack.add(node)
+        for successor in graph[node]:
+            if successor not in index:
+                connect(successor)
+                low[node] = min(low[node], low[successor])
+            elif successor in on_stack:
+                low[node] = min(low[node], index[successor])
+        if low[node] == index[node]:
+            while True:
+                member = stack.pop()
+                on_stack.discard(member)
+                component[member] = node
+                if member == node:
+                    break
+
+    for node in graph:
+        if node not in index:
+            connect(node)
+    return component
+
+
+class _SmoothInputs(ast.NodeTransformer):
+    """ Pass the inputs of smooth and delay as functions, and start those in a loop at 0.0 unless they have a value """
+
+    def __init__(self, loop_pks: set):
+        self.loop_pks = loop_pks
+        self.zero_starts = 0
+
+    def visit_Call(self, node):
+        input_node = _smooth_input(node)
+        self.generic_visit(node)
+        if input_node is None:
+            return node
+        wrapped = ast.Lambda(
+            args=ast.arguments(posonlyargs=[], args=[], kwonlyargs=[], kw_defaults=[], defaults=[]), body=input_node,
+        )
+        if len(node.args) > 1:
+            node.args[1] = wrapped
+        else:
+            for keyword in node.keywords:
+                if keyword.arg == "input_var":
+                    keyword.value = wrapped
+        if not _has_initial_value(node) and _references(wrapped.body) & self.loop_pks:
+            # its input isn't known before the first step
+            node.keywords.append(ast.keyword(arg="initial_value", value=ast.Constant(0.0)))
+            self.zero_starts += 1
+        return node
+
+
+def compile_equations(elements) -> CompiledEquations:
+    """ Check, order and compile the equations of the Variables and Flows in elements
+    Equations that are blank, invalid or reference elements that aren't in the model are reported and set to 0.0.
+    Raises ValueError if equations need each other in the same step, in a loop that doesn't go through a smooth or
+    delay.
+    """
+    pks = {str(element.pk) for element in elements}
+    expressions = {}
+    dependencies = {}
+    flows = set()
+    problems = []
+    trees = {}
+    for element in elements:
+        if element.sd_type not in ["Variable", "Flow"]:
+            continue
+        pk = str(element.pk)
+        if element.sd_type == "Flow":
+            flows.add(pk)
+        expressions[pk] = "0.0"
+        dependencies[pk] = set()
+        if element.equation is None or not element.equation.strip():
+            problems.append(f"{element} equation is blank, setting to 0.0")
+            continue
+        tree, refs, equation_problems = check_equation(element.equation)
+        missing = sorted(ref for ref in refs if ref not in pks)
+        if missing:
+            equation_problems.append(f"{missing} are not in the model")
+        if equation_problems:
+            problems.append(f"'{element}' equation could not be defined because {'; '.join(equation_problems)}. "
+                            f"Setting equation to 0.0 instead.")
+            continue
+        trees[pk] = tree
+        dependencies[pk] = refs
+
+    # references through smooth and delay inputs are only ordered when they aren't part of a loop
+    same_step = {}
+    lagged = {}
+    for pk in expressions:
+        same_step[pk], lagged[pk] = split_references(trees[pk]) if pk in trees else (set(), set())
+        same_step[pk] &= expressions.keys()
+        lagged[pk] &= expressions.keys()
+    component = _strongly_connected({pk: same_step[pk] | lagged[pk] for pk in expressions})
+    order = evaluation_order({
+        pk: same_step[pk] | {ref for ref in lagged[pk] if component[ref] != component[pk]} for pk in expressions
+    })
+    for pk, tree in trees.items():
+        loop_pks = {ref for ref in lagged[pk] if component[ref] == component[pk]}
+        transformer = _SmoothInputs(loop_pks)
+        expressions[pk] = ast.unparse(ast.fix_missing_locations(transformer.visit(tree)))
+        if transformer.zero_starts:
+            problems.append(f"equation of {pk} has a smooth or delay in a loop with {sorted(loop_pks, key=int)} "
+                            f"and no initial value, it starts at 0.0")
+    return CompiledEquations(
+        order=order, flows=flows, expressions=expressions, dependencies=dependencies, problems=problems,
+        source=_function_source(order, flows, expressions, dependencies, lagged),
+    )
+
+
+def evaluation_order(dependencies: dict) -> list:
+    """ Order pks so that every pk comes after the pks it depends on, a pk depending on itself is a cycle """
+    order = []
+    ready = [pk for pk, deps in dependencies.items() if not deps]
+    dependents = {pk: [] for pk in dependencies}
+    for pk, deps in dependencies.items():
+        for dep in deps:
+            dependents[dep].append(pk)
+    remaining = {pk: len(deps) for pk, deps in dependencies.items()}
+    while ready:
+        pk = ready.pop()
+        order.append(pk)
+        for dependent in dependents[pk]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+    if len(order) < len(dependencies):
+        cycle = sorted(pk for pk in dependencies if pk not in set(order))
+        raise ValueError(
+            f"equations of {cycle} reference each other in a cycle that doesn't go through a smooth or delay"
+        )
+    return order
+
+
+def _function_source(order: list, flows: set, expressions: dict, dependencies: dict, lagged: dict) -> str:
+    external = sorted(set().union(*dependencies.values()) - expressions.keys(), key=int)
+    lines = ["def evaluate(values, sd, smooth, delay, model, variable, flow):"]
+    lines += [f"    _E{pk}_ = values['_E{pk}_']" for pk in external]
+    # smooth and delay inputs can reference elements computed later, engines that build their equations rather than
+    # compute them (BPTK) have them in values already
+    lines += [f"    _E{pk}_ = values.get('_E{pk}_')" for pk in sorted(set().union(*lagged.values()), key=int)]
+    for pk in order:
+        wrapper = "flow" if pk in flows else "variable"
+        lines.append(f"    _E{pk}_ = {wrapper}('{pk}', {expressions[pk]})")
+    lines.append("    return {" + ", ".join(f"'_E{pk}_': _E{pk}_" for pk in order) + "}")
+    return "\n".join(lines) + "\n"
+
+
+def _make_function(source: str):
+    namespace = {}
+    exec(compile(source, "<samra equations>", "exec"), {"__builtins__": {}}, namespace)
+    return namespace["evaluate"]
@@ -5,6 +5,8 @@ from statsmodels.tsa.api import ExponentialSmoothing
 from statsmodels.tsa.forecasting.theta import ThetaModel
 
 from ..models import Variable, Source, ForecastedDataPoint
+from .stale_results import mark_stale
+from .timeseries import load_measured
 
 # TODO: make this just trigger on data add, or somewhere else by admin
 # TODO: make sure this forecasts up to modeling time (for very old data)
@@ -14,22 +16,24 @@ def forecast_element(element_pk, adm0, sarima_params=None):
     use_model = 'ETS'
     forecast_years = 2
     variable = Variable.objects.get(pk=element_pk)
-    df = pd.DataFrame(variable.measureddatapoints.filter(admin0=adm0).values())
+    source_ids = variable.measureddatapoints.filter(admin0=adm0).values_list("source_id", flat=True)
 
-    if df.empty:
+    if not source_ids.exists():
         print(f"no datapoints for {variable}, cannot forecast")
         return
     print(f"forecasting for {variable} now")
 
     # determine correct periodicity
     # TODO: deal with periodicity for non-seasonal data sources
+    filters = {}
     if variable.source_for_model is not None:
-        df = df[df["source_id"] == variable.source_for_model.pk]
+        filters["source_id"] = variable.source_for_model.pk
         number_of_periods = variable.source_for_model.number_of_periods
-    elif Source.objects.get(pk=df["source_id"].iloc[0]).number_of_periods is not None or len(df["source_id"].unique()) > 1:
-        number_of_periods = Source.objects.get(pk=df["source_id"].iloc[0]).number_of_periods
+    elif Source.objects.get(pk=source_ids.first()).number_of_periods is not None or source_ids.distinct().count() > 1:
+        number_of_periods = Source.objects.get(pk=source_ids.first()).number_of_periods
     else:
         number_of_periods = 12
+    measured = load_measured([element_pk], adm0, by=("admin1",), **filters)
 
     # resample into MS or QS (previously LIKELY on 15th of month etc)
     if number_of_periods == 12:
@@ -41,14 +45,13 @@ def forecast_element(element_pk, adm0, sarima_params=None):
     else:
         period = "MS"
 
-    df.index = pd.to_datetime(df["date"])
     forecast_periods = number_of_periods * forecast_years
 
     objs = []
-    for admin1 in df["admin1"].unique():
+    for (_, admin1), series in measured.items():
+        admin1 = None if pd.isna(admin1) else admin1
         print(f"FORECASTING {admin1} NOW")
-        dff = df[df["admin1"] == admin1]
-        dff = dff.resample(period).mean().interpolate()["value"]
+        dff = series.to_series().resample(period).mean().interpolate()
         message = ''
         if use_model == 'ExpSmo':
             model = ExponentialSmoothing(dff, trend="add", damped_trend=True)
@@ -115,3 +118,4 @@ def forecast_element(element_pk, adm0, sarima_params=None):
 
     ForecastedDataPoint.objects.filter(element=variable, admin0=adm0).delete()
     ForecastedDataPoint.objects.bulk_create(objs)
+    mark_stale(f"forecasts of {variable} updated", samramodel_pk=variable.samramodel_id, adm0=adm0)
@@ -0,0 +1,202 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from datetime import date, timedelta
+
+import numpy as np
+
+from ..models import MeasuredDataPoint, ForecastedDataPoint, SeasonalInputDataPoint
+from . import model_cache, profiling, seasonal, timeseries
+
+# Inputs and Seasonal Inputs read from the database and resampled once onto the simulation time grid.
+# Each series is cached per process by element, admin unit, date range and timestep, so it is reused by every
+# model built for that admin unit (other engines, other outputs, edited equations) until its datapoints change.
+# Pulse Inputs of a response are also turned into arrays on the time grid, so engines only look their values up.
+
+# series are small, but there is one per input, admin unit and date range
+MAX_CACHED_SERIES = 2000
+# a pulse without an enddate lasts this many days either side of its startdate
+PULSE_HALF_WIDTH_DAYS = 15
+
+_series = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+@dataclass
+class InputSeries:
+    """ One Input or Seasonal Input of an admin unit, as lookup points and as values on the time grid """
+    # [[t, value], ...], None if there was no data and the input is a constant value
+    points: list
+    # standard deviation of each point, None unless the input has forecast intervals
+    sds: list
+    # values on the time grid as a read-only contiguous float array, shared by all models using it
+    values: np.ndarray
+    # the constant value used when there is no data
+    value: float = None
+    # True if the admin unit has no data for the input, and this is the admin0 series, see load_inputs
+    admin0_fallback: bool = False
+
+
+def time_grid(startdate: date, enddate: date, timestep: int) -> np.ndarray:
+    """ Times (as date ordinals) the models are simulated and reported at """
+    return np.arange(startdate.toordinal(), enddate.toordinal() + timestep, timestep, dtype=float)
+
+
+def load_inputs(
+        elements: list,
+        adm0: str,
+        adm1: str = None,
+        adm2: str = None,
+        startdate: date = date(2022, 7, 1),
+        enddate: date = date(2024, 7, 1),
+        timestep: int = 2,
+        use_cache: bool = True,
+) -> dict:
+    """ InputSeries of each Input and Seasonal Input in elements, by pk
+    Only the series that aren't cached, or whose datapoints changed since, are read from the database.
+    Inputs an admin1 or admin2 unit has no data for get the series of the whole admin0 instead.
+    """
+    with profiling.span("load inputs") as inputs_span:
+        t = time_grid(startdate, enddate, timestep)
+        mdps, fdps, sdps = _datapoints(adm0, adm1, adm2, startdate, enddate)
+        pks = [element.pk for element in elements]
+        watermarks = model_cache.datapoint_watermarks([mdps, fdps, sdps], pks)
+
+        series = {}
+        keys = {}
+        for element in elements:
+            keys[element.pk] = (
+                element.pk, element.sd_type, element.constant_default_value, adm0, adm1, adm2, startdate, enddate,
+                timestep, watermarks.get(element.pk),
+            )
+            cached = get(keys[element.pk]) if use_cache else None
+            if cached is not None:
+                series[str(element.pk)] = cached
+
+        missing = [element for element in elements if str(element.pk) not in series]
+        if missing:
+            input_pks = [element.pk for element in missing if element.sd_type == "Input"]
+            measured = timeseries.load_measured(input_pks, adm0, adm1, adm2, startdate, enddate)
+            forecasted = timeseries.load_forecasted(input_pks, adm0, adm1, adm2, startdate, enddate)
+            profiles = seasonal.load_profiles(
+                [element.pk for element in missing if element.sd_type == "Seasonal Input"], adm0, adm1, adm2,
+                use_cache=use_cache,
+            )
+            for element in missing:
+                series[str(element.pk)] = _load_series(element, measured, forecasted, profiles, startdate, enddate, t)
+                if use_cache:
+                    put(keys[element.pk], series[str(element.pk)])
+
+        inputs_span.counts.update(loaded=len(missing), reused=len(elements) - len(missing))
+
+    no_data = [element for element in elements if series[str(element.pk)].points is None]
+    if adm1 is not None and no_data:
+        admin0_series = load_inputs(no_data, adm0, None, None, startdate, enddate, timestep, use_cache)
+        for element in no_data:
+            # a copy, the cached admin0 series is shared
+            series[str(element.pk)] = replace(admin0_series[str(element.pk)], admin0_fallback=True)
+        print(f"{adm1}, {adm2} has no data for {[element.pk for element in no_data]}, using {adm0} data")
+    return series
+
+
+def pulse_window(startdate: date, enddate: date = None) -> tuple[float, float]:
+    """ Times (as date ordinals) a pulse is active strictly between
+    With an enddate the pulse covers every day from startdate to enddate, otherwise it is centred on startdate.
+    """
+    if enddate is None:
+        return (
+            float((startdate - timedelta(days=PULSE_HALF_WIDTH_DAYS)).toordinal()),
+            float((startdate + timedelta(days=PULSE_HALF_WIDTH_DAYS)).toordinal()),
+        )
+    return startdate.toordinal() - 0.5, enddate.toordinal() + 0.5
+
+
+def pulse_array(t: np.ndarray, pulse_values: list) -> np.ndarray:
+    """ Values of a Pulse Input on the time grid t, from a list of (start, stop, value), overlapping pulses add up """
+    if not pulse_values:
+        return np.zeros(len(t))
+    starts, stops, values = (np.asarray(column, dtype=float) for column in zip(*pulse_values))
+    active = (t[None, :] > starts[:, None]) & (t[None, :] < stops[:, None])
+    return values @ active
+
+
+def pulse_points(t: np.ndarray, values: np.ndarray) -> list:
+    """ Fewest lookup points [[t, value], ...] that give values at every time of the grid t
+    Only the first and last times, and the times either side of each change, are kept.
+    """
+    changes = np.flatnonzero(np.diff(values))
+    keep = np.unique(np.concatenate([[0, len(t) - 1], changes, changes + 1]))
+    return np.column_stack([t[keep], values[keep]]).tolist()
+
+
+def _datapoints(adm0, adm1, adm2, startdate, enddate) -> tuple:
+    mdps = MeasuredDataPoint.objects.filter(date__gte=startdate, date__lte=enddate, admin0=adm0)
+    fdps = ForecastedDataPoint.objects.filter(date__gte=startdate, date__lte=enddate, admin0=adm0)
+    sdps = SeasonalInputDataPoint.objects.filter(admin0=adm0)
+    if adm1 is not None:
+        mdps, fdps, sdps = mdps.filter(admin1=adm1), fdps.filter(admin1=adm1), sdps.filter(admin1=adm1)
+        if adm2 is not None:
+            mdps, fdps, sdps = mdps.filter(admin2=adm2), fdps.filter(admin2=adm2), sdps.filter(admin2=adm2)
+    return mdps, fdps, sdps
+
+
+def _load_series(element, measured: dict, forecasted: dict, profiles: dict, startdate, enddate, t) -> InputSeries:
+    pk = element.pk
+    if element.sd_type == "Input":
+        # measured points, then forecasted points
+        parts = [series for series in [measured.get(pk), forecasted.get(pk)] if series is not None]
+        if not parts:
+            default_value = element.constant_default_value
+            if default_value is None:
+                default_value = 0.0
+            print(f"couldn't find timeseries data for {element}, setting eq to {default_value}")
+            return _constant_series(default_value, t)
+        ts = np.concatenate([series.ordinals for series in parts]).astype(float)
+        values = np.concatenate([series.values for series in parts])
+        sds = np.concatenate([
+            # bounds are a 95% prediction interval
+            np.nan_to_num((series.upper_bounds - series.lower_bounds) / (2 * 1.96))
+            if series.upper_bounds is not None else np.zeros(len(series.values))
+            for series in parts
+        ])
+        sds = sds.tolist() if (sds > 0).any() else None
+    else:
+        if pk not in profiles:
+            print(f"couldn't find seasonal values for {element}, setting eq to 1.0")
+            return _constant_series(1.0, t)
+        ts, values = seasonal.tile_profile(profiles[pk], startdate, enddate)
+        sds = None
+
+    order = np.argsort(ts, kind="stable")
+    grid_values = np.ascontiguousarray(np.interp(t, ts[order], values[order]))
+    grid_values.flags.writeable = False
+    return InputSeries(points=np.column_stack([ts, values]).tolist(), sds=sds, values=grid_values)
+
+
+def _constant_series(value: float, t: np.ndarray) -> InputSeries:
+    values = np.full(len(t), value, dtype=float)
+    values.flags.writeable = False
+    return InputSeries(points=None, sds=None, values=values, value=value)
+
+
+def get(key):
+    with _cache_lock:
+        series = _series.get(key)
+        if series is not None:
+            _series.move_to_end(key)
+        return series
+
+
+def put(key, series: InputSeries):
+    with _cache_lock:
+        # drop older versions of the same series, they can never be hit again
+        for old_key in [old_key for old_key in _series if old_key[:-1] == key[:-1]]:
+            del _series[old_key]
+        _series[key] = series
+        while len(_series) > MAX_CACHED_SERIES:
+            _series.popitem(last=False)
+
+
+def clear():
+    with _cache_lock:
+        _series.clear()
@@ -0,0 +1,134 @@
+import time
+import traceback
+from datetime import date
+
+from django.db import transaction
+from django.utils import timezone
+
+from ..models import SimulationJob
+from . import model_operations
+
+
+def _pks_to_str(pks) -> str:
+    return ",".join(str(pk) for pk in sorted({int(pk) for pk in pks}))
+
+
+def _str_to_pks(pks: str) -> list[int]:
+    return [int(pk) for pk in pks.split(",") if pk]
+
+
+def submit_job(
+        scenario_pks: list[int],
+        response_pks: list[int],
+        samramodel_pk: int,
+        adm0: str,
+        startdate: date = date(2023, 1, 1),
+        enddate: date = date(2025, 1, 1),
+        engine: str = "numpy",
+) -> int:
+    """ Queue a run_model request and return its job pk straight away
+    an identical job that is still pending is reused instead of queueing the same runs twice
+    """
+    fields = dict(
+        samramodel_id=int(samramodel_pk), admin0=adm0,
+        scenario_pks=_pks_to_str(scenario_pks), response_pks=_pks_to_str(response_pks),
+        startdate=startdate, enddate=enddate, engine=engine,
+    )
+    with transaction.atomic():
+        job = SimulationJob.objects.filter(status=SimulationJob.PENDING, cancel_requested=False, **fields).first()
+        if job is not None:
+            print(f"reusing pending {job}")
+            return job.pk
+        job = SimulationJob.objects.create(
+            runs_total=len(_str_to_pks(fields["scenario_pks"])) * len(_str_to_pks(fields["response_pks"])),
+            **fields,
+        )
+    print(f"queued {job}")
+    return job.pk
+
+
+def cancel_job(job_pk: int):
+    """ Cancel a pending job outright, or ask a running job to stop after its current run """
+    SimulationJob.objects.filter(pk=job_pk, status=SimulationJob.PENDING).update(
+        status=SimulationJob.CANCELLED, cancel_requested=True, date_finished=timezone.now()
+    )
+    SimulationJob.objects.filter(pk=job_pk, status=SimulationJob.RUNNING).update(cancel_requested=True)
+
+
+def job_progress(job_pk: int) -> dict:
+    job = SimulationJob.objects.filter(pk=job_pk).values(
+        "status", "runs_done", "runs_total", "current_run", "message", "cancel_requested"
+    ).first()
+    if job is None:
+        return {"status": None, "runs_done": 0, "runs_total": 0, "current_run": None, "message": "job not found",
+                "cancel_requested": False, "finished": True}
+    job["finished"] = job["status"] not in SimulationJob.ACTIVE_STATUSES
+    return job
+
+
+def progress_text(job_pk: int) -> str:
+    """ One-line readout of a job's progress for the Dash pages """
+    job = job_progress(job_pk)
+    text = f"simulation {job_pk}: {job['status']}, {job['runs_done']}/{job['runs_total']} runs"
+    if job["current_run"]:
+        text += f", last {job['current_run']}"
+    if job["message"]:
+        text += f" ({job['message']})"
+    return text
+
+
+def claim_next_job():
+    """ Mark the oldest pending job as running and return it, None if there are none
+    the status filter in the update makes sure two workers can't claim the same job
+    """
+    for job in SimulationJob.objects.filter(status=SimulationJob.PENDING).order_by("date_created", "pk"):
+        claimed = SimulationJob.objects.filter(pk=job.pk, status=SimulationJob.PENDING).update(
+            status=SimulationJob.RUNNING, date_started=timezone.now()
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def run_job(job: SimulationJob):
+    start = time.time()
+
+    def report_progress(scenario_pk, response_pk, runs_done, runs_total):
+        SimulationJob.objects.filter(pk=job.pk).update(
+            runs_done=runs_done, runs_total=runs_total, current_run=f"scenario {scenario_pk}, response {response_pk}"
+        )
+        return not SimulationJob.objects.filter(pk=job.pk, cancel_requested=True).exists()
+
+    try:
+        model_operations.run_model(
+            _str_to_pks(job.scenario_pks), _str_to_pks(job.response_pks), job.samramodel_id, job.admin0,
+            startdate=job.startdate, enddate=job.enddate, engine=job.engine, progress_callback=report_progress,
+        )
+    except Exception:
+        traceback.print_exc()
+        SimulationJob.objects.filter(pk=job.pk).update(
+            status=SimulationJob.FAILED, message=traceback.format_exc(limit=1), date_finished=timezone.now()
+        )
+        return
+
+    job.refresh_from_db()
+    cancelled = job.cancel_requested and job.runs_done < job.runs_total
+    status = SimulationJob.CANCELLED if cancelled else SimulationJob.DONE
+    SimulationJob.objects.filter(pk=job.pk).update(
+        status=status, message=f"took {time.time() - start:.2f} s", date_finished=timezone.now()
+    )
+    print(f"finished {job.pk} with status {status} in {time.time() - start} s")
+
+
+def work(poll_interval: float = 2.0, once: bool = False):
+    """ Run queued jobs one after the other, waiting poll_interval seconds when the queue is empty """
+    while True:
+        job = claim_next_job()
+        if job is None:
+            if once:
+                return
+            time.sleep(poll_interval)
+            continue
+        print(f"running {job}")
+        run_job(job)
@@ -0,0 +1,92 @@
+import hashlib
+import os
+import pickle
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+
+from . import profiling
+
+# Compiled models saved to disk, so a new process (a web worker, a management command, a pool worker) loads the
+# model definition and its compiled equations from a file instead of reading them from the database.
+# Files are named by the model_cache key, which ends with the content hash of the definition and its input
+# datapoints, so a changed model is never loaded, and older versions of the same model are deleted when a new one is
+# saved. Edits to a model's variables or datapoints also delete its files, see signals.py.
+# The engine model itself isn't saved (a BPTK model holds lambdas), it is rebuilt from the definition, without the
+# database.
+
+# bump when ModelDefinition or CompiledEquations change, so files saved by older code aren't loaded
+FORMAT_VERSION = 2
+
+
+def artifact_dir():
+    """ Directory compiled models are saved to, None if they aren't saved """
+    directory = getattr(settings, "MODEL_ARTIFACT_DIR", "")
+    return Path(directory) if directory else None
+
+
+def _prefix(key: tuple) -> str:
+    # everything but the definition hash, shared by all versions of a model
+    return hashlib.sha1(repr(key[:-1]).encode()).hexdigest()[:16]
+
+
+def _path(directory: Path, key: tuple) -> Path:
+    # starts with the samramodel pk, so the files of a model can be deleted
+    return directory / f"{key[0]}-{_prefix(key)}-{key[-1]}.pkl"
+
+
+def load(key: tuple):
+    """ (definition, compiled equations) saved for a model_cache key, None if there is no usable file """
+    directory = artifact_dir()
+    if directory is None:
+        return None
+    path = _path(directory, key)
+    if not path.exists():
+        return None
+    with profiling.span("load compiled model", bytes=path.stat().st_size) as load_span:
+        try:
+            with open(path, "rb") as file:
+                artifact = pickle.load(file)
+        except Exception as error:
+            print(f"couldn't load compiled model {path}: {error}")
+            return None
+        if artifact.get("format") != FORMAT_VERSION or artifact.get("key") != key:
+            return None
+        load_span.counts["elements"] = len(artifact["definition"].elements)
+    return artifact["definition"], artifact["compiled_equations"]
+
+
+def save(key: tuple, definition, compiled_equations):
+    """ Save a model's definition and compiled equations for a model_cache key, replacing older versions """
+    directory = artifact_dir()
+    if directory is None:
+        return
+    path = _path(directory, key)
+    artifact = {
+        "format": FORMAT_VERSION, "key": key, "definition": definition, "compiled_equations": compiled_equations,
+    }
+    with profiling.span("save compiled model", elements=len(definition.elements)) as save_span:
+        try:
+            directory.mkdir(parents=True, exist_ok=True)
+            # written to a temporary file first, so other processes never load a partial file
+            descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(descriptor, "wb") as file:
+                pickle.dump(artifact, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, path)
+            for old_path in directory.glob(f"{key[0]}-{_prefix(key)}-*.pkl"):
+                if old_path != path:
+                    old_path.unlink(missing_ok=True)
+        except (OSError, pickle.PicklingError) as error:
+            print(f"couldn't save compiled model {path}: {error}")
+            return
+        save_span.counts["bytes"] = path.stat().st_size
+
+
+def clear(samramodel_pk: int = None):
+    """ Delete the saved compiled models of a samramodel, or all of them """
+    directory = artifact_dir()
+    if directory is None or not directory.exists():
+        return
+    for path in directory.glob("*.pkl" if samramodel_pk is None else f"{samramodel_pk}-*.pkl"):
+        path.unlink(missing_ok=True)
@@ -0,0 +1,124 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import date
+from django.db.models import Count, ExpressionWrapper, F, FloatField, Max, Sum
+from django.db.models.functions import ExtractDay, ExtractMonth, ExtractYear
+from ..models import Variable, MeasuredDataPoint, ForecastedDataPoint, SeasonalInputDataPoint
+
+# compiled models are kept in memory per process, so keep only the most recently used few
+MAX_CACHED_MODELS = 8
+
+# fields of Variable that change the compiled model when edited
+DEFINITION_FIELDS = (
+    "pk", "sd_type", "equation", "unit", "constant_default_value", "model_output_variable",
+    "stock_initial_value", "stock_initial_value_variable_id", "sd_source_id", "sd_sink_id",
+)
+
+# fields of the datapoint tables that end up in models, editing any of them in place changes the watermark
+CONTENT_FIELDS = {
+    MeasuredDataPoint: ("value",),
+    ForecastedDataPoint: ("value", "upper_bound", "lower_bound"),
+    SeasonalInputDataPoint: ("value",),
+}
+# significant digits of the sums in a watermark, so the order the database adds rows in doesn't change it
+WATERMARK_DIGITS = 12
+
+_compiled_models = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _day(field: str):
+    # a number that increases with the date, for weighting values by their date
+    return ExtractYear(field) * 372 + ExtractMonth(field) * 31 + ExtractDay(field)
+
+
+def _aggregates(model) -> dict:
+    aggregates = {"count": Count("id"), "max_pk": Max("id"), "days": Sum(_day("date"))}
+    for name in CONTENT_FIELDS[model]:
+        aggregates[f"{name}_sum"] = Sum(name)
+        # weighted by date, so moving a value to another date changes it too
+        aggregates[f"{name}_by_day"] = Sum(ExpressionWrapper(F(name) * _day("date"), output_field=FloatField()))
+    return aggregates
+
+
+def datapoint_watermarks(querysets: list, pks: list = None) -> dict:
+    """ Watermark of the datapoints of each element, in one query per datapoint table
+    Made of the count and max pk, and sums of the values and dates, so it changes when datapoints are added,
+    deleted or edited in place. Only the elements in pks if given.
+    """
+    watermarks = {}
+    for dps in querysets:
+        if pks is not None:
+            dps = dps.filter(element_id__in=pks)
+        aggregates = _aggregates(dps.model)
+        rows = dps.order_by().values("element_id").annotate(**aggregates).values_list("element_id", *aggregates)
+        for element_id, *values in rows:
+            values = [float(f"{value:.{WATERMARK_DIGITS}g}") if isinstance(value, float) else value for value in values]
+            watermarks[element_id] = watermarks.get(element_id, ()) + (dps.model.__name__, *values)
+    return watermarks
+
+
+def model_definition_hash(
+        samramodel_pk: int,
+        adm0: str,
+        adm1: str = None,
+        adm2: str = None,
+        startdate: date = None,
+        enddate: date = None,
+) -> str:
+    """ Content hash of everything that goes into building a model
+    Covers the Variable rows of the samramodel, plus a watermark of the content of the input datapoints, see
+    datapoint_watermarks, since those are baked into the model as lookups.
+    """
+    digest = hashlib.sha1()
+    rows = Variable.objects.filter(samramodel_id=samramodel_pk).order_by("pk").values_list(*DEFINITION_FIELDS)
+    digest.update(repr(list(rows)).encode())
+
+    mdps = MeasuredDataPoint.objects.filter(admin0=adm0)
+    fdps = ForecastedDataPoint.objects.filter(admin0=adm0)
+    sdps = SeasonalInputDataPoint.objects.filter(admin0=adm0)
+    if startdate is not None and enddate is not None:
+        mdps = mdps.filter(date__gte=startdate, date__lte=enddate)
+        fdps = fdps.filter(date__gte=startdate, date__lte=enddate)
+    digest.update(repr(sorted(datapoint_watermarks([mdps, fdps, sdps]).items())).encode())
+    # admin units use the admin0 series of inputs they have no data for, so the admin0 data is hashed for them too
+    if adm1 is not None:
+        mdps, fdps, sdps = mdps.filter(admin1=adm1), fdps.filter(admin1=adm1), sdps.filter(admin1=adm1)
+        if adm2 is not None:
+            mdps, fdps, sdps = mdps.filter(admin2=adm2), fdps.filter(admin2=adm2), sdps.filter(admin2=adm2)
+        digest.update(repr(sorted(datapoint_watermarks([mdps, fdps, sdps]).items())).encode())
+
+    return digest.hexdigest()
+
+
+def make_key(samramodel_pk, adm0, adm1, adm2, startdate, enddate, timestep, engine="bptk", output_pks=None) -> tuple:
+    """ Cache key, the definition hash must stay last so older versions of the same model can be found """
+    return (
+        samramodel_pk, adm0, adm1, adm2, startdate, enddate, timestep, engine,
+        tuple(sorted(str(pk) for pk in output_pks)) if output_pks is not None else None,
+        model_definition_hash(samramodel_pk, adm0, adm1, adm2, startdate, enddate),
+    )
+
+
+def get(key):
+    with _cache_lock:
+        compiled = _compiled_models.get(key)
+        if compiled is not None:
+            _compiled_models.move_to_end(key)
+        return compiled
+
+
+def put(key, compiled):
+    with _cache_lock:
+        # drop any older version of the same model and admin unit, it can never be hit again
+        for old_key in [old_key for old_key in _compiled_models if old_key[:-1] == key[:-1]]:
+            del _compiled_models[old_key]
+        _compiled_models[key] = compiled
+        while len(_compiled_models) > MAX_CACHED_MODELS:
+            _compiled_models.popitem(last=False)
+
+
+def clear():
+    with _cache_lock:
+        _compiled_models.clear()
@@ -1,16 +1,58 @@
 import pandas as pd
 from BPTK_Py import Model, bptk
 from BPTK_Py import sd_functions as sd
-from ..models import Variable, SimulatedDataPoint, MeasuredDataPoint, ResponseConstantValue, ResponseOption, \
-    SeasonalInputDataPoint, ForecastedDataPoint, HouseholdConstantValue, ScenarioConstantValue, PulseValue, ADMIN0S
-from datetime import datetime, date
-import time, functools, warnings
+from BPTK_Py.sddsl.constant import Constant
+from BPTK_Py.sddsl.converter import Converter
+from ..models import Variable, ResponseConstantValue, ResponseOption, HouseholdConstantValue, \
+    ScenarioConstantValue, PulseValue, ADMIN0S
+from datetime import date
+import time, functools, warnings, threading
+from dataclasses import dataclass, field
 from django.db.models import Q
-from django.db import connection
-from contextlib import closing
-from samra.settings import DATABASES
+from django.utils import timezone
+from . import equations, input_arrays, model_artifacts, model_cache, numpy_engine, parallel, profiling, pruning, \
+    result_storage, result_writer, run_registry, stale_results, topology
 
 DAYS_IN_MONTH = 30.437
+ENGINES = ["bptk", "numpy"]
+
+
+@dataclass
+class ModelDefinition:
+    """ Everything needed to simulate a SAMRA model for an admin unit, read from the database once """
+    samramodel_pk: int
+    startdate: date
+    enddate: date
+    timestep: int
+    elements: list
+    model_output_pks: list[str]
+    # stock pk: {"initial_value_pk": pk or None, "inflows": [(flow pk, factor)], "outflows": [(flow pk, factor)]}
+    stocks: dict = field(default_factory=dict)
+    # input pk: [[t, value], ...], for inputs and seasonal inputs with data
+    input_points: dict = field(default_factory=dict)
+    # input pk: value, for inputs and seasonal inputs without data
+    input_values: dict = field(default_factory=dict)
+    # input pk: [standard deviation, ...] of each of its input_points, only for inputs with forecast intervals
+    input_sds: dict = field(default_factory=dict)
+    # input pk: values on the time grid, for all inputs and seasonal inputs
+    input_arrays: dict = field(default_factory=dict)
+
+    @property
+    def t(self):
+        """ Times (as date ordinals) the model is simulated and reported at """
+        return input_arrays.time_grid(self.startdate, self.enddate, self.timestep)
+
+
+@dataclass
+class CompiledModel:
+    """ Model with all elements, equations and inputs set, ready to be run for any scenario and response
+    model is a BPTK Model for engine "bptk", and a numpy_engine.NumpyModel for engine "numpy"
+    """
+    definition: ModelDefinition
+    model: object
+    engine: str = "bptk"
+    compiled_equations: equations.CompiledEquations = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
 
 
 def run_model(
@@ -23,205 +65,226 @@ def run_model(
         startdate: date = date(2022, 7, 1),
         enddate: date = date(2024, 7, 1),
         timestep: int = 2,
+        use_cache: bool = True,
+        engine: str = "bptk",
+        batch: bool = True,
+        workers: int = 1,
+        progress_callback=None,
+        output_pks: list[int] = None,
+        integrator: str = "euler",
+        step_size: float = None,
+        reuse: bool = True,
+        profile: bool = False,
 ):
+    """ Run and save every combination of scenario and response
+    output_pks limits the run to what is needed to simulate those elements, and only their results are replaced,
+    by default all model_output_variables are run and saved
+    integrator and step_size select how the numpy engine steps, see numpy_engine.integrate, results are always
+    reported every timestep
+    progress_callback(scenario_pk, response_pk, runs_done, runs_total) is called after each run is saved,
+    returning False from it stops the remaining runs
+    with reuse, combinations whose saved results come from the same inputs aren't run again, see run_registry.py
+    the time taken by each phase is printed and logged, profile also captures cProfile and tracemalloc statistics,
+    see profiling.py
+    """
     if adm0 not in ADMIN0S:
         print("invalid admin0")
         return
+    if engine not in ENGINES:
+        print(f"invalid engine, must be one of {ENGINES}")
+        return
+    if integrator not in numpy_engine.INTEGRATORS or (integrator != "euler" and engine != "numpy"):
+        print(f"invalid integrator, must be one of {numpy_engine.INTEGRATORS}, only the numpy engine supports "
+              f"integrators other than euler")
+        return
 
-    start = time.time()
+    # results are only fresh for changes made before the run started
+    run_started = timezone.now()
 
     scenario_pks = [int(pk) for pk in scenario_pks]
     response_pks = [int(pk) for pk in response_pks]
     samramodel_pk = int(samramodel_pk)
+    if output_pks is not None:
+        output_pks = sorted({str(pk) for pk in output_pks}, key=int)
+
+    if workers > 1 and not (engine == "numpy" and batch):
+        # combinations can't be batched together, so spread them over processes instead
+        jobs = parallel.make_jobs(
+            scenario_pks, response_pks, [samramodel_pk], [adm0], adm1=adm1, adm2=adm2, startdate=startdate,
+            enddate=enddate, timestep=timestep, use_cache=use_cache, engine=engine, batch=batch, output_pks=output_pks,
+            integrator=integrator, step_size=step_size, reuse=reuse,
+        )
+        parallel.run_jobs(jobs, workers=workers)
+        return None
+
+    saved_run_pks = []
+    with profiling.profile(
+            "run_model", capture=profile, model=samramodel_pk, adm0=adm0, engine=engine, runs=0
+    ) as run_span:
+        compiled = get_compiled_model(
+            samramodel_pk, adm0, adm1, adm2, startdate, enddate, timestep, engine=engine, use_cache=use_cache,
+            output_pks=output_pks,
+        )
+
+        # the cached BPTK model is mutated below (pulses), so only one run can use it at a time
+        with compiled.lock:
+            model_output_pks = compiled.definition.model_output_pks.copy()
+            with profiling.span("constants") as constants_span:
+                runs = collect_runs(
+                    compiled.definition.elements, scenario_pks, response_pks, adm0, compiled.definition.t
+                )
+                hashes = run_registry.run_hashes(
+                    run_registry.model_digest(compiled, adm0, adm1, adm2, integrator, step_size), runs,
+                    {str(element.pk) for element in compiled.definition.elements},
+                )
+                reused = run_registry.reusable_runs(samramodel_pk, runs, hashes, adm0, adm1, adm2) if reuse else set()
+                constants_span.counts.update(runs=len(runs), reused=len(reused))
+            for runs_done, i in enumerate(sorted(reused), start=1):
+                scenario_pk, responseoption_pk, _, _ = runs[i]
+                if adm1 is None:
+                    stale_results.clear_stale([scenario_pk], [responseoption_pk], adm0, run_started)
+                if progress_callback is not None:
+                    progress_callback(scenario_pk, responseoption_pk, runs_done, len(runs))
+            if reused:
+                print(f"{len(reused)} of {len(runs)} runs are up to date")
+            pending = [i for i in range(len(runs)) if i not in reused]
+            run_span.counts["runs"] = len(pending)
+            if not pending:
+                return None
+
+            simulation_runs = {
+                i: run_registry.start_run(
+                    samramodel_pk, runs[i][0], runs[i][1], adm0, adm1, adm2, hashes[i], engine, startdate, enddate,
+                    timestep,
+                )
+                for i in pending
+            }
+            try:
+                dfs = None
+                if compiled.engine == "numpy" and batch:
+                    with profiling.span("simulate", runs=len(pending)) as simulate_span:
+                        dfs = simulate_runs(
+                            compiled, [runs[i] for i in pending], model_output_pks, batch=batch,
+                            integrator=integrator, step_size=step_size,
+                        )
+                    # the batch is timed as a whole, each run gets an equal share
+                    simulate_seconds = simulate_span.seconds / len(pending)
+
+                for runs_done, (k, i) in enumerate(enumerate(pending), start=len(reused) + 1):
+                    scenario_pk, responseoption_pk, _, _ = runs[i]
+                    if dfs is not None:
+                        df = dfs[k]
+                    else:
+                        # simulated one at a time so progress is reported, and cancellation checked, after every run
+                        with profiling.span("simulate", runs=1) as simulate_span:
+                            df = simulate_runs(
+                                compiled, [runs[i]], model_output_pks, batch=batch, integrator=integrator,
+                                step_size=step_size,
+                            )[0]
+                        simulate_seconds = simulate_span.seconds
+                    save_start = time.time()
+                    with profiling.span("save"):
+                        n_values = save_results(
+                            df, scenario_pk, responseoption_pk, adm0, model_output_pks,
+                            replace_all=output_pks is None, adm1=adm1, adm2=adm2, run=simulation_runs[i],
+                        )
+                        run = simulation_runs.pop(i)
+                        run_registry.finish_run(
+                            run, n_values, simulate_seconds, time.time() - save_start,
+                            element_pks=None if output_pks is None else model_output_pks,
+                        )
+                        saved_run_pks.append(run.pk)
+                    if adm1 is None:
+                        stale_results.clear_stale([scenario_pk], [responseoption_pk], adm0, run_started)
+                    if progress_callback is not None:
+                        if progress_callback(scenario_pk, responseoption_pk, runs_done, len(runs)) is False:
+                            print(f"run cancelled after {runs_done} of {len(runs)} runs")
+                            break
+            finally:
+                # runs that weren't saved, because of an error or a cancellation
+                run_registry.fail_runs(list(simulation_runs.values()))
+
+    run_registry.set_profile(saved_run_pks, profiling.to_json(run_span))
+    return None
 
-    model = Model(starttime=startdate.toordinal(), stoptime=enddate.toordinal(), dt=timestep)
-    zero_flow = model.flow("Zero Flow")
-    zero_flow.equation = 0.0
-
-    elements = Variable.objects.filter(samramodel_id=samramodel_pk).filter(
-        Q(sd_type="Variable", equation__isnull=False) |
-        Q(sd_type="Flow", equation__isnull=False) |
-        Q(sd_type="Stock", stock_initial_value__isnull=False) |
-        Q(sd_type="Input") |
-        Q(sd_type="Seasonal Input") |
-        Q(sd_type="Scenario Constant") |
-        Q(sd_type="Constant") |
-        Q(sd_type="Pulse Input") |
-        Q(sd_type="Household Constant")
-    )
-
-    model_output_pks = [str(element.pk) for element in elements]
-    stop = time.time()
-    print(f"init took {stop - start} s")
-    start = time.time()
 
-    model_output_pks = []
-    for element in elements:
-        if element.sd_type in ["Variable", "Stock", "Flow"] and element.model_output_variable:
-            model_output_pks.append(str(element.pk))
+def get_compiled_model(
+        samramodel_pk: int,
+        adm0: str,
+        adm1: str = None,
+        adm2: str = None,
+        startdate: date = date(2022, 7, 1),
+        enddate: date = date(2024, 7, 1),
+        timestep: int = 2,
+        engine: str = "bptk",
+        use_cache: bool = True,
+        output_pks: list[str] = None,
+) -> CompiledModel:
+    with profiling.span("init") as init_span:
+        compiled = None
+        if use_cache:
+            cache_key = model_cache.make_key(
+                samramodel_pk, adm0, adm1, adm2, startdate, enddate, timestep, engine, output_pks=output_pks
+            )
+            compiled = model_cache.get(cache_key)
+            if compiled is not None:
+                init_span.counts["source"] = "cache"
+        if compiled is None and use_cache:
+            # saved by another process
+            artifact = model_artifacts.load(cache_key)
+            if artifact is not None:
+                compiled = compile_definition(*artifact, engine=engine)
+                model_cache.put(cache_key, compiled)
+                init_span.counts["source"] = "artifact"
+        if compiled is None:
+            compiled = build_model(
+                samramodel_pk, adm0, adm1, adm2, startdate, enddate, timestep, engine=engine, output_pks=output_pks,
+                use_cache=use_cache,
+            )
+            init_span.counts["source"] = "database"
+            if use_cache:
+                model_cache.put(cache_key, compiled)
+                model_artifacts.save(cache_key, compiled.definition, compiled.compiled_equations)
+    return compiled
+
+
+def simulate_runs(
+        compiled: CompiledModel,
+        runs: list[tuple],
+        model_output_pks: list[str],
+        batch: bool = True,
+        integrator: str = "euler",
+        step_size: float = None,
+):
+    """ Simulate the runs from collect_runs, return one DataFrame of results per run
+    integrator and step_size are only used by the numpy engine, BPTK always uses Euler steps
+    """
+    if compiled.engine == "numpy" and batch:
+        # combinations only differ by their constants and pulses, so they are all advanced together in one run
+        with profiling.span("engine", runs=len(runs)):
+            return numpy_engine.simulate_batch(
+                compiled.model, [(constants, pulses) for _, _, constants, pulses in runs], model_output_pks,
+                integrator=integrator, step_size=step_size,
+            )
+
+    dfs = []
+    for scenario_pk, responseoption_pk, constants, pulses in runs:
+        with profiling.span("engine", runs=1):
+            if compiled.engine == "numpy":
+                df = numpy_engine.simulate(
+                    compiled.model, constants, pulses, model_output_pks, integrator=integrator, step_size=step_size
+                )
+            else:
+                df = _simulate_bptk(compiled.model, compiled.definition.t, constants, pulses, model_output_pks)
+        dfs.append(df)
+    return dfs
 
-    # initialise all elements and set constants
-    model_locals = {"model": model}
-    for element in elements:
-        pk = str(element.pk)
-        if element.sd_type in ["Variable", "Input", "Seasonal Input"]:
-            model_locals.update({f'_E{pk}_': model.converter(pk)})
-        elif element.sd_type == "Flow":
-            model_locals.update({f'_E{element.pk}_': model.flow(pk)})
-        elif element.sd_type == "Stock":
-            model_locals.update({f'_E{element.pk}_': model.stock(pk)})
-        elif element.sd_type in ["Constant", "Household Constant", "Scenario Constant"]:
-            model_locals.update({f'_E{element.pk}_': model.constant(pk)})
-            # TODO: remove below line somehow
-            model.constant(pk).equation = element.constant_default_value
-        elif element.sd_type == "Pulse Input":
-            model_locals.update({f'_E{element.pk}_': model.converter(pk)})
-    stop = time.time()
-    print(f"set up elements took {stop - start} s")
-    start = time.time()
 
-    # set equations for modeling elements
-    all_equations = ""
-    smoothed_elements = []
-    for element in elements:
-        pk = str(element.pk)
-        if element.sd_type in ["Variable", "Flow"]:
-            if "smooth" in element.equation:
-                # set equation to zero, return to it later to set it properly once everthing else has been set
-                all_equations += element.equation
-                model.converter(pk).equation = 0.0
-                smoothed_elements.append(element)
-                continue
-            try:
-                # exec is limited to use sd.* and smooth functions, and can only see and edit the dict model_locals
-                exec(f"temp_eq = {element.equation}", {"__builtins__": None, "sd": sd, "smooth": smooth}, model_locals)
-                if element.sd_type == "Variable":
-                    model.converter(pk).equation = model_locals.get("temp_eq")
-                else:
-                    model.flow(pk).equation = model_locals.get("temp_eq")
-                all_equations += element.equation
-            except NameError as error:
-                print(f"'{element}' equation could not be defined because {error}. "
-                      f"Setting equation to 0.0 instead.")
-                model.converter(pk).equation = 0.0
-            except SyntaxError as error:
-                print(f"{element} equation is blank, setting to None")
-
-        elif element.sd_type == "Stock":
-            print(f"stock for {element}")
-            model.stock(pk).equation = zero_flow
-            initial_value_var_pk = element.stock_initial_value_variable_id
-            if initial_value_var_pk is not None:
-                model.stock(pk).initial_value = model.constant(str(element.stock_initial_value_variable_id))
-            else:
-                print(f"couldn't find initial_value_variable for {element}, setting initial value to 1.0")
-                model.stock(pk).initial_value = 1.0
-            for inflow in element.inflows.filter(equation__isnull=False).exclude(equation=""):
-                model.stock(pk).equation += model.flow(inflow.pk) / DAYS_IN_MONTH if "mois" in inflow.unit else 1.0
-            for outflow in element.outflows.filter(equation__isnull=False).exclude(equation=""):
-                if "mois" in outflow.unit:
-                    model.stock(pk).equation -= model.flow(outflow.pk) / DAYS_IN_MONTH
-                else:
-                    model.stock(pk).equation -= model.flow(outflow.pk)
-
-    stop = time.time()
-    print(f"set up equations took {stop - start} s")
-    start = time.time()
-
-    # read inputs
-    mdps = MeasuredDataPoint.objects.filter(date__gte=startdate, date__lte=enddate, admin0=adm0)
-    fdps = ForecastedDataPoint.objects.filter(date__gte=startdate, date__lte=enddate, admin0=adm0)
-    sdps = SeasonalInputDataPoint.objects.filter(admin0=adm0)
-    if adm1 is not None:
-        mdps = mdps.filter(admin1=adm1)
-        fdps = fdps.filter(admin1=adm1)
-        sdps = sdps.filter(admin1=adm1)
-        if adm2 is not None:
-            mdps = mdps.filter(admin2=adm2)
-            fdps = fdps.filter(admin2=adm2)
-            sdps = sdps.filter(admin2=adm2)
-    df_m_all = pd.DataFrame(mdps.values())
-    df_f_all = pd.DataFrame(fdps.values())
-    df_s_all = pd.DataFrame(sdps.values())
-
-    m_time = 0.0
-    f_time = 0.0
-
-    # set inputs
-    for element in elements:
-        pk = str(element.pk)
-        if element.sd_type in ["Input", "Seasonal Input"]:
-            if f"_E{element.pk}_" in all_equations:
-                if element.sd_type == "Input":
-                    # load measured points
-                    m_start = time.time()
-                    df_m = df_m_all[df_m_all["element_id"] == int(pk)]
-                    if not df_m.empty:
-                        df_m = df_m.groupby("date").mean().reset_index()[["date", "value"]]
-                    m_time += time.time() - m_start
-
-                    # load forecasted points
-                    f_start = time.time()
-                    df_f = pd.DataFrame()
-                    if not df_f_all.empty:
-                        df_f = df_f_all[df_f_all["element_id"] == int(pk)]
-                        if not df_f.empty:
-                            df_f = df_f.groupby("date").mean().reset_index()[["date", "value"]]
-                    f_time += time.time() - f_start
-                    df = pd.concat([df_m, df_f], ignore_index=True)
-                    if df.empty:
-                        default_value = element.constant_default_value
-                        print(f'{default_value=}')
-                        if default_value is None: default_value = 0.0
-                        print(f"couldn't find timeseries data for {element}, setting eq to {default_value}")
-                        model.converter(pk).equation = default_value
-                        continue
-                else:
-                    df = pd.DataFrame()
-                    if not df_s_all.empty:
-                        df = df_s_all[df_s_all['element_id'] == int(pk)]
-                    if df.empty:
-                        model.converter(str(element.pk)).equation = 1.0
-                        print(f"couldn't find seasonal values for {element}, setting eq to 1.0")
-                        continue
-                    df["date"] = pd.to_datetime(df["date"])
-                    df["month"] = df["date"].dt.month
-                    df["day"] = df["date"].dt.day
-                    df = df[['month', 'day', 'value']]
-                    for yearnum in range(startdate.year - 1, enddate.year + 2):
-                        df[f"year_{yearnum}"] = yearnum
-                    df = pd.melt(df, id_vars=["value", "month", "day"], value_name="year")
-                    df["date"] = df.apply(lambda row: date(row["year"], row["month"], row["day"]), axis=1)
-
-                df["t"] = df["date"].apply(datetime.toordinal)
-                model.points[pk] = df[["t", "value"]].values.tolist()
-                model.converter(pk).equation = sd.lookup(sd.time(), pk)
-            else:
-                # print(f"{element} not used in any equations, removing from modeling")
-                if pk in model_output_pks:
-                    model_output_pks.remove(pk)
-
-    print(f"m took {m_time}, f took {f_time}")
-
-    stop = time.time()
-    print(f"set up inputs took {stop - start} s")
-    start = time.time()
-
-    # smoothed variables
-    # TODO: check if there's a problem setting smoothed variables before constants
-    for element in smoothed_elements:
-        pk = str(element.pk)
-        print(element.label)
-        # exec is limited to use sd.* and smooth functions, and can only see and edit the dict model_locals
-        exec(f"temp_eq = {element.equation}", {"__builtins__": None, "sd": sd, "smooth": smooth}, model_locals)
-        model.converter(pk).equation = model_locals.get("temp_eq")
-
-    stop = time.time()
-    print(f"set up smoothed variables took {stop - start} s")
-    start = time.time()
-
-    # set constant values
-    constants_values = {}
+def collect_runs(elements, scenario_pks, response_pks, adm0, t) -> list[tuple]:
+    """ Read constants and pulses for every combination of scenario and response
+    Returns a list of (scenario_pk, responseoption_pk, constants, pulses), with pulses as arrays of their values on
+    the time grid t. Pulses only depend on the response, so their arrays are shared by all scenarios.
+    """
     response_cv_df = pd.DataFrame(ResponseConstantValue.objects.filter(admin0=adm0).values())
     response_pv_df = pd.DataFrame(PulseValue.objects.filter(admin0=adm0).values())
     scenario_cv_df = pd.DataFrame(ScenarioConstantValue.objects.filter().values())
@@ -235,6 +298,8 @@ def run_model(
             for row in household_cv_df.itertuples()
         })
 
+    runs = []
+    response_pulses = {}
     # TODO: if value doesn't exist for specific admin1,2, just take one from admin0
     for scenario_pk in scenario_pks:
         print(f"SETTING UP SCENARIO {scenario_pk}")
@@ -257,156 +322,367 @@ def run_model(
                         for row in response_cv_dff.itertuples()
                     })
 
-            response_pv_dff = pd.DataFrame()
-            if not response_pv_df.empty:
-                response_pv_dff = response_pv_df[response_pv_df['responseoption_id'] == responseoption_pk]
-            print(f"{response_pv_dff=}")
-            # check that constants are all there and set pulses
+            # check that constants are all there
             constants = household_constants | scenario_constants | response_constants
             for element in elements:
                 pk = str(element.pk)
-                if element.sd_type in Variable.CONSTANTS:
-                    if pk not in constants:
-                        print(f"couldn't find constant for {element}, setting to 0.0")
-                        household_constants.update({pk: 0.0})
-                elif element.sd_type == Variable.RESPONSE_PULSE:
-                    model.converter(pk).equation = 0.0
-                    if not response_pv_dff.empty:
-                        response_pv_dfff = response_pv_dff[response_pv_dff['element_id'] == int(pk)]
-                        print(f"{response_pv_dfff=}")
-                        for row in response_pv_dfff.itertuples():
-                            pulse_start_ord = (row.startdate - pd.DateOffset(days=15)).toordinal()
-                            pulse_stop_ord = (row.startdate + pd.DateOffset(days=15)).toordinal()
-                            model.converter(pk).equation += sd.If(
-                                sd.And(sd.time() > pulse_start_ord, sd.time() < pulse_stop_ord), row.value, 0.0
-                            )
-                    else:
-                        print(f"couldn't find pulses for {element}, setting to 0.0")
-
-            stop = time.time()
-            print(f"setup constants took {stop - start} s")
-            start = time.time()
-
-            # setup to run model
-            model_env = bptk()
-            model_env.register_model(model)
-            scenario_manager = {"scenario_manager": {"model": model}}
-            model_env.register_scenario_manager(scenario_manager)
-
-            # run model
-            # for purposes of running bptk, just set scenario to "base"
-            # TODO: loop over admin0s and/or HH types
-            bptk_scenario = "base"
-            model_env.register_scenarios(scenarios={bptk_scenario: {"constants": constants}},
-                                         scenario_manager="scenario_manager")
-            # ignore pandas PerformanceWarnings since bptk will always throw these up if given enough variables to output
-            with warnings.catch_warnings():
-                warnings.simplefilter(action="ignore", category=pd.errors.PerformanceWarning)
-                df = model_env.plot_scenarios(scenarios=bptk_scenario, scenario_managers="scenario_manager",
-                                              equations=model_output_pks, return_df=True).reset_index()
-            stop = time.time()
-            print(f"run model took {stop - start} s")
-            start = time.time()
-
-            df["date"] = df["t"].apply(datetime.fromordinal)
-            df = df.drop(columns=['t'])
-            df = pd.melt(df, id_vars=["date"])
-
-            pks_in_result = df['variable'].unique()
-            missing_pks = []
-            for pk in model_output_pks:
-                if pk not in pks_in_result:
-                    missing_pks.append(pk)
-
-            missing_variables = Variable.objects.filter(pk__in=missing_pks)
-            print(missing_variables)
-
-            stop = time.time()
-            print(f"format results took {stop - start} s")
-            start = time.time()
-
-            if DATABASES['default']['ENGINE'] == 'mssql':
-                # if using MSSQL, use Django ORM because there's a problem with using the raw SQL
-                # TODO: add admin0-2 functionality
-                objs = [
-                    SimulatedDataPoint(
-                        element_id=row.variable,
-                        value=row.value,
-                        date=row.date,
-                        scenario_id=scenario_pk,
-                        responseoption_id=responseoption_pk
-                    )
-                    for row in df.itertuples()
-                ]
-
-                print(f"df iterrows took {time.time() - start} s")
-                start = time.time()
-
-                SimulatedDataPoint.objects.filter(scenario_id=scenario_pk, responseoption_id=responseoption_pk).delete()
-                SimulatedDataPoint.objects.bulk_create(objs)
-
-                print(f"bulk_create took {time.time() - start} s")
-                start = time.time()
+                if element.sd_type in Variable.CONSTANTS and pk not in constants:
+                    print(f"couldn't find constant for {element}, setting to 0.0")
+                    household_constants.update({pk: 0.0})
+            if responseoption_pk not in response_pulses:
+                response_pulses[responseoption_pk] = _collect_pulses(elements, response_pv_df, responseoption_pk, t)
+            pulses = response_pulses[responseoption_pk]
+            runs.append((scenario_pk, responseoption_pk, constants, pulses))
+
+    return runs
+
+
+def _collect_pulses(elements, response_pv_df, responseoption_pk, t) -> dict:
+    """ Values on the time grid t of every Pulse Input for a response """
+    response_pv_dff = pd.DataFrame()
+    if not response_pv_df.empty:
+        response_pv_dff = response_pv_df[response_pv_df['responseoption_id'] == responseoption_pk]
+    pulses = {}
+    for element in elements:
+        if element.sd_type != Variable.RESPONSE_PULSE:
+            continue
+        pulse_values = []
+        if not response_pv_dff.empty:
+            for row in response_pv_dff[response_pv_dff['element_id'] == element.pk].itertuples():
+                enddate = None if pd.isna(row.enddate) else row.enddate
+                pulse_values.append((*input_arrays.pulse_window(row.startdate, enddate), row.value))
+        else:
+            print(f"couldn't find pulses for {element}, setting to 0.0")
+        pulses[str(element.pk)] = input_arrays.pulse_array(t, pulse_values)
+    return pulses
+
+
+def save_results(
+        df, scenario_pk, responseoption_pk, adm0, model_output_pks, replace_all=True, adm1=None, adm2=None, run=None
+):
+    """ Replace the saved results of a scenario and response with the results of a run, see result_storage.py
+    with replace_all False, only the results of the elements in the run are replaced
+    adm1 and adm2 are None for results of a whole admin0, and only replace results of the same admin unit
+    run is the SimulationRun the results belong to, they are read once run_registry.finish_run makes it current.
+    Returns the number of values saved.
+    """
+    with profiling.span("format"):
+        pks_in_result = [column for column in df.columns if column != "t"]
+        missing_pks = []
+        for pk in model_output_pks:
+            if pk not in pks_in_result:
+                missing_pks.append(pk)
+
+        missing_variables = Variable.objects.filter(pk__in=missing_pks)
+        print(missing_variables)
+
+        if run is None:
+            run_registry.forget_runs(scenario_pk, responseoption_pk, adm0, adm1, adm2)
+        run_pk = None if run is None else run.pk
+        n_values = len(pks_in_result) * len(df)
+        if result_storage.storage() == result_storage.ROWS:
+            df["date"] = df["t"].apply(date.fromordinal)
+            df = pd.melt(df.drop(columns=['t']), id_vars=["date"])
+            # NaN values are saved as NULL
+            rows = (
+                (int(pk), None if value != value else value, row_date)
+                for pk, value, row_date in zip(df["variable"], df["value"], df["date"])
+            )
+
+    with profiling.span("write", values=n_values):
+        if result_storage.storage() == result_storage.SERIES:
+            result_storage.replace_series(
+                df, scenario_pk, responseoption_pk, adm0, adm1, adm2,
+                element_pks=None if replace_all else pks_in_result, run_pk=run_pk,
+            )
+        else:
+            result_writer.replace_results(
+                rows, scenario_pk, responseoption_pk, adm0, adm1, adm2,
+                element_pks=None if replace_all else pks_in_result, run_pk=run_pk,
+            )
+    return n_values
+
+
+def _simulate_bptk(model, t, constants, pulses, model_output_pks):
+    """ Run a built BPTK model for one set of constants and pulses, return the results with one column per output
+    pulses are arrays on the time grid t, each pulse input looks up its own points
+    """
+    for pk, values in pulses.items():
+        model.points[f"PULSE {pk}"] = input_arrays.pulse_points(t, values)
+
+    # setup to run model
+    model_env = bptk()
+    model_env.register_model(model)
+    scenario_manager = {"scenario_manager": {"model": model}}
+    model_env.register_scenario_manager(scenario_manager)
+
+    # for purposes of running bptk, just set scenario to "base"
+    # TODO: loop over admin0s and/or HH types
+    bptk_scenario = "base"
+    model_env.register_scenarios(scenarios={bptk_scenario: {"constants": constants}},
+                                 scenario_manager="scenario_manager")
+    # ignore pandas PerformanceWarnings since bptk will always throw these up if given enough variables to output
+    with warnings.catch_warnings():
+        warnings.simplefilter(action="ignore", category=pd.errors.PerformanceWarning)
+        return model_env.plot_scenarios(scenarios=bptk_scenario, scenario_managers="scenario_manager",
+                                        equations=model_output_pks, return_df=True).reset_index()
+
+
+def build_model(
+        samramodel_pk: int,
+        adm0: str,
+        adm1: str = None,
+        adm2: str = None,
+        startdate: date = date(2022, 7, 1),
+        enddate: date = date(2024, 7, 1),
+        timestep: int = 2,
+        engine: str = "bptk",
+        output_pks: list[str] = None,
+        use_cache: bool = True,
+):
+    """ Build a model for a SAMRA model and admin unit, without setting scenario or response constants
+    Returns a CompiledModel that can be run for any number of scenarios and responses.
+    If output_pks is given, the model only has those outputs and the elements they depend on.
+    """
+    definition = load_model_definition(
+        samramodel_pk, adm0, adm1, adm2, startdate, enddate, timestep, output_pks=output_pks, use_cache=use_cache
+    )
+
+    # check all equations up front, so problems are reported before any model is built or run
+    with profiling.span("equations") as equations_span:
+        compiled_equations = equations.compile_equations(definition.elements)
+        equations_span.counts["equations"] = len(compiled_equations.order)
+        for problem in compiled_equations.problems:
+            print(problem)
+    return compile_definition(definition, compiled_equations, engine=engine)
+
+
+def compile_definition(
+        definition: ModelDefinition,
+        compiled_equations: equations.CompiledEquations,
+        engine: str = "bptk",
+) -> CompiledModel:
+    """ Build the engine model from a definition and its compiled equations, without reading the database """
+    with profiling.span("build", engine=engine):
+        if engine == "numpy":
+            model = numpy_engine.compile_model(definition, compiled_equations)
+        else:
+            model = build_bptk_model(definition, compiled_equations)
+    return CompiledModel(definition=definition, model=model, engine=engine, compiled_equations=compiled_equations)
+
+
+def load_model_definition(
+        samramodel_pk: int,
+        adm0: str,
+        adm1: str = None,
+        adm2: str = None,
+        startdate: date = date(2022, 7, 1),
+        enddate: date = date(2024, 7, 1),
+        timestep: int = 2,
+        output_pks: list[str] = None,
+        use_cache: bool = True,
+):
+    with profiling.span("elements") as elements_span:
+        elements = Variable.objects.filter(samramodel_id=samramodel_pk).filter(
+            Q(sd_type="Variable", equation__isnull=False) |
+            Q(sd_type="Flow", equation__isnull=False) |
+            Q(sd_type="Stock", stock_initial_value__isnull=False) |
+            Q(sd_type="Input") |
+            Q(sd_type="Seasonal Input") |
+            Q(sd_type="Scenario Constant") |
+            Q(sd_type="Constant") |
+            Q(sd_type="Pulse Input") |
+            Q(sd_type="Household Constant")
+        )
+
+        model_output_pks = []
+        for element in elements:
+            if element.sd_type in ["Variable", "Stock", "Flow"] and element.model_output_variable:
+                model_output_pks.append(str(element.pk))
+
+        definition = ModelDefinition(
+            samramodel_pk=samramodel_pk, startdate=startdate, enddate=enddate, timestep=timestep,
+            elements=list(elements), model_output_pks=model_output_pks,
+        )
+        elements_span.counts["elements"] = len(definition.elements)
+
+    with profiling.span("stocks") as stocks_span:
+        # stock and flow structure, the flows of all stocks are read in one query
+        stock_flows = topology.load_topology(samramodel_pk)
+        all_equations = ""
+        for element in elements:
+            pk = str(element.pk)
+            if element.sd_type in ["Variable", "Flow"]:
+                all_equations += element.equation
+            elif element.sd_type == "Stock":
+                initial_value_var_pk = element.stock_initial_value_variable_id
+                if initial_value_var_pk is None:
+                    print(f"couldn't find initial_value_variable for {element}, setting initial value to 1.0")
+                definition.stocks[pk] = {
+                    "initial_value_pk": str(initial_value_var_pk) if initial_value_var_pk is not None else None,
+                    "inflows": [
+                        (str(inflow.flow_pk), 1 / DAYS_IN_MONTH if "mois" in inflow.unit else 1.0)
+                        for inflow in stock_flows.inflows.get(element.pk, []) if inflow.has_equation
+                    ],
+                    "outflows": [
+                        (str(outflow.flow_pk), 1 / DAYS_IN_MONTH if "mois" in outflow.unit else 1.0)
+                        for outflow in stock_flows.outflows.get(element.pk, []) if outflow.has_equation
+                    ],
+                }
+        stocks_span.counts["stocks"] = len(definition.stocks)
+
+    if output_pks is not None:
+        # only what the outputs depend on is simulated, so only those inputs need to be read
+        definition = pruning.prune_definition(definition, output_pks)
+
+    with profiling.span("inputs") as inputs_span:
+        # read inputs, resampled onto the time grid once and reused from input_arrays' cache where possible
+        used_inputs = []
+        for element in definition.elements:
+            if element.sd_type in ["Input", "Seasonal Input"]:
+                if f"_E{element.pk}_" in all_equations:
+                    used_inputs.append(element)
+                elif str(element.pk) in definition.model_output_pks:
+                    # print(f"{element} not used in any equations, removing from modeling")
+                    definition.model_output_pks.remove(str(element.pk))
+
+        series = input_arrays.load_inputs(
+            used_inputs, adm0, adm1, adm2, startdate, enddate, timestep, use_cache=use_cache
+        )
+        for pk, input_series in series.items():
+            definition.input_arrays[pk] = input_series.values
+            if input_series.points is None:
+                definition.input_values[pk] = input_series.value
+                continue
+            definition.input_points[pk] = input_series.points
+            if input_series.sds is not None:
+                definition.input_sds[pk] = input_series.sds
+        inputs_span.counts["inputs"] = len(series)
+
+    return definition
+
+
+def build_bptk_model(definition: ModelDefinition, compiled_equations: equations.CompiledEquations = None):
+    if compiled_equations is None:
+        compiled_equations = equations.compile_equations(definition.elements)
+
+    model = Model(
+        starttime=definition.startdate.toordinal(), stoptime=definition.enddate.toordinal(), dt=definition.timestep
+    )
+    with profiling.span("elements"):
+        zero_flow = model.flow("Zero Flow")
+        zero_flow.equation = 0.0
+
+        # initialise all elements and set constants
+        model_locals = {}
+        for element in definition.elements:
+            pk = str(element.pk)
+            if element.sd_type in ["Variable", "Input", "Seasonal Input"]:
+                model_locals.update({f'_E{pk}_': model.converter(pk)})
+            elif element.sd_type == "Flow":
+                model_locals.update({f'_E{element.pk}_': model.flow(pk)})
+            elif element.sd_type == "Stock":
+                model_locals.update({f'_E{element.pk}_': model.stock(pk)})
+            elif element.sd_type in ["Constant", "Household Constant", "Scenario Constant"]:
+                model_locals.update({f'_E{element.pk}_': model.constant(pk)})
+                # TODO: remove below line somehow
+                model.constant(pk).equation = element.constant_default_value
+            elif element.sd_type == "Pulse Input":
+                model_locals.update({f'_E{element.pk}_': model.converter(pk)})
+                # the points are replaced for each run
+                model.points[f"PULSE {pk}"] = [[definition.t[0], 0.0], [definition.t[-1], 0.0]]
+                model.converter(pk).equation = sd.lookup(sd.time(), f"PULSE {pk}")
+
+    with profiling.span("stocks and inputs"):
+        # stocks
+        for pk, stock in definition.stocks.items():
+            model.stock(pk).equation = zero_flow
+            if stock["initial_value_pk"] is not None:
+                model.stock(pk).initial_value = model.constant(stock["initial_value_pk"])
             else:
-                # delete and save done with raw SQL delete and insert (twice as fast as built-in bulk_create)
-                # TODO: add admin1-2 functionality
-                data = []
-                for row in df.itertuples():
-                    data.extend([row.variable, row.value, row.date, scenario_pk, responseoption_pk, adm0])
-
-                print(f"SQL iterrows took {time.time() - start} s")
-                start = time.time()
-
-                insert_stmt = (
-                    "INSERT INTO sahel_simulateddatapoint (element_id, value, date, scenario_id, responseoption_id, admin0) "
-                    f"VALUES {', '.join(['(' + ', '.join(['%s'] * 6) + ')'] * len(df))}"
-                )
-                delete_stmt = (
-                    f"DELETE FROM sahel_simulateddatapoint WHERE "
-                    f"scenario_id = {scenario_pk} AND responseoption_id = {responseoption_pk} AND admin0 = '{adm0}';"
-                )
-                with closing(connection.cursor()) as cursor:
-                    cursor.execute(delete_stmt)
-                    cursor.execute(insert_stmt, data)
+                model.stock(pk).initial_value = 1.0
+            for inflow_pk, factor in stock["inflows"]:
+                model.stock(pk).equation += model.flow(inflow_pk) * factor
+            for outflow_pk, factor in stock["outflows"]:
+                model.stock(pk).equation -= model.flow(outflow_pk) * factor
+
+        # set inputs
+        for pk, points in definition.input_points.items():
+            model.points[pk] = points
+            model.converter(pk).equation = sd.lookup(sd.time(), pk)
+        for pk, value in definition.input_values.items():
+            model.converter(pk).equation = value
 
-                print(f"SQL bulk delete and insert took {time.time() - start} s")
-                start = time.time()
+    # set equations for modeling elements
+    def set_variable(pk, equation):
+        model.converter(pk).equation = equation
+        return model.converter(pk)
 
-    return None
+    def set_flow(pk, equation):
+        model.flow(pk).equation = equation
+        return model.flow(pk)
+
+    with profiling.span("equations") as equations_span:
+        compiled_equations.function(model_locals, sd, smooth, delay, model, set_variable, set_flow)
+        equations_span.counts["smooths"] = sum(name.startswith("SMOOTHED") for name in model.stocks)
+
+    return model
 
 
 def smooth(model, input_var, time_constant, initial_value=None):
-    """ Smooth a variable
+    """ Smooth a variable with a single stock, whose rate of change is (input - smoothed) / time_constant
     (Built-in sd.smooth function does not work properly)
+    The stock starts at the value of input_var at the start of the run, unless initial_value is given.
+    input_var is a function giving the input, see equations.CompiledEquations.
     """
-    smoothed_value = model.stock(f"{input_var.name} SMOOTHED")
+    input_var = _as_converter(model, input_var(), "SMOOTHING INPUT")
+    smoothed_value = model.stock(f"SMOOTHED {len(model.stocks)} {input_var.name}")
     if initial_value is None:
-        initial_value = model.evaluate_equation(input_var.name, model.starttime)
+        initial_value = input_var
+    elif isinstance(initial_value, (int, float)):
+        initial_value = float(initial_value)
+    else:
+        initial_value = _as_converter(model, initial_value, f"{smoothed_value.name} INITIAL VALUE")
     smoothed_value.initial_value = initial_value
-    value_increase = model.flow(f"{input_var.name} SMOOTHING UP")
-    value_decrease = model.flow(f"{input_var.name} SMOOTHING DOWN")
-    smoothed_value.equation = value_increase - value_decrease
-    value_increase.equation = (input_var - smoothed_value) / time_constant
-    value_decrease.equation = (smoothed_value - input_var) / time_constant
+    smoothed_value.equation = (input_var - smoothed_value) / time_constant
+    return smoothed_value
+
+
+def delay(model, input_var, delay_time, initial_value=None, order=1):
+    """ Delay a variable by delay_time with a cascade of order smooths """
+    for _ in range(int(order)):
+        smoothed_value = smooth(model, input_var, delay_time / order, initial_value)
+        input_var = lambda smoothed_value=smoothed_value: smoothed_value
     return smoothed_value
 
 
+def _as_converter(model, element, name):
+    """ Converters and constants are used as they are, any other element or expression is wrapped in a converter """
+    if isinstance(element, (Converter, Constant)):
+        return element
+    converter = model.converter(f"{name} {len(model.converters)}")
+    converter.equation = element
+    return converter
+
+
 def timer(func):
+    """ Time every call of func as a span, see profiling.py """
     @functools.wraps(func)
     def wrapper_timer(*args, **kwargs):
-        start_time = time.time()
-        value = func(*args, **kwargs)
-        run_time = time.time() - start_time
-        print(f"Function {func.__name__!r} took {run_time:.4f} s")
-        return value
+        with profiling.span(func.__name__):
+            return func(*args, **kwargs)
 
     return wrapper_timer
 
 
-def read_results(adm0, element_pk, scenario_pks, response_pks, agg_value: str = None):
-    # TODO: again, add admin1-2
+def read_results(
+        adm0, element_pk, scenario_pks, response_pks, agg_value: str = None, adm1=None, adm2=None,
+        cost_element_pk: int = 102, baseline_response_pk: int = 1,
+):
+    """ Aggregated results and cost efficiency of each scenario and response, for adm0 or one of its admin units
+    cost efficiency is the change in the element over the change in cost_element_pk, relative to the baseline response
+    """
     # initialize
-    baseline_response_pk = 1
     response_pks_filter = response_pks.copy()
     if baseline_response_pk not in response_pks:
         response_pks_filter.append(baseline_response_pk)
@@ -416,13 +692,15 @@ def read_results(adm0, element_pk, scenario_pks, response_pks, agg_value: str =
         agg_value = element.aggregate_by
 
     # read in element df
-    df = pd.DataFrame(SimulatedDataPoint.objects.filter(
+    df = result_storage.read_points(
+        ["responseoption_id", "scenario_id", "value", "responseoption__name", "scenario__name", "date"],
         admin0=adm0,
+        admin1=adm1,
+        admin2=adm2,
         element_id=element_pk,
         scenario_id__in=scenario_pks,
         responseoption_id__in=response_pks_filter,
-    ).values("responseoption_id", "scenario_id", "value",
-             "responseoption__name", "scenario__name", "date"))
+    )
     if "LCY" in element.unit:
         df["value"] /= 1000
         element.unit = "1000 " + element.unit
@@ -471,13 +749,15 @@ def read_results(adm0, element_pk, scenario_pks, response_pks, agg_value: str =
         agg_unit = "INVALID"
 
     # read in cost df
-    df_cost = pd.DataFrame(SimulatedDataPoint.objects.filter(
+    df_cost = result_storage.read_points(
+        ["responseoption_id", "scenario_id", "value", "responseoption__name", "scenario__name", "date"],
         admin0=adm0,
-        element_id=102,
+        admin1=adm1,
+        admin2=adm2,
+        element_id=cost_element_pk,
         scenario_id__in=scenario_pks,
         responseoption_id__in=response_pks_filter,
-    ).values("responseoption_id", "scenario_id", "value",
-             "responseoption__name", "scenario__name", "date"))
+    )
     df_cost = df_cost.sort_values(["scenario_id", "responseoption_id", "date"])
     df_cost_agg = df_cost.groupby([
         "responseoption_id", "scenario_id",
@@ -505,3 +785,24 @@ def read_results(adm0, element_pk, scenario_pks, response_pks, agg_value: str =
     df_agg["baseline_diff"] = df_agg["value"] - df_agg["baseline_value"]
 
     return df, df_cost, df_agg, df_cost_agg, agg_text, agg_unit, divider_text, element.unit
+
+
+def aggregate_values(values, agg_value: str, unit: str, period: float):
+    """ Aggregate simulated values over time (axis 0) the same way read_results does, for arrays of runs """
+    if agg_value == "MEAN":
+        return values.mean(axis=0)
+    if agg_value == "SUM":
+        total = values.sum(axis=0) * period
+        if "mois" in unit:
+            total /= DAYS_IN_MONTH
+        elif "jour" in unit:
+            pass
+        elif "an" in unit:
+            total /= 365.25
+        return total
+    if "CHANGE" in agg_value:
+        change = values[-1] - values[0]
+        if "%" in agg_value:
+            change = change * 100 / values[0]
+        return change
+    raise ValueError(f"invalid aggregation {agg_value}")
@@ -0,0 +1,557 @@
+from dataclasses import dataclass, field
+import numpy as np
+import pandas as pd
+from . import equations, input_arrays
+
+# Vectorised alternative to BPTK for running SAMRA models.
+# Follows the same semantics as the BPTK model built in model_operations.build_bptk_model:
+# - fixed-step Euler, stock(t + dt) = stock(t) + dt * net flow(t)
+#   (RK4 and adaptive Dormand-Prince steps can be used instead, with outputs interpolated back onto the grid)
+# - flows are never negative
+# - inputs are linearly interpolated lookups, held constant outside the range of their points
+# - smooth() is a first order smoothing stock, starting at the value of its input at the start of the run, and
+#   delay() is a cascade of smooths
+
+
+INTEGRATORS = ["euler", "rk4", "adaptive"]
+# error tolerances and smallest step of the adaptive integrator
+RTOL = 1e-4
+ATOL = 1e-6
+MIN_STEP = 1e-6
+
+# Dormand-Prince 5(4) tableau, the last stage is evaluated at the new state, so it is the first stage of the next step
+_DP_C = [1 / 5, 3 / 10, 4 / 5, 8 / 9, 1.0, 1.0]
+_DP_A = [
+    [1 / 5],
+    [3 / 40, 9 / 40],
+    [44 / 45, -56 / 15, 32 / 9],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+    [35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84],
+]
+# difference between the 5th and 4th order weights, gives the error estimate
+_DP_E = [71 / 57600, 0.0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40]
+
+
+@dataclass
+class NumpyModel:
+    t: np.ndarray
+    dt: float
+    equations: equations.CompiledEquations
+    # pk: (initial value pk or None, [(flow pk, factor)], [(flow pk, factor)])
+    stocks: dict
+    # pk: values on t
+    inputs: dict
+    constant_defaults: dict
+    pulse_pks: list
+    points: dict
+    # pk: standard deviation of each of its points, for inputs with forecast intervals
+    input_sds: dict = field(default_factory=dict)
+
+
+class _SDFunctions:
+    """ Vectorised versions of the BPTK sd functions that can be used in equations """
+
+    def __init__(self, numpy_model: NumpyModel):
+        self._model = numpy_model
+        self.t = numpy_model.t[0]
+
+    @staticmethod
+    def If(condition, then_value, else_value):
+        return np.where(condition, then_value, else_value)
+
+    @staticmethod
+    def And(*conditions):
+        return np.logical_and.reduce(np.broadcast_arrays(*conditions))
+
+    @staticmethod
+    def Or(*conditions):
+        return np.logical_or.reduce(np.broadcast_arrays(*conditions))
+
+    @staticmethod
+    def Not(condition):
+        return np.logical_not(condition)
+
+    @staticmethod
+    def max(x, y):
+        return np.maximum(x, y)
+
+    @staticmethod
+    def min(x, y):
+        return np.minimum(x, y)
+
+    @staticmethod
+    def abs(x):
+        return np.abs(x)
+
+    @staticmethod
+    def exp(x):
+        return np.exp(x)
+
+    @staticmethod
+    def sqrt(x):
+        return np.sqrt(x)
+
+    @staticmethod
+    def sin(x):
+        return np.sin(x)
+
+    @staticmethod
+    def cos(x):
+        return np.cos(x)
+
+    @staticmethod
+    def tan(x):
+        return np.tan(x)
+
+    @staticmethod
+    def round(x, digits=0):
+        return np.round(x, int(digits))
+
+    @staticmethod
+    def pi():
+        return np.pi
+
+    @staticmethod
+    def nan():
+        return np.nan
+
+    def time(self):
+        return self.t
+
+    def dt(self):
+        return self._model.dt
+
+    def starttime(self):
+        return self._model.t[0]
+
+    def stoptime(self):
+        return self._model.t[-1]
+
+    def step(self, height, timestep):
+        return np.where(self.t > timestep, height, 0.0)
+
+    def lookup(self, x, points):
+        if isinstance(points, str):
+            points = self._model.points[points]
+        xp, fp = _sorted_points(points)
+        return np.interp(x, xp, fp)
+
+
+class _Smoothing:
+    """ State of all smooth() calls in a model, in the order they are evaluated in a timestep """
+
+    def __init__(self):
+        self.values = []
+        self.rates = []
+        self.slot = 0
+        # (slot, input, time constant) of the smooths evaluated since the last finish()
+        self.pending = []
+
+    def smooth(self, input_var, time_constant, initial_value=None):
+        """ The value of the next smoothing stock, input_var is a function giving its input """
+        slot = self.slot
+        self.slot += 1
+        if slot == len(self.values):
+            # first evaluation of the run
+            value = input_var() if initial_value is None else initial_value
+            self.values.append(np.asarray(value, dtype=float))
+            self.rates.append(0.0)
+        self.pending.append((slot, input_var, time_constant))
+        return self.values[slot]
+
+    def finish(self):
+        """ Compute the rates once every equation is evaluated, the inputs can depend on the smoothed values """
+        for slot, input_var, time_constant in self.pending:
+            self.rates[slot] = (input_var() - self.values[slot]) / time_constant
+        self.pending = []
+
+    def step(self, dt):
+        for slot, rate in enumerate(self.rates):
+            self.values[slot] = self.values[slot] + dt * rate
+        self.slot = 0
+
+
+def _smooth(model, input_var, time_constant, initial_value=None):
+    return model.smooth(input_var, time_constant, initial_value)
+
+
+def _delay(model, input_var, delay_time, initial_value=None, order=1):
+    for _ in range(int(order)):
+        value = model.smooth(input_var, delay_time / order, initial_value)
+        input_var = lambda value=value: value
+    return value
+
+
+def _sorted_points(points):
+    points = np.asarray(points, dtype=float)
+    order = np.argsort(points[:, 0], kind="stable")
+    return points[order, 0], points[order, 1]
+
+
+def compile_model(definition, compiled_equations: equations.CompiledEquations = None) -> NumpyModel:
+    """ Turn a model_operations.ModelDefinition into arrays, using the equations compiled by equations.py """
+    if compiled_equations is None:
+        compiled_equations = equations.compile_equations(definition.elements)
+    t = input_arrays.time_grid(definition.startdate, definition.enddate, definition.timestep)
+
+    constant_defaults = {}
+    pulse_pks = []
+    for element in definition.elements:
+        pk = str(element.pk)
+        if element.sd_type in ["Constant", "Household Constant", "Scenario Constant"]:
+            constant_defaults[pk] = element.constant_default_value if element.constant_default_value is not None else 0.0
+        elif element.sd_type == "Pulse Input":
+            pulse_pks.append(pk)
+
+    # already on the time grid, shared with every other model using the same inputs
+    inputs = dict(definition.input_arrays)
+
+    stocks = {
+        pk: (stock["initial_value_pk"], stock["inflows"], stock["outflows"])
+        for pk, stock in definition.stocks.items()
+    }
+
+    numpy_model = NumpyModel(
+        t=t, dt=float(definition.timestep), equations=compiled_equations, stocks=stocks, inputs=inputs,
+        constant_defaults=constant_defaults, pulse_pks=pulse_pks, points=definition.input_points,
+        input_sds=definition.input_sds,
+    )
+    return numpy_model
+
+
+def _variable_value(pk, value):
+    return value
+
+
+def _flow_value(pk, value):
+    # flows are never negative
+    return np.maximum(value, 0.0)
+
+
+def _initial_stocks(numpy_model: NumpyModel, constants: dict, batch_size: int) -> dict:
+    stocks = {}
+    for pk, (initial_value_pk, _, _) in numpy_model.stocks.items():
+        value = 1.0 if initial_value_pk is None else constants.get(initial_value_pk, 0.0)
+        stocks[pk] = np.full(batch_size, value, dtype=float)
+    return stocks
+
+
+def _evaluate(
+        numpy_model: NumpyModel, k, sd_functions, smoothing, constants, pulses, stocks, inputs, time: float = None
+) -> dict:
+    """ Evaluate every element at time index k, return the namespace of values by name
+    If time is given the model is evaluated at that time instead, with inputs interpolated between grid points and
+    pulses as they are at index k.
+    """
+    sd_functions.t = numpy_model.t[k] if time is None else time
+    namespace = {}
+    for pk, value in constants.items():
+        namespace[f"_E{pk}_"] = value
+    for pk in numpy_model.pulse_pks:
+        namespace[f"_E{pk}_"] = pulses[pk][..., k] if pk in pulses else 0.0
+    if time is None:
+        for pk, values in inputs.items():
+            namespace[f"_E{pk}_"] = values[k]
+    else:
+        j, weight = _grid_position(numpy_model.t, time)
+        for pk, values in inputs.items():
+            namespace[f"_E{pk}_"] = values[j] + weight * (values[j + 1] - values[j])
+    for pk, value in stocks.items():
+        namespace[f"_E{pk}_"] = value
+    namespace.update(numpy_model.equations.function(
+        namespace, sd_functions, _smooth, _delay, smoothing, _variable_value, _flow_value
+    ))
+    smoothing.finish()
+    return namespace
+
+
+def _grid_position(t: np.ndarray, time: float) -> tuple[int, float]:
+    """ Index of the grid interval containing time, and how far into it time is, for linear interpolation """
+    j = min(max(int(np.searchsorted(t, time, side="right")) - 1, 0), len(t) - 2)
+    return j, (time - t[j]) / (t[j + 1] - t[j])
+
+
+def _net_flows(numpy_model: NumpyModel, namespace: dict) -> dict:
+    """ Inflows minus outflows of every stock """
+    net_flows = {}
+    for pk, (_, inflows, outflows) in numpy_model.stocks.items():
+        net_flow = 0.0
+        for flow_pk, factor in inflows:
+            net_flow = net_flow + namespace.get(f"_E{flow_pk}_", 0.0) * factor
+        for flow_pk, factor in outflows:
+            net_flow = net_flow - namespace.get(f"_E{flow_pk}_", 0.0) * factor
+        net_flows[pk] = net_flow
+    return net_flows
+
+
+def integrate(
+        numpy_model: NumpyModel,
+        constants: dict,
+        pulses: dict,
+        output_pks: list,
+        batch_size: int = 1,
+        inputs: dict = None,
+        integrator: str = "euler",
+        step_size: float = None,
+) -> dict:
+    """ Run the model with Euler steps, or with one of the other INTEGRATORS
+    constants are floats or arrays of shape (batch_size,), pulses are arrays of shape (len(t),) or (batch_size, len(t))
+    inputs replace the model's inputs, as arrays of shape (len(t),) or (len(t), batch_size)
+    Euler always steps on the grid t. step_size is the step of rk4, by default dt, and an optional largest step of
+    adaptive, in days. Without it adaptive steps are only limited by the error control, pulses and the end of the run.
+    Returns arrays of shape (len(t), batch_size) for each output pk.
+    """
+    if integrator not in INTEGRATORS:
+        raise ValueError(f"invalid integrator {integrator}, must be one of {INTEGRATORS}")
+    constants = numpy_model.constant_defaults | constants
+    inputs = numpy_model.inputs | (inputs or {})
+    sd_functions = _SDFunctions(numpy_model)
+    smoothing = _Smoothing()
+    stocks = _initial_stocks(numpy_model, constants, batch_size)
+    if integrator != "euler":
+        return _integrate_runge_kutta(
+            numpy_model, sd_functions, smoothing, constants, pulses, stocks, inputs, output_pks, batch_size,
+            adaptive=integrator == "adaptive", step_size=step_size,
+        )
+    results = {pk: np.empty((len(numpy_model.t), batch_size)) for pk in output_pks}
+
+    for k in range(len(numpy_model.t)):
+        namespace = _evaluate(numpy_model, k, sd_functions, smoothing, constants, pulses, stocks, inputs)
+        for pk, values in results.items():
+            values[k] = namespace.get(f"_E{pk}_", np.nan)
+        for pk, net_flow in _net_flows(numpy_model, namespace).items():
+            stocks[pk] = stocks[pk] + numpy_model.dt * net_flow
+        smoothing.step(numpy_model.dt)
+
+    return results
+
+
+def _pulse_breakpoints(numpy_model: NumpyModel, pulses: dict) -> np.ndarray:
+    """ Times on the grid where any pulse changes value, steps end on these so no pulse is stepped over """
+    changed = np.zeros(len(numpy_model.t), dtype=bool)
+    for values in pulses.values():
+        values = np.reshape(values, (-1, len(numpy_model.t)))
+        changed[1:] |= np.any(np.diff(values, axis=1) != 0, axis=0)
+    return numpy_model.t[changed]
+
+
+def _integrate_runge_kutta(
+        numpy_model: NumpyModel, sd_functions, smoothing, constants, pulses, stocks, inputs, output_pks,
+        batch_size: int, adaptive: bool, step_size: float = None,
+) -> dict:
+    """ Integrate with classic RK4 steps of step_size (dt if None), or adaptive Dormand-Prince steps of at most
+    step_size if given
+    The state is the stocks followed by the smoothing stocks. Pulses are held at their value at the start of each
+    step, and steps end on every time a pulse changes. The state is then interpolated onto the grid t with cubic
+    Hermite polynomials, and all other elements are evaluated on the whole grid at once.
+    """
+    t = numpy_model.t
+    n_stocks = len(numpy_model.stocks)
+
+    def rates(time, k, state):
+        smoothing.values = list(state[n_stocks:])
+        smoothing.slot = 0
+        namespace = _evaluate(
+            numpy_model, k, sd_functions, smoothing, constants, pulses, dict(zip(numpy_model.stocks, state)),
+            inputs, time=time,
+        )
+        net_flows = _net_flows(numpy_model, namespace)
+        return [net_flows[pk] for pk in numpy_model.stocks] + list(smoothing.rates)
+
+    def grid_index(time):
+        return int(np.searchsorted(t, time, side="right") - 1)
+
+    def combine(state, stage_rates, weights):
+        return [
+            value + sum(weight * stage[i] for weight, stage in zip(weights, stage_rates) if weight)
+            for i, value in enumerate(state)
+        ]
+
+    # the first evaluation also adds the smoothing stocks to the state
+    state = list(stocks.values())
+    k1 = rates(t[0], 0, state)
+    state = state + smoothing.values
+    breakpoints = np.append(_pulse_breakpoints(numpy_model, pulses), t[-1])
+    # for each step: start time, state and rates at its start, state and rates (with its pulses) at its end
+    steps = []
+    n_evaluations = 1
+
+    if not adaptive:
+        step_size = step_size if step_size is not None else numpy_model.dt
+        step_ends = np.union1d(np.arange(t[0] + step_size, t[-1], step_size), breakpoints)
+        for start, stop in zip([t[0], *step_ends[:-1]], step_ends):
+            h = stop - start
+            k = grid_index(start)
+            k2 = rates(start + h / 2, k, combine(state, [k1], [h / 2]))
+            k3 = rates(start + h / 2, k, combine(state, [k2], [h / 2]))
+            k4 = rates(stop, k, combine(state, [k3], [h]))
+            new_state = combine(state, [k1, k2, k3, k4], [h / 6, h / 3, h / 3, h / 6])
+            end_rates = rates(stop, k, new_state)
+            n_evaluations += 4
+            if stop in breakpoints:
+                # pulses change, so the next step starts from different rates
+                next_k1 = rates(stop, grid_index(stop), new_state)
+                n_evaluations += 1
+            else:
+                next_k1 = end_rates
+            steps.append((start, state, k1, new_state, end_rates))
+            state, k1 = new_state, next_k1
+    else:
+        time = t[0]
+        largest_h = step_size if step_size is not None else t[-1] - t[0]
+        # dt is only the first guess, error control grows or shrinks the steps from there
+        proposed_h = min(numpy_model.dt, largest_h)
+        while time < t[-1]:
+            next_breakpoint = breakpoints[np.searchsorted(breakpoints, time, side="right")]
+            h = min(proposed_h, largest_h, next_breakpoint - time)
+            k = grid_index(time)
+            stages = [k1]
+            for c, a in zip(_DP_C, _DP_A):
+                new_state = combine(state, stages, [h * weight for weight in a])
+                stages.append(rates(time + c * h, k, new_state))
+            n_evaluations += len(_DP_C)
+            error = combine([0.0] * len(state), stages, [h * weight for weight in _DP_E])
+            error_norm = max(
+                (float(np.max(np.abs(e) / (ATOL + RTOL * np.maximum(np.abs(y0), np.abs(y1)))))
+                 for e, y0, y1 in zip(error, state, new_state)),
+                default=0.0,
+            )
+            factor = 5.0 if error_norm == 0 else min(5.0, max(0.2, 0.9 * error_norm ** -0.2))
+            if error_norm > 1 and h > MIN_STEP:
+                proposed_h = max(h * factor, MIN_STEP)
+                continue
+            at_breakpoint = h == next_breakpoint - time
+            stop = next_breakpoint if at_breakpoint else time + h
+            # the last stage is the rates at the new state, unless pulses change there
+            next_k1 = stages[-1]
+            if at_breakpoint:
+                next_k1 = rates(stop, grid_index(stop), new_state)
+                n_evaluations += 1
+            steps.append((time, state, k1, new_state, stages[-1]))
+            time, state, k1 = stop, new_state, next_k1
+            proposed_h = h * factor
+
+    print(f"{len(steps)} {'adaptive' if adaptive else 'rk4'} steps, {n_evaluations} evaluations")
+    grid_state = _hermite_to_grid(t, steps, batch_size)
+    namespace = _evaluate_on_grid(
+        numpy_model, sd_functions, smoothing, constants, pulses, inputs, grid_state[:n_stocks],
+        grid_state[n_stocks:],
+    )
+    return {
+        pk: np.array(np.broadcast_to(namespace.get(f"_E{pk}_", np.nan), (len(t), batch_size)))
+        for pk in output_pks
+    }
+
+
+def _hermite_to_grid(t: np.ndarray, steps: list, batch_size: int) -> list:
+    """ Values of each state variable on the grid t, shape (len(t), batch_size), from the steps of an integrator """
+    starts = np.array([start for start, _, _, _, _ in steps])
+    ends = np.append(starts[1:], t[-1])
+    j = np.clip(np.searchsorted(starts, t, side="right") - 1, 0, len(steps) - 1)
+    h = (ends - starts)[j][:, None]
+    s = (t - starts[j])[:, None] / h
+    h00, h10, h01, h11 = 2 * s ** 3 - 3 * s ** 2 + 1, s ** 3 - 2 * s ** 2 + s, 3 * s ** 2 - 2 * s ** 3, s ** 3 - s ** 2
+
+    def stack(values):
+        return np.stack([np.broadcast_to(value, (batch_size,)) for value in values])[j]
+
+    grid_state = []
+    for i in range(len(steps[0][1])):
+        y0, f0, y1, f1 = (stack([step[n][i] for step in steps]) for n in range(1, 5))
+        grid_state.append(h00 * y0 + h10 * h * f0 + h01 * y1 + h11 * h * f1)
+    return grid_state
+
+
+def _evaluate_on_grid(
+        numpy_model: NumpyModel, sd_functions, smoothing, constants, pulses, inputs, stocks: list, smooth_values: list,
+) -> dict:
+    """ Evaluate every element at all times of the grid at once, from stocks and smoothing stocks on the grid
+    Values have shape (len(t), batch_size), or broadcast to it.
+    """
+    t = numpy_model.t
+    sd_functions.t = t[:, None]
+    namespace = {}
+    for pk, value in constants.items():
+        namespace[f"_E{pk}_"] = value
+    for pk in numpy_model.pulse_pks:
+        namespace[f"_E{pk}_"] = np.reshape(pulses[pk], (-1, len(t))).T if pk in pulses else 0.0
+    for pk, values in inputs.items():
+        namespace[f"_E{pk}_"] = np.reshape(values, (len(t), -1))
+    for pk, value in zip(numpy_model.stocks, stocks):
+        namespace[f"_E{pk}_"] = value
+    smoothing.values = list(smooth_values)
+    smoothing.slot = 0
+    namespace.update(numpy_model.equations.function(
+        namespace, sd_functions, _smooth, _delay, smoothing, _variable_value, _flow_value
+    ))
+    smoothing.finish()
+    return namespace
+
+
+def simulate(
+        numpy_model: NumpyModel, constants: dict, pulses: dict, output_pks: list, integrator: str = "euler",
+        step_size: float = None,
+) -> pd.DataFrame:
+    """ Run the model for one set of constants and pulses, return the results with one column per output
+    Same format as the BPTK results, so they can be formatted and saved the same way.
+    """
+    results = integrate(
+        numpy_model, constants, pulses, output_pks, integrator=integrator, step_size=step_size
+    )
+    df = pd.DataFrame({pk: values[:, 0] for pk, values in results.items()})
+    df.insert(0, "t", numpy_model.t.astype(int))
+    return df
+
+
+def stack_runs(numpy_model: NumpyModel, runs: list) -> tuple[dict, dict]:
+    """ Stack the constants and pulses of several runs, given as (constants, pulses), along a batch axis
+    Constants that are the same in every run are kept as floats.
+    """
+    constants = {}
+    for pk in set().union(*[run_constants.keys() for run_constants, _ in runs]):
+        default = numpy_model.constant_defaults.get(pk, 0.0)
+        values = np.array([run_constants.get(pk, default) for run_constants, _ in runs], dtype=float)
+        constants[pk] = float(values[0]) if np.all(values == values[0]) else values
+    pulses = {
+        pk: np.stack([run_pulses.get(pk, np.zeros(len(numpy_model.t))) for _, run_pulses in runs])
+        for pk in set().union(*[run_pulses.keys() for _, run_pulses in runs])
+    }
+    return constants, pulses
+
+
+def simulate_batch(
+        numpy_model: NumpyModel, runs: list, output_pks: list, integrator: str = "euler", step_size: float = None,
+        inputs: dict = None,
+) -> list[pd.DataFrame]:
+    """ Run the model for several sets of (constants, pulses) in a single pass
+    Returns one DataFrame per run, in the same format as simulate.
+    inputs replace the model's inputs, as arrays of shape (len(t), len(runs)), see integrate.
+    """
+    constants, pulses = stack_runs(numpy_model, runs)
+    results = integrate(
+        numpy_model, constants, pulses, output_pks, batch_size=len(runs), integrator=integrator, step_size=step_size,
+        inputs=inputs,
+    )
+    t = numpy_model.t.astype(int)
+    dfs = []
+    for i in range(len(runs)):
+        df = pd.DataFrame({pk: values[:, i] for pk, values in results.items()})
+        df.insert(0, "t", t)
+        dfs.append(df)
+    return dfs
+
+
+def sample_inputs(numpy_model: NumpyModel, n_samples: int, rng: np.random.Generator) -> dict:
+    """ Sample trajectories of the inputs that have forecast intervals, as arrays of shape (len(t), n_samples)
+    Each sample shifts all forecast points of an input by the same number of standard deviations.
+    """
+    inputs = {}
+    for pk, sds in numpy_model.input_sds.items():
+        points = np.asarray(numpy_model.points[pk], dtype=float)
+        order = np.argsort(points[:, 0], kind="stable")
+        xp, fp, sds = points[order, 0], points[order, 1], np.asarray(sds, dtype=float)[order]
+        z = rng.standard_normal(n_samples)
+        samples = fp[None, :] + z[:, None] * sds[None, :]
+        inputs[pk] = np.stack([np.interp(numpy_model.t, xp, sample) for sample in samples], axis=1)
+    return inputs
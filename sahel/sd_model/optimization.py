@@ -0,0 +1,264 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+from ..models import Variable, ResponseOption, ResponseConstantValue, PulseValue
+from . import input_arrays, model_operations, numpy_engine, profiling
+
+# Search for the response that does most for an outcome within a budget, with the cross-entropy method: each
+# generation samples a population of designs around the current mean, simulates them together in one numpy batch, and
+# moves the mean and spread towards the best of them.
+# A design is a value for each searched Response Constant, and a height and start date for each searched Pulse Input.
+# Its cost is the cost element summed over the run as in read_results, above the cost of the baseline response, and
+# designs over the budget rank below every design within it, by how much they are over.
+# The best designs are saved as new ResponseOptions, with the values of the base response for everything not searched.
+
+POPULATION = 200
+GENERATIONS = 20
+# designs simulated together in one batch, limits memory for large populations
+BATCH_SIZE = 1000
+# fraction of each generation the next one is sampled around
+ELITE_FRACTION = 0.1
+# how much of the elites' mean and spread each generation moves to
+SMOOTHING = 0.7
+# spread of a generation, in the unit hypercube, never goes below this, so the search doesn't stall early
+MIN_STD = 0.02
+
+
+def _windows(days: int = None) -> tuple[float, float]:
+    """ Start and stop of a pulse relative to its start date, the same as input_arrays.pulse_window """
+    start = date(2000, 1, 1)
+    enddate = None if days is None else start + timedelta(days=days - 1)
+    low, high = input_arrays.pulse_window(start, enddate)
+    return low - start.toordinal(), high - start.toordinal()
+
+
+def _total_cost(values: np.ndarray, period: float) -> np.ndarray:
+    """ Cost of runs summed over time (axis 0), as read_results sums the cost element, whatever its unit """
+    return values.sum(axis=0) * period / model_operations.DAYS_IN_MONTH
+
+
+def _order(score: np.ndarray, excess: np.ndarray) -> np.ndarray:
+    """ Indices of designs from best to worst, designs within budget (excess 0) first, then by score """
+    score = np.where(np.isnan(score), -np.inf, score)
+    return np.lexsort((-score, excess))
+
+
+def run_optimization(
+        samramodel_pk: int,
+        adm0: str,
+        element_pk: int,
+        budget: float,
+        constant_ranges: dict = None,
+        pulse_ranges: dict = None,
+        pulse_days: int = None,
+        earliest: date = None,
+        latest: date = None,
+        maximize: bool = True,
+        agg_value: str = None,
+        population: int = POPULATION,
+        generations: int = GENERATIONS,
+        n_best: int = 3,
+        scenario_pk: int = 1,
+        response_pk: int = None,
+        cost_element_pk: int = 102,
+        baseline_response_pk: int = 1,
+        seed: int = None,
+        name: str = "Optimisation",
+        startdate: date = date(2023, 1, 1),
+        enddate: date = date(2025, 1, 1),
+        timestep: int = 2,
+) -> list[ResponseOption]:
+    """ Search for the responses with the best aggregated outcome whose cost is within budget, and save them
+    constant_ranges is {Response Constant pk: (low, high)}, pulse_ranges is {Pulse Input pk: (low, high)} for the
+    height of one pulse of each, starting between earliest and latest and lasting pulse_days, or the default window.
+    The other constants and pulses are those of response_pk, by default the baseline response.
+    Returns the n_best designs within budget, as new ResponseOptions.
+    """
+    constant_ranges = {str(pk): value for pk, value in (constant_ranges or {}).items()}
+    pulse_ranges = {str(pk): value for pk, value in (pulse_ranges or {}).items()}
+    if not constant_ranges and not pulse_ranges:
+        raise ValueError("give at least one constant or pulse to search")
+    if response_pk is None:
+        response_pk = baseline_response_pk
+    sd_types = dict(Variable.objects.filter(pk__in=[*constant_ranges, *pulse_ranges]).values_list("pk", "sd_type"))
+    invalid = [pk for pk in constant_ranges if sd_types.get(int(pk)) != Variable.RESPONSE_CONSTANT]
+    invalid += [pk for pk in pulse_ranges if sd_types.get(int(pk)) != Variable.RESPONSE_PULSE]
+    if invalid:
+        raise ValueError(f"{invalid} are not Response Constants or Pulse Inputs")
+    element = Variable.objects.get(pk=element_pk)
+    if agg_value is None:
+        agg_value = element.aggregate_by
+    sign = 1.0 if maximize else -1.0
+
+    with profiling.profile("run_optimization", population=population, generations=generations) as root:
+        with profiling.span("init"):
+            compiled = model_operations.get_compiled_model(
+                int(samramodel_pk), adm0, None, None, startdate, enddate, timestep, engine="numpy",
+                output_pks=[str(element_pk), str(cost_element_pk)],
+            )
+            numpy_model = compiled.model
+            t = numpy_model.t
+            with compiled.lock:
+                response_pks = list(dict.fromkeys([response_pk, baseline_response_pk]))
+                runs = model_operations.collect_runs(compiled.definition.elements, [scenario_pk], response_pks, adm0, t)
+            base_constants, base_pulses = runs[0][2], runs[0][3]
+            baseline_constants, baseline_pulses = runs[-1][2], runs[-1][3]
+            missing = [pk for pk in constant_ranges if pk not in numpy_model.constant_defaults]
+            missing += [pk for pk in pulse_ranges if pk not in base_pulses]
+            if missing:
+                print(f"{missing} don't affect {element}, their values are chosen at random")
+
+            constant_pks, pulse_pks = list(constant_ranges), list(pulse_ranges)
+            ranges = [constant_ranges[pk] for pk in constant_pks] + [pulse_ranges[pk] for pk in pulse_pks]
+            lows, highs = np.array(ranges, dtype=float).T
+            start_offset, stop_offset = _windows(pulse_days)
+            first_day = (earliest or startdate).toordinal()
+            last_day = (latest or enddate - timedelta(days=pulse_days or 1)).toordinal()
+            if last_day < first_day:
+                raise ValueError(f"pulses can't start between {earliest or startdate} and {latest}")
+
+        def decode(x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            """ Values, and pulse start days as date ordinals, of designs in the unit hypercube """
+            n_values = len(constant_pks) + len(pulse_pks)
+            values = lows + x[:, :n_values] * (highs - lows)
+            starts = np.round(first_day + x[:, n_values:] * (last_day - first_day))
+            return values, starts
+
+        def evaluate(x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+            """ Aggregated outcome and cost of designs """
+            values, starts = decode(x)
+            outcomes = np.empty(len(x))
+            costs = np.empty(len(x))
+            for batch_start in range(0, len(x), BATCH_SIZE):
+                batch = slice(batch_start, batch_start + BATCH_SIZE)
+                constants = base_constants | {pk: values[batch, i] for i, pk in enumerate(constant_pks)}
+                pulses = dict(base_pulses)
+                for j, pk in enumerate(pulse_pks):
+                    active = ((t[None, :] > starts[batch, j, None] + start_offset)
+                              & (t[None, :] < starts[batch, j, None] + stop_offset))
+                    pulses[pk] = values[batch, len(constant_pks) + j, None] * active
+                results = numpy_engine.integrate(
+                    numpy_model, constants, pulses, [str(element_pk), str(cost_element_pk)],
+                    batch_size=len(values[batch]),
+                )
+                outcomes[batch] = model_operations.aggregate_values(
+                    results[str(element_pk)], agg_value, element.unit, numpy_model.dt
+                )
+                costs[batch] = _total_cost(results[str(cost_element_pk)], numpy_model.dt)
+            return outcomes, costs
+
+        with profiling.span("baseline"):
+            baseline = numpy_engine.integrate(
+                numpy_model, baseline_constants, baseline_pulses, [str(element_pk), str(cost_element_pk)]
+            )
+            baseline_value = model_operations.aggregate_values(
+                baseline[str(element_pk)], agg_value, element.unit, numpy_model.dt
+            )[0]
+            baseline_cost = _total_cost(baseline[str(cost_element_pk)], numpy_model.dt)[0]
+
+        with profiling.span("search") as search:
+            rng = np.random.default_rng(seed)
+            n_dims = len(constant_pks) + 2 * len(pulse_pks)
+            mean = np.full(n_dims, 0.5)
+            std = np.full(n_dims, 0.3)
+            n_elites = max(2, int(population * ELITE_FRACTION))
+            designs, outcomes, costs = [], [], []
+            for generation in range(generations):
+                x = np.clip(rng.normal(mean, std, size=(population, n_dims)), 0.0, 1.0)
+                outcome, cost = evaluate(x)
+                excess = np.maximum(cost - baseline_cost - budget, 0.0)
+                elites = x[_order(sign * outcome, excess)[:n_elites]]
+                mean = SMOOTHING * elites.mean(axis=0) + (1 - SMOOTHING) * mean
+                std = np.maximum(SMOOTHING * elites.std(axis=0) + (1 - SMOOTHING) * std, MIN_STD)
+                designs.append(x)
+                outcomes.append(outcome)
+                costs.append(cost)
+            designs, outcomes, costs = np.concatenate(designs), np.concatenate(outcomes), np.concatenate(costs)
+            search.counts["evaluations"] = len(designs)
+
+        with profiling.span("save") as save:
+            excess = np.maximum(costs - baseline_cost - budget, 0.0)
+            values, starts = decode(designs)
+            best, seen = [], set()
+            for i in _order(sign * outcomes, excess):
+                if len(best) == n_best or excess[i] > 0:
+                    break
+                # designs that differ only where it makes no difference, e.g. the start of a pulse of 0, are the same
+                key = f"{outcomes[i]:.6g} {costs[i]:.6g}"
+                if key not in seen:
+                    seen.add(key)
+                    best.append(i)
+            if not best:
+                print(f"no design costs less than {budget} above the baseline response, nothing saved")
+            responseoptions = save_designs(
+                samramodel_pk, adm0, element, [values[i] for i in best], [starts[i] for i in best], constant_pks,
+                pulse_pks, pulse_days, response_pk, name,
+                [
+                    f"{agg_value} {element.label}: {outcomes[i]:.4g} ({outcomes[i] - baseline_value:+.4g}), "
+                    f"coût {costs[i] - baseline_cost:.4g} / budget {budget:.4g}, scénario {scenario_pk}"
+                    for i in best
+                ],
+            )
+            save.counts["responses"] = len(responseoptions)
+        root.counts["evaluations"] = len(designs)
+
+    for responseoption, i in zip(responseoptions, best):
+        extra_cost = costs[i] - baseline_cost
+        cost_eff = (outcomes[i] - baseline_value) / extra_cost if extra_cost else np.nan
+        print(f"{responseoption}: {agg_value} {outcomes[i]:.4g}, cost {extra_cost:.4g}, cost_eff {cost_eff:.4g}")
+    return responseoptions
+
+
+def save_designs(
+        samramodel_pk: int,
+        adm0: str,
+        element: Variable,
+        values: list,
+        starts: list,
+        constant_pks: list,
+        pulse_pks: list,
+        pulse_days: int,
+        response_pk: int,
+        name: str,
+        descriptions: list,
+) -> list[ResponseOption]:
+    """ Save designs as ResponseOptions, copying the constants and pulses of response_pk that weren't searched """
+    base_constants = ResponseConstantValue.objects.filter(responseoption_id=response_pk, admin0=adm0).exclude(
+        element_id__in=[int(pk) for pk in constant_pks]
+    )
+    base_pulses = PulseValue.objects.filter(responseoption_id=response_pk, admin0=adm0).exclude(
+        element_id__in=[int(pk) for pk in pulse_pks]
+    )
+    responseoptions = []
+    constant_values = []
+    pulse_values = []
+    for rank, (design_values, design_starts, description) in enumerate(zip(values, starts, descriptions), start=1):
+        responseoption = ResponseOption.objects.create(
+            name=f"{name} {element.label} {rank}", description=description, samramodel_id=samramodel_pk
+        )
+        responseoptions.append(responseoption)
+        constant_values += [
+            ResponseConstantValue(element_id=value.element_id, responseoption=responseoption, admin0=adm0,
+                                  value=value.value)
+            for value in base_constants
+        ] + [
+            ResponseConstantValue(element_id=int(pk), responseoption=responseoption, admin0=adm0,
+                                  value=float(design_values[i]))
+            for i, pk in enumerate(constant_pks)
+        ]
+        pulse_values += [
+            PulseValue(element_id=value.element_id, responseoption=responseoption, admin0=adm0, value=value.value,
+                       startdate=value.startdate, enddate=value.enddate)
+            for value in base_pulses
+        ]
+        for j, pk in enumerate(pulse_pks):
+            pulse_start = date.fromordinal(int(design_starts[j]))
+            pulse_values.append(PulseValue(
+                element_id=int(pk), responseoption=responseoption, admin0=adm0,
+                value=float(design_values[len(constant_pks) + j]), startdate=pulse_start,
+                enddate=None if pulse_days is None else pulse_start + timedelta(days=pulse_days - 1),
+            ))
+    ResponseConstantValue.objects.bulk_create(constant_values)
+    PulseValue.objects.bulk_create(pulse_values)
+    return responseoptions
@@ -0,0 +1,166 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import django
+from django.apps import apps
+from django.db import connections
+from django.utils import timezone
+
+from . import model_operations, run_registry, stale_results
+
+
+def make_jobs(
+        scenario_pks: list[int],
+        response_pks: list[int],
+        samramodel_pks: list[int],
+        adm0s: list[str],
+        adm1: str = None,
+        adm2: str = None,
+        startdate: date = date(2022, 7, 1),
+        enddate: date = date(2024, 7, 1),
+        timestep: int = 2,
+        use_cache: bool = True,
+        engine: str = "bptk",
+        batch: bool = True,
+        output_pks: list[str] = None,
+        integrator: str = "euler",
+        step_size: float = None,
+        reuse: bool = True,
+) -> list[dict]:
+    """ Split a run into independent jobs, each a dict of run_model arguments
+    with the numpy engine in batch mode all combinations of a model and admin0 are one job,
+    otherwise each (scenario, response) combination is its own job
+    """
+    jobs = []
+    for samramodel_pk in samramodel_pks:
+        for adm0 in adm0s:
+            common = dict(
+                samramodel_pk=int(samramodel_pk), adm0=adm0, adm1=adm1, adm2=adm2, startdate=startdate,
+                enddate=enddate, timestep=timestep, use_cache=use_cache, engine=engine, batch=batch,
+                output_pks=output_pks, integrator=integrator, step_size=step_size, reuse=reuse,
+            )
+            if engine == "numpy" and batch:
+                jobs.append(dict(scenario_pks=list(scenario_pks), response_pks=list(response_pks), **common))
+                continue
+            for scenario_pk in scenario_pks:
+                for response_pk in response_pks:
+                    jobs.append(dict(scenario_pks=[scenario_pk], response_pks=[response_pk], **common))
+    return jobs
+
+
+def run_jobs(jobs: list[dict], workers: int = 1):
+    """ Run jobs from make_jobs over a pool of processes, then write results back in job order
+    each worker opens its own database connection, results are only saved from this process
+    """
+    start = time.time()
+    run_started = timezone.now()
+    timings = []
+    if workers > 1:
+        # connections can't be shared with forked workers, they reconnect on first query
+        connections.close_all()
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+            futures = [executor.submit(_run_job, job) for job in jobs]
+            for job, future in zip(jobs, futures):
+                timings.append(_save_job(job, future.result(), run_started))
+    else:
+        for job in jobs:
+            timings.append(_save_job(job, _run_job(job), run_started))
+
+    print_timings(timings)
+    print(f"ran {len(jobs)} jobs on {workers} workers in {time.time() - start} s")
+    return timings
+
+
+def _init_worker():
+    # spawned workers (e.g. on Windows) start without Django set up
+    if not apps.ready:
+        django.setup()
+    connections.close_all()
+
+
+def _run_job(job: dict) -> dict:
+    """ Build (or get from this process's cache) and simulate the model for one job, without saving """
+    start = time.time()
+    if job["adm0"] not in model_operations.ADMIN0S:
+        raise ValueError(f"invalid admin0 {job['adm0']}")
+    compiled = model_operations.get_compiled_model(
+        job["samramodel_pk"], job["adm0"], job["adm1"], job["adm2"], job["startdate"], job["enddate"],
+        job["timestep"], engine=job["engine"], use_cache=job["use_cache"], output_pks=job["output_pks"],
+    )
+    built = time.time()
+    with compiled.lock:
+        model_output_pks = compiled.definition.model_output_pks.copy()
+        runs = model_operations.collect_runs(
+            compiled.definition.elements, job["scenario_pks"], job["response_pks"], job["adm0"], compiled.definition.t
+        )
+        hashes = run_registry.run_hashes(
+            run_registry.model_digest(
+                compiled, job["adm0"], job["adm1"], job["adm2"], job["integrator"], job["step_size"]
+            ),
+            runs, {str(element.pk) for element in compiled.definition.elements},
+        )
+        reused = run_registry.reusable_runs(
+            job["samramodel_pk"], runs, hashes, job["adm0"], job["adm1"], job["adm2"]
+        ) if job["reuse"] else set()
+        pending = [i for i in range(len(runs)) if i not in reused]
+        dfs = model_operations.simulate_runs(
+            compiled, [runs[i] for i in pending], model_output_pks, batch=job["batch"], integrator=job["integrator"],
+            step_size=job["step_size"],
+        ) if pending else []
+    simulated = time.time()
+    return {
+        "runs": [(runs[i][0], runs[i][1], hashes[i]) for i in pending],
+        "reused": [(runs[i][0], runs[i][1]) for i in sorted(reused)],
+        "dfs": dfs,
+        "model_output_pks": model_output_pks,
+        "engine": compiled.engine,
+        "build": built - start,
+        "simulate": simulated - built,
+    }
+
+
+def _save_job(job: dict, result: dict, run_started) -> dict:
+    start = time.time()
+    if job["adm1"] is None:
+        for scenario_pk, responseoption_pk in result["reused"]:
+            stale_results.clear_stale([scenario_pk], [responseoption_pk], job["adm0"], run_started)
+    for (scenario_pk, responseoption_pk, input_hash), df in zip(result["runs"], result["dfs"]):
+        save_start = time.time()
+        run = run_registry.start_run(
+            job["samramodel_pk"], scenario_pk, responseoption_pk, job["adm0"], job["adm1"], job["adm2"], input_hash,
+            result["engine"], job["startdate"], job["enddate"], job["timestep"],
+        )
+        try:
+            n_values = model_operations.save_results(
+                df, scenario_pk, responseoption_pk, job["adm0"], result["model_output_pks"],
+                replace_all=job["output_pks"] is None, adm1=job["adm1"], adm2=job["adm2"], run=run,
+            )
+        except Exception:
+            run_registry.fail_runs([run])
+            raise
+        run_registry.finish_run(
+            run, n_values, result["simulate"] / len(result["runs"]), time.time() - save_start,
+            element_pks=None if job["output_pks"] is None else result["model_output_pks"],
+        )
+        if job["adm1"] is None:
+            stale_results.clear_stale([scenario_pk], [responseoption_pk], job["adm0"], run_started)
+    return {
+        "model": job["samramodel_pk"],
+        "adm0": job["adm0"],
+        "scenarios": job["scenario_pks"],
+        "responses": job["response_pks"],
+        "build": result["build"],
+        "simulate": result["simulate"],
+        "save": time.time() - start,
+    }
+
+
+def print_timings(timings: list[dict]):
+    print(f"{'model':>6} {'adm0':<12} {'scenarios':<12} {'responses':<12} "
+          f"{'build':>8} {'simulate':>9} {'save':>8} {'total':>8}")
+    for timing in timings:
+        total = timing["build"] + timing["simulate"] + timing["save"]
+        print(f"{timing['model']:>6} {timing['adm0']:<12} {str(timing['scenarios']):<12} "
+              f"{str(timing['responses']):<12} {timing['build']:>8.2f} {timing['simulate']:>9.2f} "
+              f"{timing['save']:>8.2f} {total:>8.2f}")
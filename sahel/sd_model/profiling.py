@@ -0,0 +1,169 @@
+import cProfile
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.utils import timezone
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# Nested spans timing the phases of a run (init, elements, inputs, equations, constants, simulate, format, write, ...).
+# Each span records how long it took, counts such as rows or runs, and the peak memory of the process when it ended,
+# and is printed as it ends like the other timings. A span opened while another is open in the same thread is its
+# child, the outermost span of a run_model call is written as one JSON line to settings.SIMULATION_PROFILE_LOG and to
+# the SimulationRuns it saved, so phases can be compared between runs.
+# capture=True also runs cProfile and tracemalloc for the whole span, and records the traced peak of each span.
+
+# functions printed from a cProfile capture
+PROFILE_TOP_FUNCTIONS = 25
+
+_local = threading.local()
+
+
+@dataclass
+class Span:
+    name: str
+    counts: dict = field(default_factory=dict)
+    seconds: float = 0.0
+    # peak resident memory of the process at the end of the span
+    max_rss_kb: int = None
+    # peak memory traced by tracemalloc during the span, only with capture
+    peak_traced_kb: int = None
+    children: list = field(default_factory=list)
+    # peak traced before the last child reset it
+    _peak_before_children: int = field(default=0, repr=False)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name, "seconds": self.seconds, "counts": self.counts, "max_rss_kb": self.max_rss_kb,
+            "peak_traced_kb": self.peak_traced_kb, "children": [child.to_dict() for child in self.children],
+        }
+
+
+def _stack() -> list:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _max_rss_kb():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return max_rss // 1024 if sys.platform == "darwin" else max_rss
+
+
+@contextmanager
+def span(name: str, **counts):
+    """ Time a phase, as a child of the span open in this thread, and print how long it took
+    counts are recorded with it, more can be added to span.counts inside the block.
+    """
+    stack = _stack()
+    current = Span(name, counts=dict(counts))
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # each span measures its own peak, the parent keeps what it reached so far
+        if stack:
+            stack[-1]._peak_before_children = max(stack[-1]._peak_before_children, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    if stack:
+        stack[-1].children.append(current)
+    stack.append(current)
+    start = time.time()
+    try:
+        yield current
+    finally:
+        current.seconds = time.time() - start
+        stack.pop()
+        current.max_rss_kb = _max_rss_kb()
+        if tracing and tracemalloc.is_tracing():
+            peak = max(current._peak_before_children, tracemalloc.get_traced_memory()[1])
+            current.peak_traced_kb = peak // 1024
+            if stack:
+                stack[-1]._peak_before_children = max(stack[-1]._peak_before_children, peak)
+        counts_text = "".join(f", {key} {value}" for key, value in current.counts.items())
+        print(f"{name} took {current.seconds} s{counts_text}")
+
+
+@contextmanager
+def profile(name: str, capture: bool = False, **counts):
+    """ Outermost span of a run, written to the profile log when it ends, see span
+    capture runs cProfile and tracemalloc for the span, and prints the slowest functions and largest allocations.
+    """
+    started = timezone.now()
+    profiler = None
+    if capture:
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with span(name, **counts) as root:
+            yield root
+    finally:
+        if capture:
+            profiler.disable()
+            _print_capture(profiler, tracemalloc.take_snapshot())
+            tracemalloc.stop()
+        print_tree(root)
+        write_log(root, started)
+
+
+def _print_capture(profiler, snapshot):
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+    print(output.getvalue())
+    for statistic in snapshot.statistics("lineno")[:10]:
+        print(statistic)
+
+
+def print_tree(root: Span, depth: int = 0):
+    counts_text = " ".join(f"{key}={value}" for key, value in root.counts.items())
+    print(f"{'  ' * depth}{root.name:<{30 - 2 * depth}} {root.seconds:>9.3f} s  {counts_text}")
+    for child in root.children:
+        print_tree(child, depth + 1)
+
+
+def to_json(root: Span, started=None) -> str:
+    record = root.to_dict()
+    if started is not None:
+        record["started"] = started.isoformat()
+    return json.dumps(record, default=str)
+
+
+def write_log(root: Span, started=None):
+    """ Append a span, with its children, as one JSON line to settings.SIMULATION_PROFILE_LOG if it is set """
+    path = getattr(settings, "SIMULATION_PROFILE_LOG", "")
+    if not path:
+        return
+    try:
+        with open(path, "a") as file:
+            file.write(to_json(root, started) + "\n")
+    except OSError as error:
+        print(f"couldn't write profile to {path}: {error}")
+
+
+def read_log(path: str) -> list[dict]:
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def phase_seconds(record: dict, prefix: str = "") -> dict:
+    """ Seconds of every phase of a logged span, by path (e.g. "run_model/init/inputs"), repeated phases summed """
+    path = f"{prefix}/{record['name']}" if prefix else record["name"]
+    seconds = {path: record["seconds"]}
+    for child in record["children"]:
+        for child_path, child_seconds in phase_seconds(child, path).items():
+            seconds[child_path] = seconds.get(child_path, 0.0) + child_seconds
+    return seconds
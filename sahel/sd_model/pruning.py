@@ -0,0 +1,57 @@
+from dataclasses import replace
+
+from ..models import VariableConnection
+from . import equations, profiling
+
+
+def upstream_pks(definition, output_pks: list[str]) -> set[str]:
+    """ pks of every element the outputs depend on, including the outputs themselves
+    Follows the references in equations and the VariableConnections drawn in the model, and for stocks their
+    inflows, outflows and initial value.
+    """
+    pks = {str(element.pk) for element in definition.elements}
+    upstream = {pk: set() for pk in pks}
+    for element in definition.elements:
+        if element.sd_type in ["Variable", "Flow"] and element.equation:
+            _, refs, _ = equations.check_equation(element.equation)
+            upstream[str(element.pk)] |= refs
+    for from_pk, to_pk in VariableConnection.objects.filter(
+            to_variable__samramodel_id=definition.samramodel_pk).values_list("from_variable_id", "to_variable_id"):
+        if str(to_pk) in upstream:
+            upstream[str(to_pk)].add(str(from_pk))
+    for pk, stock in definition.stocks.items():
+        upstream[pk] |= {flow_pk for flow_pk, _ in stock["inflows"] + stock["outflows"]}
+        if stock["initial_value_pk"] is not None:
+            upstream[pk].add(stock["initial_value_pk"])
+
+    needed = set()
+    to_visit = [pk for pk in output_pks if pk in pks]
+    while to_visit:
+        pk = to_visit.pop()
+        if pk in needed:
+            continue
+        needed.add(pk)
+        to_visit.extend(ref for ref in upstream[pk] if ref in pks and ref not in needed)
+    return needed
+
+
+def prune_definition(definition, output_pks: list[str]):
+    """ Copy of a ModelDefinition with only what is needed to simulate output_pks, which become its outputs """
+    output_pks = [str(pk) for pk in output_pks]
+    with profiling.span("prune", elements=len(definition.elements)) as prune_span:
+        needed = upstream_pks(definition, output_pks)
+        missing = [pk for pk in output_pks if pk not in needed]
+        if missing:
+            print(f"outputs {missing} are not in the model")
+        pruned = replace(
+            definition,
+            elements=[element for element in definition.elements if str(element.pk) in needed],
+            model_output_pks=[pk for pk in output_pks if pk in needed],
+            stocks={pk: stock for pk, stock in definition.stocks.items() if pk in needed},
+            input_points={pk: points for pk, points in definition.input_points.items() if pk in needed},
+            input_values={pk: value for pk, value in definition.input_values.items() if pk in needed},
+            input_sds={pk: sds for pk, sds in definition.input_sds.items() if pk in needed},
+            input_arrays={pk: values for pk, values in definition.input_arrays.items() if pk in needed},
+        )
+        prune_span.counts["kept"] = len(pruned.elements)
+    return pruned
@@ -0,0 +1,122 @@
+import zlib
+from datetime import date
+
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import transaction
+
+from ..models import Variable, SimulatedDataPoint, SimulatedSeries
+from . import profiling
+
+# Simulation results are saved either as one SimulatedDataPoint per element and date ("rows"), or as one
+# SimulatedSeries per element and run, holding all its values as a compressed array ("series").
+# settings.SIMULATION_RESULT_STORAGE chooses which one is written and read, read_points reads either into the same
+# DataFrame, so readers don't depend on the storage.
+# Only results of current SimulationRuns, or saved without a run, are read, see run_registry.py
+
+ROWS = "rows"
+SERIES = "series"
+STORAGES = [ROWS, SERIES]
+COMPRESSION_LEVEL = 6
+BATCH_SIZE = 500
+
+
+def storage() -> str:
+    return getattr(settings, "SIMULATION_RESULT_STORAGE", ROWS)
+
+
+def encode(values: np.ndarray) -> bytes:
+    """ Compress an array of floats
+    The bytes are shuffled first (all first bytes, then all second bytes, ...), so the signs and exponents of
+    neighbouring values, which rarely change, end up next to each other and compress well.
+    """
+    raw = np.ascontiguousarray(values, dtype="<f8").view(np.uint8).reshape(-1, 8)
+    return zlib.compress(raw.T.tobytes(), COMPRESSION_LEVEL)
+
+
+def decode(data: bytes, n_points: int) -> np.ndarray:
+    shuffled = np.frombuffer(zlib.decompress(bytes(data)), dtype=np.uint8).reshape(8, n_points)
+    return np.ascontiguousarray(shuffled.T).view("<f8").ravel()
+
+
+def replace_series(
+        df: pd.DataFrame,
+        scenario_pk: int,
+        responseoption_pk: int,
+        adm0: str,
+        adm1: str = None,
+        adm2: str = None,
+        element_pks: list = None,
+        run_pk: int = None,
+) -> int:
+    """ Replace the SimulatedSeries of a scenario, response and admin unit with the results of a run
+    df has a column t of date ordinals on a regular grid, and one column of values per element pk.
+    element_pks limits the delete to those elements, by default all results of the admin unit are replaced.
+    With run_pk, series are saved for that SimulationRun and nothing is deleted.
+    Returns the number of series written.
+    """
+    with profiling.span("save series") as save_span:
+        t = df["t"].to_numpy()
+        startdate = date.fromordinal(int(t[0]))
+        timestep = int(t[1] - t[0]) if len(t) > 1 else 1
+        series = [
+            SimulatedSeries(
+                element_id=int(pk), scenario_id=scenario_pk, responseoption_id=responseoption_pk, admin0=adm0,
+                admin1=adm1, admin2=adm2, startdate=startdate, timestep=timestep, n_points=len(t),
+                values=encode(df[pk].to_numpy(dtype=float)), run_id=run_pk,
+            )
+            for pk in df.columns if pk != "t"
+        ]
+        with transaction.atomic():
+            old_series = SimulatedSeries.objects.filter(
+                scenario_id=scenario_pk, responseoption_id=responseoption_pk, admin0=adm0, admin1=adm1, admin2=adm2
+            )
+            if element_pks is not None:
+                old_series = old_series.filter(element_id__in=[int(pk) for pk in element_pks])
+            if run_pk is None:
+                old_series.delete()
+            SimulatedSeries.objects.bulk_create(series, batch_size=BATCH_SIZE)
+        n_bytes = sum(len(one_series.values) for one_series in series)
+        save_span.counts.update(series=len(series), points=len(t), bytes=n_bytes)
+    return len(series)
+
+
+def read_points(fields: list, **filters) -> pd.DataFrame:
+    """ Simulated values matching filters as a DataFrame of fields, from the configured storage
+    Same as pd.DataFrame(SimulatedDataPoint.objects.filter(**filters).values(*fields)), fields can include "date"
+    and "value", but with series storage filters can't.
+    """
+    if storage() == ROWS:
+        return pd.DataFrame(
+            SimulatedDataPoint.objects.filter(**filters).exclude(run__current=False).values(*fields)
+        )
+
+    with profiling.span("read series") as read_span:
+        series_fields = [field for field in fields if field not in ["date", "value"]]
+        rows = SimulatedSeries.objects.filter(**filters).exclude(run__current=False).values(
+            *series_fields, "startdate", "timestep", "n_points", "values"
+        )
+        frames = []
+        for row in rows:
+            dates = np.datetime64(row["startdate"], "D") + row["timestep"] * np.arange(row["n_points"])
+            columns = {
+                # dates as datetime.date, like DateFields read through the ORM
+                "date": dates.astype(object),
+                "value": decode(row["values"], row["n_points"]),
+            }
+            frames.append(pd.DataFrame(
+                {field: columns.get(field, row.get(field)) for field in fields}, index=pd.RangeIndex(row["n_points"])
+            ))
+        if not frames:
+            return pd.DataFrame()
+        df = pd.concat(frames, ignore_index=True)
+        read_span.counts.update(series=len(frames), points=len(df))
+    return df
+
+
+def simulated_elements():
+    """ Variables that have simulated results in the configured storage """
+    if storage() == ROWS:
+        return Variable.objects.exclude(simulateddatapoints=None)
+    return Variable.objects.exclude(simulatedseries=None)
@@ -0,0 +1,94 @@
+import csv
+import io
+import itertools
+
+from django.db import connection, transaction
+
+from ..models import SimulatedDataPoint
+from . import profiling
+
+# Writes simulation results in chunks of bounded size, with the fastest bulk insert of each database backend:
+# COPY on PostgreSQL, pyodbc's fast_executemany on MSSQL, and executemany otherwise (SQLite).
+# Old results are deleted and new ones inserted in the same transaction, so readers never see a partial run.
+# Results of a SimulationRun are only inserted, old results are replaced when the run is finished, see run_registry.py
+
+# rows held in memory, and sent to the database, at a time
+CHUNK_ROWS = 10000
+TABLE = SimulatedDataPoint._meta.db_table
+COLUMNS = ["element_id", "value", "date", "scenario_id", "responseoption_id", "admin0", "admin1", "admin2", "run_id"]
+
+
+def replace_results(
+        rows,
+        scenario_pk: int,
+        responseoption_pk: int,
+        adm0: str,
+        adm1: str = None,
+        adm2: str = None,
+        element_pks: list = None,
+        run_pk: int = None,
+) -> int:
+    """ Replace the SimulatedDataPoints of a scenario, response and admin unit with rows
+    rows is an iterable of (element pk, value, date), it is read one chunk at a time so it can be a generator.
+    element_pks limits the delete to those elements, by default all results of the admin unit are replaced.
+    With run_pk, rows are saved for that SimulationRun and nothing is deleted.
+    Returns the number of rows written.
+    """
+    run_columns = (scenario_pk, responseoption_pk, adm0, adm1, adm2, run_pk)
+    insert_chunk = _chunk_inserter()
+    n_rows = 0
+    with profiling.span("write rows", vendor=connection.vendor) as write_span, transaction.atomic():
+        sdps = SimulatedDataPoint.objects.filter(
+            scenario_id=scenario_pk, responseoption_id=responseoption_pk, admin0=adm0, admin1=adm1, admin2=adm2
+        )
+        if element_pks is not None:
+            sdps = sdps.filter(element_id__in=[int(pk) for pk in element_pks])
+        deleted, _ = sdps.delete() if run_pk is None else (0, None)
+        rows = iter(rows)
+        while True:
+            chunk = [row + run_columns for row in itertools.islice(rows, CHUNK_ROWS)]
+            if not chunk:
+                break
+            insert_chunk(chunk)
+            n_rows += len(chunk)
+        write_span.counts.update(deleted=deleted, rows=n_rows)
+    return n_rows
+
+
+def _chunk_inserter():
+    if connection.vendor == "postgresql":
+        return _copy
+    if connection.vendor == "microsoft":
+        return _fast_executemany
+    return _executemany
+
+
+def _copy(chunk: list):
+    # None is written as \N, so it isn't confused with an empty string
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([[r"\N" if value is None else value for value in row] for row in chunk])
+    buffer.seek(0)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {TABLE} ({', '.join(COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer
+        )
+
+
+def _fast_executemany(chunk: list):
+    # the raw pyodbc cursor, Django's cursor wrapper doesn't expose fast_executemany
+    connection.ensure_connection()
+    cursor = connection.connection.cursor()
+    try:
+        cursor.fast_executemany = True
+        cursor.executemany(
+            f"INSERT INTO {TABLE} ({', '.join(COLUMNS)}) VALUES ({', '.join(['?'] * len(COLUMNS))})", chunk
+        )
+    finally:
+        cursor.close()
+
+
+def _executemany(chunk: list):
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {TABLE} ({', '.join(COLUMNS)}) VALUES ({', '.join(['%s'] * len(COLUMNS))})", chunk
+        )
@@ -0,0 +1,185 @@
+import hashlib
+from datetime import date, timedelta
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from ..models import SimulationRun, SimulatedDataPoint, SimulatedSeries
+from . import model_cache, profiling, result_storage
+
+# Every saved simulation is a SimulationRun, identified by a hash of everything its results depend on: the model's
+# equations and elements, input datapoints, constants, pulses, dates and engine settings.
+# A combination whose hash matches its current run is already up to date, so it isn't simulated again.
+# Results point to the run that saved them and only results of current runs are read, so the previous results stay
+# readable until a new run is complete. Runs that aren't current are deleted by collect_garbage.
+
+# bump when a change to the engines changes results for the same inputs, so no earlier run is reused
+RESULTS_VERSION = 1
+# runs that are no longer current are kept this many days before they are deleted
+KEEP_DAYS = 7
+
+
+def _update(digest, value):
+    """ Add value to digest, numbers as floats so 1 and 1.0 hash the same, dicts in key order """
+    if isinstance(value, np.ndarray):
+        digest.update(b"a")
+        digest.update(np.ascontiguousarray(value, dtype=float).tobytes())
+    elif isinstance(value, dict):
+        digest.update(b"{")
+        for key in sorted(value, key=str):
+            _update(digest, str(key))
+            _update(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(b"[")
+        for item in value:
+            _update(digest, item)
+    elif isinstance(value, (int, float, np.number)) and not isinstance(value, bool):
+        digest.update(repr(float(value)).encode())
+    else:
+        digest.update(repr(value).encode())
+    digest.update(b";")
+
+
+def model_digest(
+        compiled,
+        adm0: str,
+        adm1: str = None,
+        adm2: str = None,
+        integrator: str = "euler",
+        step_size: float = None,
+):
+    """ sha256 of everything a compiled model's results depend on, apart from constants and pulses
+    Input data is hashed from the datapoints of the admin unit in the database, not from the model's input arrays,
+    which may come from a cache. Finish it for each run with run_hashes.
+    """
+    definition = compiled.definition
+    digest = hashlib.sha256()
+    for value in [
+        RESULTS_VERSION, result_storage.storage(), compiled.engine, integrator, step_size,
+        definition.samramodel_pk, adm0, adm1, adm2, definition.startdate, definition.enddate, definition.timestep,
+        definition.model_output_pks, compiled.compiled_equations.source,
+        [(element.pk, element.sd_type, element.constant_default_value) for element in definition.elements],
+        definition.stocks,
+        model_cache.model_definition_hash(
+            definition.samramodel_pk, adm0, adm1, adm2, definition.startdate, definition.enddate
+        ),
+    ]:
+        _update(digest, value)
+    return digest
+
+
+def run_hashes(digest, runs: list, element_pks: set) -> list[str]:
+    """ Hash of each (scenario pk, response pk, constants, pulses) of collect_runs, from a model_digest
+    only constants and pulses of element_pks, the elements of the model, are hashed
+    """
+    hashes = []
+    for _, _, constants, pulses in runs:
+        run_digest = digest.copy()
+        _update(run_digest, {pk: value for pk, value in constants.items() if str(pk) in element_pks})
+        _update(run_digest, {pk: value for pk, value in pulses.items() if str(pk) in element_pks})
+        hashes.append(run_digest.hexdigest())
+    return hashes
+
+
+def reusable_runs(samramodel_pk: int, runs: list, hashes: list, adm0: str, adm1: str = None, adm2: str = None) -> set:
+    """ Indices of the runs whose current SimulationRun has the same hash, so their saved results are up to date """
+    current = set(SimulationRun.objects.filter(
+        samramodel_id=samramodel_pk, admin0=adm0, admin1=adm1, admin2=adm2, input_hash__in=set(hashes),
+        status=SimulationRun.DONE, current=True,
+    ).values_list("scenario_id", "responseoption_id", "input_hash"))
+    return {
+        i for i, ((scenario_pk, responseoption_pk, _, _), input_hash) in enumerate(zip(runs, hashes))
+        if (scenario_pk, responseoption_pk, input_hash) in current
+    }
+
+
+def start_run(
+        samramodel_pk: int,
+        scenario_pk: int,
+        responseoption_pk: int,
+        adm0: str,
+        adm1: str,
+        adm2: str,
+        input_hash: str,
+        engine: str,
+        startdate: date,
+        enddate: date,
+        timestep: int,
+) -> SimulationRun:
+    return SimulationRun.objects.create(
+        samramodel_id=samramodel_pk, scenario_id=scenario_pk, responseoption_id=responseoption_pk, admin0=adm0,
+        admin1=adm1, admin2=adm2, input_hash=input_hash, engine=engine, startdate=startdate, enddate=enddate,
+        timestep=timestep, date_started=timezone.now(),
+    )
+
+
+def finish_run(
+        run: SimulationRun,
+        n_values: int,
+        simulate_seconds: float,
+        save_seconds: float,
+        element_pks: list = None,
+):
+    """ Make run, whose results are saved, the current run of its combination
+    Results saved without a run are deleted. element_pks are the elements the run saved if it only saved some,
+    results of the other elements are moved over from the previous current run, so they are still read.
+    """
+    combination = dict(
+        scenario_id=run.scenario_id, responseoption_id=run.responseoption_id, admin0=run.admin0, admin1=run.admin1,
+        admin2=run.admin2,
+    )
+    with transaction.atomic():
+        previous = SimulationRun.objects.filter(current=True, **combination).exclude(pk=run.pk)
+        for manager in [SimulatedDataPoint.objects, SimulatedSeries.objects]:
+            results = manager.filter(**combination)
+            if element_pks is None:
+                results.filter(run__isnull=True).delete()
+                continue
+            saved = Q(element_id__in=[int(pk) for pk in element_pks])
+            results.filter(saved, run__isnull=True).delete()
+            results.filter(Q(run__in=previous) | Q(run__isnull=True)).exclude(saved).update(run=run)
+        previous.update(current=False)
+        run.status = SimulationRun.DONE
+        run.current = True
+        run.n_values = n_values
+        run.simulate_seconds = simulate_seconds
+        run.save_seconds = save_seconds
+        run.date_finished = timezone.now()
+        run.save()
+
+
+def set_profile(run_pks: list, profile: str):
+    """ Record the phase timings of the run_model call that saved runs, see profiling.py """
+    SimulationRun.objects.filter(pk__in=run_pks).update(profile=profile)
+
+
+def fail_runs(runs: list):
+    SimulationRun.objects.filter(
+        pk__in=[run.pk for run in runs], status=SimulationRun.RUNNING
+    ).update(status=SimulationRun.FAILED, date_finished=timezone.now())
+
+
+def forget_runs(scenario_pk: int, responseoption_pk: int, adm0: str, adm1: str = None, adm2: str = None):
+    """ Stop reusing the current run of a combination, for results saved without a run
+    the run stays current, so results it saved that weren't replaced are still read
+    """
+    SimulationRun.objects.filter(
+        scenario_id=scenario_pk, responseoption_id=responseoption_pk, admin0=adm0, admin1=adm1, admin2=adm2,
+        current=True,
+    ).update(input_hash="")
+
+
+def collect_garbage(keep_days: int = KEEP_DAYS) -> int:
+    """ Delete runs, and their results, that are no longer current, failed, or never finished
+    only runs started more than keep_days ago are deleted. Returns the number of runs deleted.
+    """
+    runs = SimulationRun.objects.filter(current=False, date_started__lt=timezone.now() - timedelta(days=keep_days))
+    n_runs = runs.count()
+    with profiling.span("collect garbage", runs=n_runs), transaction.atomic():
+        # results first, in bulk, rather than through the cascade
+        SimulatedDataPoint.objects.filter(run__in=runs).delete()
+        SimulatedSeries.objects.filter(run__in=runs).delete()
+        runs.delete()
+    return n_runs
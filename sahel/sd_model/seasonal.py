@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from ..models import SeasonalInputDataPoint
+from . import model_cache, profiling
+
+# Seasonal Inputs are one value per day of the year, repeated every year.
+# Each element's profile is read once per admin unit, and tiled onto any simulation window with array operations.
+
+MAX_CACHED_PROFILES = 1000
+
+_profiles = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+@dataclass
+class SeasonalProfile:
+    """ Annual profile of a Seasonal Input in an admin unit, sorted through the year """
+    # 0-11 and 0-30, so they can be added to numpy months and days
+    month_offsets: np.ndarray
+    day_offsets: np.ndarray
+    values: np.ndarray
+
+
+def load_profiles(element_pks: list, adm0: str, adm1: str = None, adm2: str = None, use_cache: bool = True) -> dict:
+    """ SeasonalProfile of each element in element_pks that has seasonal values, by element pk
+    Values on the same day of the year (from different years or lower admin levels) are averaged.
+    """
+    with profiling.span("seasonal") as seasonal_span:
+        sdps = SeasonalInputDataPoint.objects.filter(admin0=adm0, element_id__in=element_pks)
+        if adm1 is not None:
+            sdps = sdps.filter(admin1=adm1)
+            if adm2 is not None:
+                sdps = sdps.filter(admin2=adm2)
+        watermarks = model_cache.datapoint_watermarks([sdps])
+
+        profiles = {}
+        keys = {pk: (pk, adm0, adm1, adm2, watermarks.get(pk)) for pk in watermarks}
+        if use_cache:
+            for pk, key in keys.items():
+                profile = get(key)
+                if profile is not None:
+                    profiles[pk] = profile
+
+        missing = [pk for pk in keys if pk not in profiles]
+        if missing:
+            df = pd.DataFrame(
+                sdps.filter(element_id__in=missing).values_list("element_id", "date", "value"),
+                columns=["element_id", "date", "value"],
+            )
+            df["date"] = pd.to_datetime(df["date"])
+            df["month"] = df["date"].dt.month - 1
+            df["day"] = df["date"].dt.day - 1
+            df = df.groupby(["element_id", "month", "day"])["value"].mean().reset_index()
+            for pk, df_element in df.groupby("element_id"):
+                profiles[pk] = SeasonalProfile(
+                    month_offsets=df_element["month"].to_numpy(), day_offsets=df_element["day"].to_numpy(),
+                    values=df_element["value"].to_numpy(dtype=float),
+                )
+                if use_cache:
+                    put(keys[pk], profiles[pk])
+
+        seasonal_span.counts.update(loaded=len(missing), reused=len(keys) - len(missing))
+    return profiles
+
+
+def tile_profile(profile: SeasonalProfile, startdate: date, enddate: date) -> tuple[np.ndarray, np.ndarray]:
+    """ Times (date ordinals) and values of a profile repeated over every year the simulation could touch
+    A 29 February becomes 1 March in years that aren't leap years.
+    """
+    years = np.arange(startdate.year - 1, enddate.year + 2) - 1970
+    months = years[:, None] * 12 + profile.month_offsets[None, :]
+    days = months.astype("datetime64[M]").astype("datetime64[D]") + profile.day_offsets[None, :]
+    ts = days.astype(int).ravel() + date(1970, 1, 1).toordinal()
+    return ts.astype(float), np.tile(profile.values, len(years))
+
+
+def get(key):
+    with _cache_lock:
+        profile = _profiles.get(key)
+        if profile is not None:
+            _profiles.move_to_end(key)
+        return profile
+
+
+def put(key, profile: SeasonalProfile):
+    with _cache_lock:
+        for old_key in [old_key for old_key in _profiles if old_key[:-1] == key[:-1]]:
+            del _profiles[old_key]
+        _profiles[key] = profile
+        while len(_profiles) > MAX_CACHED_PROFILES:
+            _profiles.popitem(last=False)
+
+
+def clear():
+    with _cache_lock:
+        _profiles.clear()
@@ -0,0 +1,182 @@
+from datetime import date
+
+import numpy as np
+
+from ..models import Variable, HouseholdConstantValue, SensitivityIndex
+from . import model_operations, numpy_engine, profiling
+
+# runs simulated together in one batch, limits memory for large designs
+BATCH_SIZE = 1000
+MORRIS_LEVELS = 4
+
+
+def morris_design(n_params: int, n_trajectories: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    """ Morris trajectories in the unit hypercube
+    Returns the design of shape (n_trajectories * (n_params + 1), n_params) and, for each trajectory, the order in
+    which its parameters were stepped, of shape (n_trajectories, n_params).
+    """
+    delta = MORRIS_LEVELS / (2 * (MORRIS_LEVELS - 1))
+    start_levels = np.arange(MORRIS_LEVELS // 2) / (MORRIS_LEVELS - 1)
+    design = np.empty((n_trajectories, n_params + 1, n_params))
+    orders = np.empty((n_trajectories, n_params), dtype=int)
+    for r in range(n_trajectories):
+        x = rng.choice(start_levels, size=n_params)
+        orders[r] = rng.permutation(n_params)
+        design[r, 0] = x
+        for step, param in enumerate(orders[r], start=1):
+            x = x.copy()
+            x[param] += delta
+            design[r, step] = x
+    return design.reshape(-1, n_params), orders
+
+
+def morris_indices(y: np.ndarray, orders: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """ mu* (mean absolute elementary effect) and sigma of each parameter, from outputs of a morris_design """
+    n_trajectories, n_params = orders.shape
+    delta = MORRIS_LEVELS / (2 * (MORRIS_LEVELS - 1))
+    y = y.reshape(n_trajectories, n_params + 1)
+    effects = np.empty((n_trajectories, n_params))
+    for r in range(n_trajectories):
+        effects[r, orders[r]] = np.diff(y[r]) / delta
+    return np.abs(effects).mean(axis=0), effects.std(axis=0)
+
+
+def sobol_design(n_params: int, n_base: int, rng: np.random.Generator) -> np.ndarray:
+    """ Saltelli design in the unit hypercube: A, B, then A with column i from B for each parameter i
+    Returns an array of shape (n_base * (n_params + 2), n_params).
+    """
+    a = rng.random((n_base, n_params))
+    b = rng.random((n_base, n_params))
+    blocks = [a, b]
+    for i in range(n_params):
+        ab = a.copy()
+        ab[:, i] = b[:, i]
+        blocks.append(ab)
+    return np.concatenate(blocks)
+
+
+def sobol_indices(y: np.ndarray, n_params: int) -> tuple[np.ndarray, np.ndarray]:
+    """ First order and total Sobol indices from outputs of a sobol_design (Saltelli 2010 and Jansen estimators) """
+    y = y.reshape(n_params + 2, -1)
+    y_a, y_b, y_ab = y[0], y[1], y[2:]
+    variance = np.var(np.concatenate([y_a, y_b]))
+    if variance == 0:
+        return np.zeros(n_params), np.zeros(n_params)
+    s1 = np.mean(y_b * (y_ab - y_a), axis=1) / variance
+    st = 0.5 * np.mean((y_a - y_ab) ** 2, axis=1) / variance
+    return s1, st
+
+
+def run_sensitivity(
+        samramodel_pk: int,
+        adm0: str,
+        element_pk: int,
+        constant_ranges: dict,
+        method: str = SensitivityIndex.MORRIS,
+        n: int = 20,
+        scenario_pk: int = 1,
+        response_pk: int = 1,
+        agg_value: str = None,
+        seed: int = None,
+        startdate: date = date(2023, 1, 1),
+        enddate: date = date(2025, 1, 1),
+        timestep: int = 2,
+) -> list[SensitivityIndex]:
+    """ Rank how much each constant drives an aggregated output, and save the indices
+    constant_ranges is {constant pk: (low, high)}, for Constants, Household Constants and Scenario Constants.
+    The other constants keep their values for the given scenario and response.
+    n is the number of trajectories for Morris, and the number of base samples for Sobol.
+    """
+    with profiling.span("sensitivity", constants=len(constant_ranges)):
+        element = Variable.objects.get(pk=element_pk)
+        if agg_value is None:
+            agg_value = element.aggregate_by
+        constant_pks = [str(pk) for pk in constant_ranges]
+        constants_in_db = dict(Variable.objects.filter(pk__in=constant_pks).values_list("pk", "sd_type"))
+        invalid = [
+            pk for pk in constant_pks
+            if constants_in_db.get(int(pk)) not in ["Constant", "Household Constant", "Scenario Constant"]
+        ]
+        if invalid:
+            raise ValueError(f"{invalid} are not constants")
+        lows = np.array([constant_ranges[pk][0] for pk in constant_ranges], dtype=float)
+        highs = np.array([constant_ranges[pk][1] for pk in constant_ranges], dtype=float)
+
+        # only the chosen output and what it depends on is simulated
+        compiled = model_operations.get_compiled_model(
+            int(samramodel_pk), adm0, None, None, startdate, enddate, timestep, engine="numpy",
+            output_pks=[str(element_pk)],
+        )
+        numpy_model = compiled.model
+        missing = [pk for pk in constant_pks if pk not in numpy_model.constant_defaults]
+        if missing:
+            print(f"constants {missing} don't affect {element}, their indices will be 0")
+
+        rng = np.random.default_rng(seed)
+        if method == SensitivityIndex.MORRIS:
+            design, orders = morris_design(len(constant_pks), n, rng)
+        elif method == SensitivityIndex.SOBOL:
+            design = sobol_design(len(constant_pks), n, rng)
+        else:
+            raise ValueError(f"invalid method {method}")
+        samples = lows + design * (highs - lows)
+        print(f"{method} design of {len(samples)} runs for {len(constant_pks)} constants")
+
+        with compiled.lock:
+            ((_, _, base_constants, pulses),) = model_operations.collect_runs(
+                compiled.definition.elements, [scenario_pk], [response_pk], adm0, numpy_model.t
+            )
+        y = np.empty(len(samples))
+        with profiling.span("simulate design", runs=len(samples)):
+            for batch_start in range(0, len(samples), BATCH_SIZE):
+                batch = samples[batch_start:batch_start + BATCH_SIZE]
+                constants = base_constants | {pk: batch[:, i] for i, pk in enumerate(constant_pks)}
+                results = numpy_engine.integrate(
+                    numpy_model, constants, pulses, [str(element_pk)], batch_size=len(batch)
+                )
+                y[batch_start:batch_start + len(batch)] = model_operations.aggregate_values(
+                    results[str(element_pk)], agg_value, element.unit, numpy_model.dt
+                )
+
+        if method == SensitivityIndex.MORRIS:
+            mu_star, sigma = morris_indices(y, orders)
+            scores = mu_star
+            fields = [{"mu_star": mu_star[i], "sigma": sigma[i]} for i in range(len(constant_pks))]
+        else:
+            s1, st = sobol_indices(y, len(constant_pks))
+            scores = st
+            fields = [{"s1": s1[i], "st": st[i]} for i in range(len(constant_pks))]
+        ranks = np.empty(len(constant_pks), dtype=int)
+        ranks[np.argsort(-scores, kind="stable")] = np.arange(1, len(constant_pks) + 1)
+
+        indices = [
+            SensitivityIndex(
+                samramodel_id=samramodel_pk, element_id=element_pk, constant_id=int(pk), scenario_id=scenario_pk,
+                responseoption_id=response_pk, admin0=adm0, method=method, agg_value=agg_value, low=lows[i],
+                high=highs[i], rank=ranks[i], n_runs=len(samples), **fields[i],
+            )
+            for i, pk in enumerate(constant_pks)
+        ]
+        SensitivityIndex.objects.filter(
+            element_id=element_pk, scenario_id=scenario_pk, responseoption_id=response_pk, admin0=adm0, method=method,
+        ).delete()
+        SensitivityIndex.objects.bulk_create(indices)
+        for i in np.argsort(ranks):
+            print(indices[i], {key: round(float(value), 4) for key, value in fields[i].items()})
+    return indices
+
+
+def default_ranges(samramodel_pk: int, adm0: str, constant_pks: list[int], spread: float = 0.5) -> dict:
+    """ Ranges of +/- spread around each constant's household value for adm0, or its default value """
+    ranges = {}
+    household_values = dict(
+        HouseholdConstantValue.objects.filter(element_id__in=constant_pks, admin0=adm0)
+        .values_list("element_id", "value")
+    )
+    defaults = dict(Variable.objects.filter(pk__in=constant_pks, samramodel_id=samramodel_pk)
+                    .values_list("pk", "constant_default_value"))
+    for pk in constant_pks:
+        value = household_values.get(int(pk), defaults.get(int(pk)))
+        value = 0.0 if value is None else value
+        ranges[str(pk)] = (value * (1 - spread), value * (1 + spread))
+    return ranges
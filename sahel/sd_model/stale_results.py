@@ -0,0 +1,122 @@
+from datetime import date
+
+from django.utils import timezone
+
+from ..models import SimulationRun, StaleResult
+from . import model_operations, profiling
+
+
+def mark_stale(
+        reason: str,
+        samramodel_pk: int = None,
+        adm0: str = None,
+        scenario_pk: int = None,
+        response_pk: int = None,
+) -> int:
+    """ Mark the simulated (scenario, response, admin0) results matching the filters as stale
+    a filter left as None matches everything, only combinations that have a current SimulationRun are marked.
+    Runs are looked up rather than results, so marking stays cheap when it is called for every saved datapoint.
+    """
+    filters = {}
+    if samramodel_pk is not None:
+        filters["samramodel_id"] = samramodel_pk
+    if adm0 is not None:
+        filters["admin0"] = adm0
+    if scenario_pk is not None:
+        filters["scenario_id"] = scenario_pk
+    if response_pk is not None:
+        filters["responseoption_id"] = response_pk
+    combinations = set(
+        SimulationRun.objects.filter(current=True, **filters)
+        .values_list("samramodel_id", "scenario_id", "responseoption_id", "admin0")
+        .distinct()
+    )
+    if not combinations:
+        return 0
+
+    now = timezone.now()
+    existing = StaleResult.objects.filter(
+        scenario_id__in={combination[1] for combination in combinations},
+        responseoption_id__in={combination[2] for combination in combinations},
+    )
+    existing_pks = {}
+    for pk, scenario_id, responseoption_id, admin0 in existing.values_list(
+            "pk", "scenario_id", "responseoption_id", "admin0"):
+        existing_pks[(scenario_id, responseoption_id, admin0)] = pk
+    # keep the latest mark, so a refresh that started before this change doesn't clear it
+    StaleResult.objects.filter(
+        pk__in=[existing_pks[combination[1:]] for combination in combinations if combination[1:] in existing_pks]
+    ).update(date_marked=now, reason=reason)
+    StaleResult.objects.bulk_create([
+        StaleResult(
+            samramodel_id=samramodel_id, scenario_id=scenario_id, responseoption_id=responseoption_id,
+            admin0=admin0, reason=reason, date_marked=now,
+        )
+        for samramodel_id, scenario_id, responseoption_id, admin0 in combinations
+        if (scenario_id, responseoption_id, admin0) not in existing_pks
+    ])
+    print(f"marked {len(combinations)} results stale: {reason}")
+    return len(combinations)
+
+
+def clear_stale(scenario_pks: list[int], response_pks: list[int], adm0: str, before):
+    """ Clear stale marks made before the results were re-simulated """
+    StaleResult.objects.filter(
+        scenario_id__in=scenario_pks, responseoption_id__in=response_pks, admin0=adm0, date_marked__lt=before
+    ).delete()
+
+
+def stale_runs(startdate: date = None, enddate: date = None, timestep: int = None, engine: str = None) -> list[tuple]:
+    """ Group stale results into as few run_model calls as possible
+    returns [(samramodel_pk, adm0, scenario_pks, response_pks, startdate, enddate, timestep, engine)], each covering
+    exactly its stale combinations, with the dates, timestep and engine of their current admin0 SimulationRun.
+    The arguments are used for combinations without a run.
+    """
+    last_runs = {
+        (scenario_pk, response_pk, adm0): run_settings
+        for scenario_pk, response_pk, adm0, *run_settings in SimulationRun.objects.filter(
+            current=True, admin1__isnull=True, admin2__isnull=True,
+        ).values_list("scenario_id", "responseoption_id", "admin0", "startdate", "enddate", "timestep", "engine")
+    }
+    response_scenarios = {}
+    for samramodel_pk, adm0, scenario_pk, response_pk in StaleResult.objects.values_list(
+            "samramodel_id", "admin0", "scenario_id", "responseoption_id"):
+        run_settings = tuple(last_runs.get((scenario_pk, response_pk, adm0), (startdate, enddate, timestep, engine)))
+        response_scenarios.setdefault((samramodel_pk, adm0, response_pk, run_settings), set()).add(scenario_pk)
+
+    # responses with the same stale scenarios and run settings can share a run
+    runs = {}
+    for (samramodel_pk, adm0, response_pk, run_settings), scenario_pks in response_scenarios.items():
+        runs.setdefault((samramodel_pk, adm0, tuple(sorted(scenario_pks)), run_settings), []).append(response_pk)
+    return [
+        (samramodel_pk, adm0, list(scenario_pks), sorted(response_pks), *run_settings)
+        for (samramodel_pk, adm0, scenario_pks, run_settings), response_pks in runs.items()
+    ]
+
+
+def refresh_stale(
+        startdate: date = date(2023, 1, 1),
+        enddate: date = date(2025, 1, 1),
+        timestep: int = 2,
+        engine: str = "numpy",
+        workers: int = 1,
+):
+    """ Re-simulate only the stale results
+    each with the dates, timestep and engine of its last run, startdate, enddate, timestep and engine are for results
+    without one.
+    Models are rebuilt from the database and nothing is reused, since the change that made results stale may not
+    show in the caches or in the hashes of their runs.
+    """
+    runs = stale_runs(startdate, enddate, timestep, engine)
+    with profiling.span("refresh stale", runs=len(runs)):
+        for samramodel_pk, adm0, scenario_pks, response_pks, *run_settings in runs:
+            run_startdate, run_enddate, run_timestep, run_engine = run_settings
+            if samramodel_pk is None or adm0 is None:
+                print(f"can't refresh scenarios {scenario_pks}, responses {response_pks} without a model and admin0")
+                continue
+            print(f"refreshing model {samramodel_pk}, {adm0}, scenarios {scenario_pks}, responses {response_pks}, "
+                  f"from {run_startdate} to {run_enddate} with {run_engine}")
+            model_operations.run_model(
+                scenario_pks, response_pks, samramodel_pk, adm0, startdate=run_startdate, enddate=run_enddate,
+                timestep=run_timestep, engine=run_engine, workers=workers, use_cache=False, reuse=False,
+            )
@@ -0,0 +1,159 @@
+import time
+from datetime import date
+
+import numpy as np
+
+from ..models import MeasuredDataPoint, ForecastedDataPoint, SeasonalInputDataPoint
+from . import input_arrays, model_operations, numpy_engine, profiling, run_registry
+
+# Runs every admin1 or admin2 unit of a country together, with the admin unit as an extra batch axis.
+# The model is compiled once for the admin0, units only differ by their inputs, which are read per unit.
+
+ADMIN_LEVELS = [1, 2]
+
+
+def admin_units(adm0: str, level: int = 1) -> list[tuple]:
+    """ (admin1, admin2) of every admin unit of adm0 that has input data, admin2 is None for level 1 """
+    fields = ["admin1", "admin2"][:level]
+    units = set()
+    for manager in [MeasuredDataPoint.objects, ForecastedDataPoint.objects, SeasonalInputDataPoint.objects]:
+        dps = manager.filter(admin0=adm0)
+        for field in fields:
+            dps = dps.exclude(**{f"{field}__isnull": True}).exclude(**{field: ""})
+        units.update(dps.order_by().values_list(*fields).distinct())
+    return sorted(unit if level == 2 else (unit[0], None) for unit in units)
+
+
+def run_subnational(
+        scenario_pks: list[int],
+        response_pks: list[int],
+        samramodel_pk: int,
+        adm0: str,
+        level: int = 1,
+        units: list[tuple] = None,
+        startdate: date = date(2022, 7, 1),
+        enddate: date = date(2024, 7, 1),
+        timestep: int = 2,
+        use_cache: bool = True,
+        output_pks: list[int] = None,
+        integrator: str = "euler",
+        step_size: float = None,
+        reuse: bool = True,
+        profile: bool = False,
+):
+    """ Run and save every combination of scenario and response for every admin unit of adm0 at level 1 or 2
+    units is a list of (admin1, admin2) to run, by default all units with input data.
+    Every unit and combination is simulated in a single numpy batch. Constants are those of the admin0, and so are
+    the inputs a unit has no data for.
+    Results are saved with admin1 and admin2 set, see model_operations.run_model for the other arguments.
+    Stale marks are for admin0 results, so they are left as they are.
+    with reuse, units and combinations whose saved results come from the same inputs aren't run again.
+    the time taken by each phase is printed and logged, profile also captures cProfile and tracemalloc statistics.
+    """
+    if adm0 not in model_operations.ADMIN0S:
+        print("invalid admin0")
+        return
+    if level not in ADMIN_LEVELS:
+        print(f"invalid level, must be one of {ADMIN_LEVELS}")
+        return
+    if integrator not in numpy_engine.INTEGRATORS:
+        print(f"invalid integrator, must be one of {numpy_engine.INTEGRATORS}")
+        return
+    samramodel_pk = int(samramodel_pk)
+    scenario_pks = [int(pk) for pk in scenario_pks]
+    response_pks = [int(pk) for pk in response_pks]
+    if output_pks is not None:
+        output_pks = sorted({str(pk) for pk in output_pks}, key=int)
+    if units is None:
+        units = admin_units(adm0, level)
+    if not units:
+        print(f"no admin{level} units with data for {adm0}")
+        return
+    print(f"running {len(units)} admin{level} units of {adm0}")
+
+    saved_run_pks = []
+    with profiling.profile(
+            "run_subnational", capture=profile, model=samramodel_pk, adm0=adm0, level=level, units=len(units)
+    ) as root:
+        compiled = model_operations.get_compiled_model(
+            samramodel_pk, adm0, None, None, startdate, enddate, timestep, engine="numpy", use_cache=use_cache,
+            output_pks=output_pks,
+        )
+        numpy_model = compiled.model
+        input_elements = [element for element in compiled.definition.elements if str(element.pk) in numpy_model.inputs]
+
+        with compiled.lock:
+            model_output_pks = compiled.definition.model_output_pks.copy()
+            with profiling.span("setup") as setup_span:
+                runs = model_operations.collect_runs(
+                    compiled.definition.elements, scenario_pks, response_pks, adm0, numpy_model.t
+                )
+                unit_inputs = [
+                    input_arrays.load_inputs(input_elements, adm0, adm1, adm2, startdate, enddate, timestep, use_cache)
+                    for adm1, adm2 in units
+                ]
+                fallbacks = {
+                    units[i]: [pk for pk, series in inputs.items() if series.admin0_fallback]
+                    for i, inputs in enumerate(unit_inputs)
+                }
+                fallbacks = {unit: pks for unit, pks in fallbacks.items() if pks}
+                if fallbacks:
+                    print(f"{len(fallbacks)} of {len(units)} units use {adm0} data for inputs they have no data for: "
+                          f"{fallbacks}")
+                element_pks = {str(element.pk) for element in compiled.definition.elements}
+                pending = []
+                hashes = {}
+                for i, (adm1, adm2) in enumerate(units):
+                    unit_hashes = run_registry.run_hashes(
+                        run_registry.model_digest(compiled, adm0, adm1, adm2, integrator, step_size), runs,
+                        element_pks,
+                    )
+                    reused = run_registry.reusable_runs(
+                        samramodel_pk, runs, unit_hashes, adm0, adm1, adm2
+                    ) if reuse else set()
+                    for j in range(len(runs)):
+                        hashes[i, j] = unit_hashes[j]
+                        if j not in reused:
+                            pending.append((i, j))
+                setup_span.counts.update(
+                    runs=len(units) * len(runs), pending=len(pending),
+                    admin0_fallbacks=sum(len(pks) for pks in fallbacks.values()),
+                )
+            if not pending:
+                print(f"all {len(units) * len(runs)} units and combinations are up to date")
+                return None
+            with profiling.span("simulate", runs=len(pending)) as simulate_span:
+                # the batch is unit by unit, with every combination of a unit next to each other
+                inputs = {
+                    pk: np.stack([unit_inputs[i][pk].values for i, _ in pending], axis=1) for pk in numpy_model.inputs
+                }
+                dfs = numpy_engine.simulate_batch(
+                    numpy_model, [(runs[j][2], runs[j][3]) for _, j in pending], model_output_pks,
+                    integrator=integrator, step_size=step_size, inputs=inputs,
+                )
+
+            with profiling.span("save", runs=len(pending)):
+                for (i, j), df in zip(pending, dfs):
+                    adm1, adm2 = units[i]
+                    scenario_pk, responseoption_pk, _, _ = runs[j]
+                    save_start = time.time()
+                    run = run_registry.start_run(
+                        samramodel_pk, scenario_pk, responseoption_pk, adm0, adm1, adm2, hashes[i, j], "numpy",
+                        startdate, enddate, timestep,
+                    )
+                    try:
+                        n_values = model_operations.save_results(
+                            df, scenario_pk, responseoption_pk, adm0, model_output_pks, replace_all=output_pks is None,
+                            adm1=adm1, adm2=adm2, run=run,
+                        )
+                    except Exception:
+                        run_registry.fail_runs([run])
+                        raise
+                    run_registry.finish_run(
+                        run, n_values, simulate_span.seconds / len(pending), time.time() - save_start,
+                        element_pks=None if output_pks is None else model_output_pks,
+                    )
+                    saved_run_pks.append(run.pk)
+
+    run_registry.set_profile(saved_run_pks, profiling.to_json(root))
+    return None
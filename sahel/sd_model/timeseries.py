@@ -0,0 +1,110 @@
+from dataclasses import dataclass
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from ..models import MeasuredDataPoint, ForecastedDataPoint
+from . import profiling
+
+# Bulk loaders for measured and forecasted datapoints.
+# Only the needed columns of the needed elements are read, averaged per date in a single groupby, and split into
+# one TimeSeries per element (or per element and any other grouping fields).
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+@dataclass
+class TimeSeries:
+    """ Values of one element averaged per date, sorted by date """
+    dates: np.ndarray
+    values: np.ndarray
+    # only for forecasts, bounds of the 95% prediction interval
+    lower_bounds: np.ndarray = None
+    upper_bounds: np.ndarray = None
+
+    @property
+    def ordinals(self) -> np.ndarray:
+        """ dates as date ordinals, the time unit of the models """
+        return self.dates.astype("datetime64[D]").astype(int) + EPOCH_ORDINAL
+
+    def to_series(self) -> pd.Series:
+        return pd.Series(self.values, index=pd.DatetimeIndex(self.dates), name="value")
+
+
+def load_measured(
+        element_pks: list,
+        adm0: str,
+        adm1: str = None,
+        adm2: str = None,
+        startdate: date = None,
+        enddate: date = None,
+        by: tuple = (),
+        **filters,
+) -> dict:
+    """ Measured values of each element, as {element pk: TimeSeries}
+    by adds other MeasuredDataPoint fields (e.g. "admin1", "source_id") to group by, the keys are then tuples of
+    (element pk, *values of by). filters are passed on to the queryset.
+    """
+    datapoints = _filter(MeasuredDataPoint.objects, element_pks, adm0, adm1, adm2, startdate, enddate, filters)
+    return _load(datapoints, by, ["value"])
+
+
+def load_forecasted(
+        element_pks: list,
+        adm0: str,
+        adm1: str = None,
+        adm2: str = None,
+        startdate: date = None,
+        enddate: date = None,
+        by: tuple = (),
+        **filters,
+) -> dict:
+    """ Forecasted values and prediction intervals of each element, as {element pk: TimeSeries}, see load_measured """
+    datapoints = _filter(ForecastedDataPoint.objects, element_pks, adm0, adm1, adm2, startdate, enddate, filters)
+    return _load(datapoints, by, ["value", "lower_bound", "upper_bound"])
+
+
+def _filter(manager, element_pks, adm0, adm1, adm2, startdate, enddate, filters):
+    datapoints = manager.filter(element_id__in=element_pks, admin0=adm0, **filters)
+    if adm1 is not None:
+        datapoints = datapoints.filter(admin1=adm1)
+        if adm2 is not None:
+            datapoints = datapoints.filter(admin2=adm2)
+    if startdate is not None:
+        datapoints = datapoints.filter(date__gte=startdate)
+    if enddate is not None:
+        datapoints = datapoints.filter(date__lte=enddate)
+    return datapoints
+
+
+def _load(datapoints, by: tuple, value_fields: list) -> dict:
+    with profiling.span("timeseries") as load_span:
+        keys = ["element_id", *by]
+        fields = [*keys, "date", *value_fields]
+        df = pd.DataFrame(datapoints.order_by().values_list(*fields), columns=fields)
+        load_span.counts["rows"] = len(df)
+        if df.empty:
+            return {}
+        df["date"] = pd.to_datetime(df["date"])
+        df[value_fields] = df[value_fields].astype(float)
+        df = df.groupby([*keys, "date"], dropna=False)[value_fields].mean().reset_index()
+
+        # rows are sorted by keys, so each group is a contiguous slice
+        key_values = df[keys].astype(object).to_numpy()
+        codes = df.groupby(keys, dropna=False, sort=False).ngroup().to_numpy()
+        changes = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+        bounds = zip(np.concatenate([[0], changes]), np.concatenate([changes, [len(df)]]))
+        dates = df["date"].to_numpy().astype("datetime64[D]")
+        values = {field: df[field].to_numpy() for field in value_fields}
+        series = {}
+        for group_start, group_stop in bounds:
+            key = tuple(key_values[group_start]) if by else key_values[group_start][0]
+            group = slice(group_start, group_stop)
+            series[key] = TimeSeries(
+                dates=dates[group], values=values["value"][group],
+                lower_bounds=values["lower_bound"][group] if "lower_bound" in values else None,
+                upper_bounds=values["upper_bound"][group] if "upper_bound" in values else None,
+            )
+        load_span.counts.update(dates=len(df), series=len(series))
+        return series
@@ -0,0 +1,52 @@
+from dataclasses import dataclass, field
+
+from django.db.models import Q
+
+from ..models import Variable
+from . import profiling
+
+
+@dataclass(frozen=True)
+class FlowEdge:
+    """ A flow going into (sd_sink) or out of (sd_source) a stock """
+    flow_pk: int
+    stock_pk: int
+    unit: str
+    equation: str
+
+    @property
+    def has_equation(self) -> bool:
+        return self.equation is not None and self.equation != ""
+
+
+@dataclass
+class StockFlowTopology:
+    """ Inflows and outflows of every stock, by stock pk, in the default (label) order of Variables """
+    inflows: dict = field(default_factory=dict)
+    outflows: dict = field(default_factory=dict)
+
+    def edges(self) -> list[FlowEdge]:
+        """ All inflows then all outflows """
+        return [edge for edges in self.inflows.values() for edge in edges] + \
+               [edge for edges in self.outflows.values() for edge in edges]
+
+
+def load_topology(samramodel_pk: int = None, stock_pks: list = None) -> StockFlowTopology:
+    """ Read the stock-flow structure of a SAMRA model (or of all models) in one query
+    stock_pks limits it to the flows of those stocks.
+    """
+    if stock_pks is not None:
+        stock_pks = {int(pk) for pk in stock_pks}
+    flows = Variable.objects.filter(Q(sd_source__isnull=False) | Q(sd_sink__isnull=False))
+    if samramodel_pk is not None:
+        flows = flows.filter(samramodel_id=samramodel_pk)
+    topology = StockFlowTopology()
+    with profiling.span("topology") as topology_span:
+        rows = flows.values_list("pk", "sd_source_id", "sd_sink_id", "unit", "equation")
+        for pk, source_pk, sink_pk, unit, equation in rows:
+            if sink_pk is not None and (stock_pks is None or sink_pk in stock_pks):
+                topology.inflows.setdefault(sink_pk, []).append(FlowEdge(pk, sink_pk, unit, equation))
+            if source_pk is not None and (stock_pks is None or source_pk in stock_pks):
+                topology.outflows.setdefault(source_pk, []).append(FlowEdge(pk, source_pk, unit, equation))
+        topology_span.counts["rows"] = len(rows)
+    return topology
@@ -0,0 +1,73 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_save
+from django.dispatch import receiver
+
+from .models import Variable, ResponseConstantValue, ScenarioConstantValue, HouseholdConstantValue, PulseValue, \
+    MeasuredDataPoint, ForecastedDataPoint, SeasonalInputDataPoint
+
+
+def _mark_stale(reason, **filters):
+    # imported here so loading the app doesn't pull in the simulation engines
+    from .sd_model.stale_results import mark_stale
+    # after the commit, so rows deleted with a response or scenario aren't marked, their marks would block the delete
+    transaction.on_commit(lambda: mark_stale(reason, **filters))
+
+
+def _delete_artifacts(samramodel_pk):
+    """ Delete a model's compiled models saved to disk, they were built from its old variables or data """
+    if samramodel_pk is None:
+        return
+    from .sd_model import model_artifacts
+    model_artifacts.clear(samramodel_pk)
+
+
+def _variable_samramodel_pk(variable_pk):
+    return Variable.objects.filter(pk=variable_pk).values_list("samramodel_id", flat=True).first()
+
+
+@receiver(post_save, sender=ResponseConstantValue)
+@receiver(post_delete, sender=ResponseConstantValue)
+@receiver(post_save, sender=PulseValue)
+@receiver(post_delete, sender=PulseValue)
+def response_value_changed(sender, instance, **kwargs):
+    _mark_stale(f"{sender.__name__} {instance.pk} changed", response_pk=instance.responseoption_id,
+                adm0=instance.admin0)
+
+
+@receiver(post_save, sender=ScenarioConstantValue)
+@receiver(post_delete, sender=ScenarioConstantValue)
+def scenario_value_changed(sender, instance, **kwargs):
+    _mark_stale(f"{sender.__name__} {instance.pk} changed", scenario_pk=instance.scenario_id)
+
+
+@receiver(post_save, sender=HouseholdConstantValue)
+@receiver(post_delete, sender=HouseholdConstantValue)
+def household_value_changed(sender, instance, **kwargs):
+    _mark_stale(f"{sender.__name__} {instance.pk} changed", samramodel_pk=_variable_samramodel_pk(instance.element_id),
+                adm0=instance.admin0)
+
+
+# no post_delete: it would stop the bulk deletes in update_data and forecasting from being fast deletes,
+# those mark their results stale themselves
+@receiver(post_save, sender=MeasuredDataPoint)
+@receiver(post_save, sender=ForecastedDataPoint)
+@receiver(post_save, sender=SeasonalInputDataPoint)
+def datapoint_changed(sender, instance, **kwargs):
+    samramodel_pk = _variable_samramodel_pk(instance.element_id)
+    _delete_artifacts(samramodel_pk)
+    _mark_stale(f"{sender.__name__} {instance.pk} changed", samramodel_pk=samramodel_pk, adm0=instance.admin0)
+
+
+@receiver(post_save, sender=Variable)
+@receiver(post_delete, sender=Variable)
+def variable_changed(sender, instance, **kwargs):
+    _delete_artifacts(instance.samramodel_id)
+
+
+@receiver(pre_save, sender=Variable)
+def equation_changed(sender, instance, **kwargs):
+    if instance.pk is None:
+        return
+    old_equation = Variable.objects.filter(pk=instance.pk).values_list("equation", flat=True).first()
+    if old_equation != instance.equation:
+        _mark_stale(f"equation of {instance} changed", samramodel_pk=instance.samramodel_id)
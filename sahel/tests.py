@@ -1,3 +1,155 @@
-from django.test import TestCase
+import contextlib
+import io
+from datetime import date
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from .models import MeasuredDataPoint, SimulationRun, Variable
+from .sd_model import benchmark, equations, model_operations, numpy_engine, result_storage
+
+ADM0 = "Mali"
+STARTDATE = date(2023, 1, 1)
+ENDDATE = date(2024, 1, 1)
+
+
+def quietly(func, *args, **kwargs):
+    """ Call func without the timings and progress it prints """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args, **kwargs)
+
+
+@override_settings(MODEL_ARTIFACT_DIR="")
+class SyntheticModelTestCase(TestCase):
+    """ Tests on a small model from the benchmark generator, see sd_model/benchmark.py """
+    size = benchmark.BenchmarkSize(stocks=3, flows=6, converters=12, inputs=3, smooths=3, pulses=2, scenarios=2,
+                                   responses=2)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.model = quietly(benchmark.create_model, cls.size, ADM0, STARTDATE, ENDDATE, seed=1)
+
+    def run_model(self, **kwargs):
+        quietly(
+            model_operations.run_model, self.model.scenario_pks, self.model.response_pks, self.model.samramodel_pk,
+            ADM0, startdate=STARTDATE, enddate=ENDDATE, use_cache=False, **kwargs,
+        )
+
+    def results(self) -> dict:
+        df = result_storage.read_points(
+            ["element_id", "scenario_id", "responseoption_id", "date", "value"],
+            element__samramodel_id=self.model.samramodel_pk, admin0=ADM0,
+        )
+        return {
+            (row.element_id, row.scenario_id, row.responseoption_id, row.date): row.value
+            for row in df.itertuples()
+        }
+
+
+class EngineParityTests(SyntheticModelTestCase):
+    def test_numpy_matches_bptk(self):
+        self.run_model(engine="bptk")
+        bptk_results = self.results()
+        self.run_model(engine="numpy")
+        numpy_results = self.results()
+        self.assertTrue(bptk_results)
+        self.assertEqual(bptk_results.keys(), numpy_results.keys())
+        for key, value in bptk_results.items():
+            self.assertAlmostEqual(numpy_results[key], value, delta=1e-6 * max(abs(value), 1.0), msg=key)
+
+
+class IntegratorTests(SyntheticModelTestCase):
+    def integrate(self, timestep: int, **kwargs) -> dict:
+        """ Outputs of the baseline response, which has no pulses, by date ordinal """
+        compiled = quietly(
+            model_operations.get_compiled_model, self.model.samramodel_pk, ADM0, None, None, STARTDATE, ENDDATE,
+            timestep, engine="numpy", use_cache=False,
+        )
+        numpy_model = compiled.model
+        ((_, _, constants, pulses),) = quietly(
+            model_operations.collect_runs, compiled.definition.elements, self.model.scenario_pks[:1],
+            self.model.response_pks[:1], ADM0, numpy_model.t,
+        )
+        outputs = compiled.definition.model_output_pks
+        results = quietly(numpy_engine.integrate, numpy_model, constants, pulses, outputs, **kwargs)
+        return {pk: dict(zip(numpy_model.t, results[pk][:, 0])) for pk in outputs}
+
+    @staticmethod
+    def max_error(results: dict, reference: dict) -> float:
+        return max(
+            abs(value - reference[pk][t]) / (abs(reference[pk][t]) + 1.0)
+            for pk, values in results.items() for t, value in values.items() if t in reference[pk]
+        )
+
+    def test_rk4_and_adaptive_are_closer_to_fine_euler_than_coarse_euler(self):
+        reference = self.integrate(1)
+        euler_error = self.max_error(self.integrate(8), reference)
+        self.assertGreater(euler_error, 0.0)
+        for kwargs in [dict(integrator="rk4"), dict(integrator="adaptive"), dict(integrator="adaptive", step_size=8)]:
+            with self.subTest(**kwargs):
+                error = self.max_error(self.integrate(8, **kwargs), reference)
+                self.assertLess(error, euler_error)
+                self.assertLess(error, 0.01)
+
+
+class ReuseTests(SyntheticModelTestCase):
+    def test_unchanged_runs_are_skipped(self):
+        self.run_model(engine="numpy")
+        n_runs = SimulationRun.objects.filter(samramodel_id=self.model.samramodel_pk).count()
+        self.assertEqual(n_runs, len(self.model.scenario_pks) * len(self.model.response_pks))
+        self.run_model(engine="numpy")
+        self.assertEqual(SimulationRun.objects.filter(samramodel_id=self.model.samramodel_pk).count(), n_runs)
+
+    def test_runs_are_repeated_after_a_datapoint_changes(self):
+        self.run_model(engine="numpy")
+        n_runs = SimulationRun.objects.filter(samramodel_id=self.model.samramodel_pk).count()
+        datapoint = MeasuredDataPoint.objects.filter(
+            element__samramodel_id=self.model.samramodel_pk, date__range=(STARTDATE, ENDDATE)
+        ).first()
+        datapoint.value += 10.0
+        datapoint.save()
+        self.run_model(engine="numpy")
+        runs = SimulationRun.objects.filter(samramodel_id=self.model.samramodel_pk)
+        self.assertEqual(runs.count(), 2 * n_runs)
+        self.assertEqual(runs.filter(current=True).count(), n_runs)
+
+
+class EquationTests(SimpleTestCase):
+    @staticmethod
+    def elements(*equations_by_pk):
+        return [Variable(pk=pk, sd_type=Variable.VARIABLE, equation=equation) for pk, equation in equations_by_pk]
+
+    def test_whitelist(self):
+        for equation in ["_E1_ * 2 + sd.max(_E2_, 0)", "smooth(model, _E1_, 30)", "sd.If(sd.time() > 3, 1, 0)"]:
+            with self.subTest(equation=equation):
+                self.assertEqual(equations.check_equation(equation)[2], [])
+        for equation in ["__import__('os')", "_E1_.real", "open('x')", "smooth(_E1_, 30)", "sd.unknown(1)", "x + 1"]:
+            with self.subTest(equation=equation):
+                self.assertTrue(equations.check_equation(equation)[2])
+
+    def test_invalid_equations_are_set_to_zero(self):
+        compiled = equations.compile_equations(self.elements((1, "__import__('os')"), (2, "_E1_ + _E9_")))
+        self.assertEqual(compiled.expressions, {"1": "0.0", "2": "0.0"})
+        self.assertEqual(len(compiled.problems), 2)
+
+    def test_cycles_are_errors(self):
+        with self.assertRaisesRegex(ValueError, "cycle"):
+            equations.compile_equations(self.elements((1, "_E2_"), (2, "_E1_ + 1")))
+        with self.assertRaisesRegex(ValueError, "cycle"):
+            equations.compile_equations(self.elements((1, "smooth(model, 1, _E2_)"), (2, "_E1_")))
+
+    def test_loops_through_smooth_and_delay_are_allowed(self):
+        compiled = equations.compile_equations(self.elements(
+            (1, "smooth(model, _E2_, 3)"), (2, "_E1_ * 0.5 + 1"), (3, "delay(model, _E3_ + 1, 4, 0.0, 2)"),
+        ))
+        self.assertLess(compiled.order.index("1"), compiled.order.index("2"))
+        self.assertEqual(len(compiled.problems), 1)
+
+
+class EncodingTests(SimpleTestCase):
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        for values in [np.array([]), np.zeros(10), rng.normal(size=1000), np.array([np.nan, np.inf, -0.0, 1e300])]:
+            with self.subTest(n_points=len(values)):
+                decoded = result_storage.decode(result_storage.encode(values), len(values))
+                np.testing.assert_array_equal(decoded, values)
@@ -171,6 +171,17 @@ X_FRAME_OPTIONS = "SAMEORIGIN"
 
 SESSION_EXPIRE_AT_BROWSER_CLOSE = True
 
+# how simulation results are saved and read: "rows" (a SimulatedDataPoint per element and date) or "series"
+# (a compressed SimulatedSeries per element)
+SIMULATION_RESULT_STORAGE = os.environ.get("SIMULATION_RESULT_STORAGE", "rows")
+
+# where compiled models are saved, so new processes load them instead of reading the model from the database,
+# empty to not save them
+MODEL_ARTIFACT_DIR = os.environ.get("MODEL_ARTIFACT_DIR", str(BASE_DIR / "model_artifacts"))
+
+# file the phase timings of each model run are appended to as JSON lines, empty to only print them
+SIMULATION_PROFILE_LOG = os.environ.get("SIMULATION_PROFILE_LOG", "")
+
 try:
     from local_settings import *
 except ImportError: